@@ -24,9 +24,21 @@ from unittest import main
 
 from ising import NbrTest, GrayGeneratorTest, GrayFlipTest, NeighboursTest, Nbr3dTest, EdgeTest, EM_Test
 from enumerate_ising import TestIsing
-from geometry import TestHistogram
+from geometry import TestHistogram, TestTorus, TestDistances, TestStructure, TestPacking
 from cluster_ising import ClusterIsingTests
+from markov_ising import TestCheckerboard as TestCheckerboardIsing, TestMultiSpin
 from ising_db import DbTest
 from thermo import TestThermo
+from cells import TestCellGrid
+from md_ensemble import TestEnsemble
+from trajectory import TestTrajectory
+from checkpoint import TestCheckpointer
+from event_chain import TestEventChain
+from markov_disks import TestMarkovDisks, TestCheckerboard, TestStepSizeController
+from multi_chain import TestMultiChain
+from eos import TestEos
+from parallel_tempering import TestParallelTempering
+from lattice import TestLattice
+from md import TestEventCalendar, TestVectorized, TestLazy, TestPeriodic, TestCreateConfig, TestsForFiles
 
 main()
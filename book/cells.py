@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2025 Simon Crase
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+    Cell lists: partition a box into a grid of cells, each at least as wide as the
+    diameter of a sphere, so that a sphere can only touch spheres that lie in its own
+    cell or in an adjacent one.
+'''
+
+from itertools import product
+from unittest import TestCase, main
+import numpy as np
+
+class CellGrid:
+    '''
+    A grid of cells covering a box, used to keep track of which spheres are near each other
+
+    Attributes:
+        L          Lengths of sides
+        d          Dimension of space
+        m          Number of cells along each side
+        w          Width of cells along each side
+        periodic   Indicates whether the grid wraps around (periodic boundary conditions)
+        cells      Maps the index of each cell to the set of spheres that it contains
+        cell_of    Maps the index of each sphere to the cell that contains it
+    '''
+    def __init__(self, L = np.array([1,1]), width = 0.2, periodic = False):
+        '''
+        Parameters:
+            L          Lengths of sides
+            width      Minimum width for a cell, e.g. 2*sigma
+            periodic   Indicates whether the grid wraps around
+        '''
+        self.L = np.array(L, dtype = float)
+        self.d = len(self.L)
+        self.m = np.maximum(np.floor(self.L/width).astype(int), 1)
+        self.w = self.L/self.m
+        self.periodic = periodic
+        self.cells = {}
+        self.cell_of = {}
+        self.adjacent = {}
+
+    def get_cell(self, x):
+        '''
+        Determine which cell contains a point
+
+        Parameters:
+            x      The point
+        '''
+        c = np.floor(np.asarray(x)/self.w).astype(int)
+        return tuple(int(k) for k in (c % self.m if self.periodic else np.clip(c, 0, self.m - 1)))
+
+    def fill(self, Xs):
+        '''
+        Assign each sphere in a configuration to its cell
+
+        Parameters:
+            Xs     Centres of all spheres
+        '''
+        self.cells = {}
+        self.cell_of = {}
+        for i,x in enumerate(Xs):
+            self.add(i, self.get_cell(x))
+
+    def add(self, i, cell):
+        '''
+        Record that a sphere lies in a specified cell
+        '''
+        self.cell_of[i] = cell
+        self.cells.setdefault(cell, set()).add(i)
+
+    def remove(self, i):
+        '''
+        Remove a sphere from the grid
+        '''
+        self.cells[self.cell_of.pop(i)].discard(i)
+
+    def move(self, i, cell):
+        '''
+        Move a sphere to a new cell
+        '''
+        self.remove(i)
+        self.add(i, cell)
+
+    def get_adjacent(self, cell):
+        '''
+        Find a cell together with all adjacent cells, without duplicates.
+        Adjacent cells wrap around if the grid is periodic.
+
+        Parameters:
+            cell    Index of a cell
+        '''
+        if cell not in self.adjacent:
+            adjacent = set()
+            for offset in product([-1,0,1], repeat = self.d):
+                c = np.array(cell) + np.array(offset)
+                if self.periodic:
+                    c %= self.m
+                elif any(c < 0) or any(c >= self.m):
+                    continue
+                adjacent.add(tuple(int(k) for k in c))
+            self.adjacent[cell] = sorted(adjacent)
+        return self.adjacent[cell]
+
+    def get_neighbours(self, i):
+        '''
+        Iterate through all the spheres that lie in the same cell as a specified sphere, or in an adjacent cell
+
+        Parameters:
+            i      Index of sphere (excluded from the results)
+        '''
+        for cell in self.get_adjacent(self.cell_of[i]):
+            for j in self.cells.get(cell, ()):
+                if j != i:
+                    yield j
+
+    def get_crossing_time(self, i, x, v):
+        '''
+        Calculate the time at which a moving sphere will leave its cell. For a periodic
+        grid, a position that has just wrapped around is still measured from its own cell.
+
+        Parameters:
+            i      Index of sphere
+            x      Position of sphere
+            v      Velocity of sphere
+
+        Returns:
+            k, t where k is the coordinate whose boundary will be crossed first, and t is the time
+            to crossing, which is infinite if the sphere cannot leave its cell (e.g. only one cell).
+        '''
+        cell = self.cell_of[i]
+        u = np.asarray(x) - np.array(cell) * self.w   # Position relative to lower corner of cell
+        if self.periodic:
+            u = (u + 0.5*self.L) % self.L - 0.5*self.L
+        crossing_times = np.full((self.d), float('inf'))
+        for k in range(self.d):
+            if self.m[k] == 1 and not self.periodic: continue
+            if v[k] > 0 and (self.periodic or cell[k] < self.m[k] - 1):
+                crossing_times[k] = max(0.0, (self.w[k] - u[k]) / v[k])
+            if v[k] < 0 and (self.periodic or cell[k] > 0):
+                crossing_times[k] = max(0.0, u[k] / (-v[k]))
+        k = np.argmin(crossing_times)
+        return k, crossing_times[k]
+
+    def cross(self, i, k, v):
+        '''
+        Move a sphere into the next cell along a specified coordinate
+
+        Parameters:
+            i      Index of sphere
+            k      Coordinate whose boundary is being crossed
+            v      Velocity of sphere: determines direction of crossing
+        '''
+        cell = list(self.cell_of[i])
+        cell[k] += 1 if v[k] > 0 else -1
+        if self.periodic:
+            cell[k] %= self.m[k]
+        self.move(i, tuple(cell))
+
+class TestCellGrid(TestCase):
+    '''
+    Tests for CellGrid
+    '''
+    def test_widths(self):
+        grid = CellGrid(L = np.array([1,2]), width = 0.3)
+        np.testing.assert_array_equal([3,6], grid.m)
+        self.assertTrue(all(grid.w >= 0.3))
+
+    def test_adjacent_box(self):
+        grid = CellGrid(L = np.array([1,1]), width = 0.25)
+        self.assertEqual(4, len(grid.get_adjacent((0,0))))
+        self.assertEqual(9, len(grid.get_adjacent((1,1))))
+
+    def test_adjacent_periodic(self):
+        grid = CellGrid(L = np.array([1,1,1]), width = 0.25, periodic = True)
+        self.assertEqual(27, len(grid.get_adjacent((0,0,0))))
+        self.assertIn((3,3,3), grid.get_adjacent((0,0,0)))
+
+    def test_adjacent_few_cells(self):
+        grid = CellGrid(L = np.array([1,1]), width = 0.4, periodic = True)
+        self.assertEqual(4, len(grid.get_adjacent((0,0))))
+
+    def test_neighbours(self):
+        grid = CellGrid(L = np.array([1,1]), width = 0.25)
+        grid.fill(np.array([[0.1,0.1], [0.3,0.3], [0.9,0.9], [0.6,0.1]]))
+        self.assertCountEqual([1], grid.get_neighbours(0))
+        self.assertCountEqual([0,3], grid.get_neighbours(1))
+        self.assertCountEqual([], grid.get_neighbours(2))
+
+    def test_crossing(self):
+        grid = CellGrid(L = np.array([1,1]), width = 0.25)
+        grid.fill(np.array([[0.1,0.1]]))
+        k,t = grid.get_crossing_time(0, np.array([0.1,0.1]), np.array([1.0,-1.0]))
+        self.assertEqual(0,k)
+        self.assertAlmostEqual(0.15,t)
+        grid.cross(0, k, np.array([1.0,-1.0]))
+        self.assertEqual((1,0), grid.cell_of[0])
+
+    def test_crossing_periodic(self):
+        grid = CellGrid(L = np.array([1,1]), width = 0.25, periodic = True)
+        grid.fill(np.array([[0.9,0.5]]))
+        k,t = grid.get_crossing_time(0, np.array([0.9,0.5]), np.array([1.0,0.0]))
+        self.assertAlmostEqual(0.1,t)
+        grid.cross(0, k, np.array([1.0,0.0]))
+        self.assertEqual((0,2), grid.cell_of[0])
+        k,t = grid.get_crossing_time(0, np.array([1.0-1e-17,0.5]), np.array([1.0,0.0]))
+        self.assertAlmostEqual(0.25,t)
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2025 Simon Crase
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+    Checkpoints for long runs. Each checkpoint is written to a temporary file, which is
+    renamed once it is complete, so a run that is killed never leaves a half written
+    checkpoint behind. Checkpoints can be written on a background thread, so the
+    simulation does not have to wait for the disk.
+'''
+
+from collections import deque
+from glob import glob
+from os import chmod, fsync, makedirs, remove, replace, stat, umask
+from os.path import basename, dirname, join, splitext
+from queue import Queue
+from struct import unpack
+from tempfile import mkstemp, TemporaryDirectory
+from threading import Thread
+from time import monotonic
+from unittest import TestCase, main
+from zipfile import ZipFile, ZIP_STORED
+import numpy as np
+
+def get_umask():
+    '''
+    Find the permissions that the process masks out of new files. The only way to read the mask
+    is to set it, so this is done once, before any background threads start writing files.
+    '''
+    mask = umask(0)
+    umask(mask)
+    return mask
+
+UMASK = get_umask()
+
+def save_npz_atomic(path, **arrays):
+    '''
+    Save arrays to an uncompressed npz file: the data are written to a temporary file
+    in the same folder, which then replaces the target in a single step. The temporary
+    file is created readable by its owner only, so it is given the permissions that
+    np.savez would have used before it replaces the target.
+
+    Parameters:
+        path      Name of file
+        arrays    Arrays to be saved, as for np.savez
+    '''
+    folder = dirname(path)
+    handle,temp = mkstemp(dir = folder if len(folder) > 0 else '.', prefix = f'.{basename(path)}', suffix = '.tmp')
+    try:
+        with open(handle, 'wb') as f:
+            np.savez(f, **arrays)
+            f.flush()
+            fsync(f.fileno())
+        chmod(temp, 0o666 & ~UMASK)
+        replace(temp, path)
+    except BaseException:
+        remove(temp)
+        raise
+
+def load_npz_mmap(path):
+    '''
+    Map the arrays in an uncompressed npz file into memory, so nothing is read until it is used.
+    Arrays that cannot be mapped (compressed or containing objects) are read in the usual way.
+
+    Parameters:
+        path      Name of file
+
+    Returns:
+        A dictionary of arrays, indexed by name
+    '''
+    arrays = {}
+    with ZipFile(path) as archive, open(path, 'rb') as f:
+        for info in archive.infolist():
+            name = info.filename.removesuffix('.npy')
+            if info.compress_type == ZIP_STORED:
+                f.seek(info.header_offset + 26)         # Local header: lengths of file name and extra field
+                n_name,n_extra = unpack('<HH', f.read(4))
+                f.seek(info.header_offset + 30 + n_name + n_extra)
+                major,_ = np.lib.format.read_magic(f)
+                read_header = np.lib.format.read_array_header_1_0 if major == 1 else np.lib.format.read_array_header_2_0
+                shape,fortran_order,dtype = read_header(f)
+                if not dtype.hasobject:
+                    arrays[name] = (np.memmap(path, dtype = dtype, mode = 'r', offset = f.tell(), shape = shape,
+                                              order = 'F' if fortran_order else 'C')
+                                    if np.prod(shape) > 0 else np.empty(shape, dtype = dtype))
+                    continue
+            with archive.open(info) as member:
+                arrays[name] = np.lib.format.read_array(member, allow_pickle = True)
+    return arrays
+
+class Checkpointer:
+    '''
+    Write numbered checkpoints, retaining only the most recent ones. The folder is only
+    scanned once, when the Checkpointer is created: after that, sequence numbers and
+    retained files are tracked in memory. Checkpoints may be triggered by elapsed
+    time, or by the number of events since the last checkpoint.
+
+    Attributes:
+        folder      Folder where checkpoints are stored
+        base        Name of checkpoint files, before sequence number
+        ext         Extension for checkpoint files
+        retention   Number of checkpoints to be retained
+        interval    Minimum time between checkpoints (seconds), or None
+        every       Minimum number of events between checkpoints, or None
+        sequence    Sequence number of the most recent checkpoint
+        saved       Retained checkpoints, oldest first
+        queue       Checkpoints waiting to be written by background thread
+        error       Exception raised by background thread, if any
+    '''
+    def __init__(self, file_patterns = 'md.npz', folder = 'configs', retention = 3, interval = None, every = None,
+                 background = True):
+        '''
+        Parameters:
+            file_patterns   Underlying pattern for file names (extended with sequence number)
+            folder          Folder where checkpoints are stored
+            retention       Number of checkpoints to be retained
+            interval        Minimum time between checkpoints (seconds), or None
+            every           Minimum number of events between checkpoints, or None
+            background      Write checkpoints on a background thread
+        '''
+        self.folder = folder
+        self.base,self.ext = splitext(file_patterns)
+        self.retention = retention
+        self.interval = interval
+        self.every = every
+        makedirs(folder, exist_ok = True)
+        sequences = sorted(int(digits) for digits in
+                           (basename(f)[len(self.base):-len(self.ext)] for f in glob(join(folder, f'{self.base}[0-9]*{self.ext}')))
+                           if digits.isdigit())
+        self.sequence = sequences[-1] if len(sequences) > 0 else 0
+        self.saved = deque(self.get_path(s) for s in sequences)
+        self.last_time = monotonic()
+        self.last_events = 0
+        self.error = None
+        self.queue = None
+        if background:
+            self.queue = Queue(maxsize = 2)
+            self.thread = Thread(target = self.run, daemon = True)
+            self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def get_path(self, sequence):
+        '''
+        Name of the checkpoint file with a specified sequence number
+        '''
+        return join(self.folder, f'{self.base}{sequence:06d}{self.ext}')
+
+    def is_due(self, n_events = 0):
+        '''
+        Determine whether it is time for another checkpoint
+
+        Parameters:
+            n_events   Total number of events so far
+        '''
+        return ((self.interval != None and monotonic() - self.last_time >= self.interval) or
+                (self.every != None and n_events - self.last_events >= self.every))
+
+    def save(self, n_events = 0, **arrays):
+        '''
+        Record a checkpoint. The arrays are copied straight away, so the caller may continue to
+        modify them while the checkpoint is being written.
+
+        Parameters:
+            n_events   Total number of events so far
+            arrays     Data to be saved, as for np.savez
+
+        Returns:
+            Name of checkpoint file
+        '''
+        self.check()
+        self.sequence += 1
+        self.last_time = monotonic()
+        self.last_events = n_events
+        path = self.get_path(self.sequence)
+        snapshot = {name : np.array(value, copy = True) for name,value in arrays.items()}
+        if self.queue == None:
+            self.write(path, snapshot)
+        else:
+            self.queue.put((path, snapshot))
+        return path
+
+    def write(self, path, arrays):
+        '''
+        Write one checkpoint, then delete the oldest checkpoints if too many have been retained
+        '''
+        save_npz_atomic(path, **arrays)
+        self.saved.append(path)
+        while len(self.saved) > self.retention:
+            remove(self.saved.popleft())
+
+    def run(self):
+        '''
+        Used by background thread to write checkpoints as they are queued
+        '''
+        while True:
+            item = self.queue.get()
+            try:
+                if item == None: return
+                if self.error == None:
+                    self.write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def wait(self):
+        '''
+        Wait until all queued checkpoints have been written
+        '''
+        if self.queue != None:
+            self.queue.join()
+        self.check()
+
+    def check(self):
+        '''
+        Report any failure on the background thread
+        '''
+        if self.error != None:
+            raise RuntimeError(f'Failed to write checkpoint: {self.error}') from self.error
+
+    def close(self):
+        '''
+        Write any queued checkpoints, then stop background thread
+        '''
+        if self.queue != None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.check()
+
+class TestCheckpointer(TestCase):
+    '''
+    Tests for Checkpointer and associated functions
+    '''
+    def test_atomic_mmap(self):
+        with TemporaryDirectory() as folder:
+            path = join(folder, 'test.npz')
+            Xs = np.arange(12.0).reshape(4,3)
+            save_npz_atomic(path, Xs = Xs, d = 3, L = np.ones(3), flag = True)
+            self.assertEqual(['test.npz'], [basename(f) for f in glob(join(folder, '*'))])
+            arrays = load_npz_mmap(path)
+            self.assertIsInstance(arrays['Xs'], np.memmap)
+            np.testing.assert_array_equal(Xs, arrays['Xs'])
+            self.assertEqual(3, int(arrays['d']))
+            self.assertTrue(bool(arrays['flag']))
+
+    def test_permissions(self):
+        '''
+        A checkpoint has the same permissions as a file written by np.savez
+        '''
+        with TemporaryDirectory() as folder:
+            save_npz_atomic(join(folder, 'atomic.npz'), Xs = np.zeros((2,2)))
+            np.savez(join(folder, 'plain.npz'), Xs = np.zeros((2,2)))
+            self.assertEqual(stat(join(folder, 'plain.npz')).st_mode, stat(join(folder, 'atomic.npz')).st_mode)
+
+    def test_retention(self):
+        with TemporaryDirectory() as folder:
+            with Checkpointer(file_patterns = 'md.npz', folder = folder, retention = 2) as checkpointer:
+                for i in range(5):
+                    checkpointer.save(Xs = np.full((2,2), i))
+            self.assertEqual(['md000004.npz', 'md000005.npz'], sorted(basename(f) for f in glob(join(folder, '*'))))
+            checkpointer = Checkpointer(file_patterns = 'md.npz', folder = folder, retention = 2, background = False)
+            self.assertEqual(5, checkpointer.sequence)
+            checkpointer.save(Xs = np.zeros((2,2)))
+            self.assertEqual(['md000005.npz', 'md000006.npz'], sorted(basename(f) for f in glob(join(folder, '*'))))
+
+    def test_snapshot(self):
+        with TemporaryDirectory() as folder:
+            Xs = np.zeros((3,2))
+            with Checkpointer(folder = folder) as checkpointer:
+                path = checkpointer.save(Xs = Xs)
+                Xs += 1
+            with np.load(path) as data:
+                np.testing.assert_array_equal(np.zeros((3,2)), data['Xs'])
+
+    def test_triggers(self):
+        checkpointer = Checkpointer(folder = '.', every = 100, background = False)
+        self.assertFalse(checkpointer.is_due(99))
+        self.assertTrue(checkpointer.is_due(100))
+        checkpointer.interval = 0
+        self.assertTrue(checkpointer.is_due(0))
+
+if __name__=='__main__':
+    main()
@@ -15,11 +15,16 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-'''Algorithm 5.9 Cluster Ising'''
-
+'''Algorithm 5.9 Cluster Ising, and the Swendsen-Wang multi-cluster algorithm'''
 
+from os.path import join
+from tempfile import TemporaryDirectory
 import numpy as np
-from ising import  Neighbours
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from enumerate_ising import get_exact_averages
+from ising import  Neighbours, generate_edges
+from ising_db import IsingDatabase
 from unittest import main,TestCase
 
 class IsingData:
@@ -83,6 +88,8 @@ class ClusterIsing:
         beta        Inverse temperature
         p           See discussion following (5.22)
         data        Used to store counts for energy and magnetization
+        in_cluster  Marks sites that belong to the cluster being built: cleared after each step
+        cluster     Sites of the cluster, in the order they were added; those not yet processed form the Pocket
     '''
     def __init__(self,rng=np.random.default_rng(),shape=(4,5),periodic=False,beta=0.001):
         self.rng = rng
@@ -94,30 +101,47 @@ class ClusterIsing:
         self.p  = 1.0 - np.exp(-2.0*beta) # Makes acceptance probability == 1 - (5.22)
         self.data = IsingData(self.N)
         self.neighbours = Neighbours(shape=shape,periodic=periodic)
+        self.in_cluster = np.zeros((self.N),dtype=bool)
+        self.cluster = np.empty((self.N),dtype=int)
 
     def step(self,sigma):
         '''
         Construct Cluster and the Pocket, a subset that will be used to expand the Cluster.
         Initially each of them contains the same randomly selected spin. We extend the Cluster
-        by selecting one element from the Pocket repeatedly, and growing both sets by randomly selecting
-        neighbours with the same spin.
+        by taking one element from the Pocket repeatedly, and growing both sets by randomly selecting
+        neighbours with the same spin. The Pocket is the tail of the array that holds the Cluster,
+        so the cost of a step is proportional to the size of the Cluster, not the lattice.
+
+        Returns:
+            Changes to energy and magnetization caused by flipping the Cluster
         '''
         j = self.rng.integers(self.N)    # Start with this randomly selected site
-        Pocket, Cluster = [j], [j]
-        while Pocket != []:
-            k = self.rng.choice(Pocket)  # Process one site from pocket
-            Pocket.remove(k)
-            for l in self.neighbours[k,:]:             # Consider all neighbours
-                if l == -1: break                      # Sentinel indicates that we have exhausted neighbours
-                if (sigma[l] == sigma[k]               # Only add if spins match
-                    and l not in Cluster               # Don't match if already in Cluster
-                    and self.rng.uniform() < self.p):  # Add tocluster with probabiilty p
-                    Pocket.append(l)
-                    Cluster.append(l)
-
-        for k in Cluster:        # Flip the completed cluster
-            sigma[k] *= -1
-        return sigma
+        s = sigma[j]
+        self.cluster[0] = j
+        self.in_cluster[j] = True
+        head,size = 0,1                  # Pocket is self.cluster[head:size]
+        while head < size:
+            k = self.cluster[head]       # Process one site from pocket
+            head += 1
+            neighbours = self.neighbours[k,:]
+            r = self.rng.random(len(neighbours))
+            for l,u in zip(neighbours,r):                  # Consider all neighbours
+                if l == -1: break                          # Sentinel indicates that we have exhausted neighbours
+                if (sigma[l] == s                          # Only add if spins match
+                    and not self.in_cluster[l]             # Don't match if already in Cluster
+                    and u < self.p):                       # Add to cluster with probability p
+                    self.in_cluster[l] = True
+                    self.cluster[size] = l
+                    size += 1
+
+        Cluster = self.cluster[0:size]
+        boundary = self.neighbours[Cluster,:].ravel()          # Bonds from Cluster to sites outside change sign
+        boundary = boundary[boundary > -1]
+        boundary = boundary[~self.in_cluster[boundary]]
+        delta_E = 2 * int(s) * int(sigma[boundary].sum())
+        sigma[Cluster] *= -1                                   # Flip the completed cluster
+        self.in_cluster[Cluster] = False
+        return delta_E, -2 * int(s) * size
 
     def get_energy_magnetism(self,sigma):
         '''
@@ -149,8 +173,9 @@ class ClusterIsing:
         E,M = self.get_energy_magnetism(sigma)
         self.data.store(E,M)
         for i in range(Nsteps):
-            self.step(sigma)
-            E,M = self.get_energy_magnetism(sigma)
+            delta_E,delta_M = self.step(sigma)
+            E += delta_E
+            M += delta_M
             self.data.store(E,M)
 
         if database != None:
@@ -162,6 +187,76 @@ class ClusterIsing:
         return Nsteps + NIterations
 
 
+class SwendsenWangIsing(ClusterIsing):
+    '''
+    Swendsen-Wang algorithm: every bond between matching spins is activated with probability p,
+    the active bonds divide the lattice into clusters, and each cluster is flipped with probability 1/2.
+    Each step takes a few passes over arrays of sites and bonds, and changes every spin with probability 1/2,
+    so it corresponds to a sweep rather than to one step of ClusterIsing. Histograms are stored in the same way
+    as ClusterIsing, so results can be saved to, and resumed from, the same IsingDatabase.
+
+    The clusters also provide improved estimators: since clusters are flipped independently,
+    <M**2> = <sum |C|**2> and <M**4> = <3 (sum |C|**2)**2 - 2 sum |C|**4>, where the sums run over
+    all clusters built in one step. These have much less variance than M itself.
+
+    Attributes:
+        edges        Pairs of sites that are neighbours: an array of shape (2,number of bonds)
+        n_samples    Number of steps contributing to improved estimators
+        sum_M2       Sum over steps of improved estimator for M**2
+        sum_M4       Sum over steps of improved estimator for M**4
+    '''
+    def __init__(self,rng=np.random.default_rng(),shape=(4,5),periodic=False,beta=0.001):
+        super().__init__(rng=rng,shape=shape,periodic=periodic,beta=beta)
+        self.edges = np.array(list(generate_edges(shape=shape,periodic=periodic)),dtype=int).T.reshape(2,-1)
+        self.n_samples = 0
+        self.sum_M2 = 0.0
+        self.sum_M4 = 0.0
+
+    def get_clusters(self,sigma):
+        '''
+        Activate bonds between matching spins, and label the clusters that they connect
+
+        Returns:
+            n_clusters, labels: labels assigns each site to a cluster, numbered from 0
+        '''
+        i,j = self.edges
+        active = (sigma[i] == sigma[j]) & (self.rng.random(len(i)) < self.p)
+        bonds = coo_matrix((np.ones(active.sum(),dtype=bool),(i[active],j[active])),shape=(self.N,self.N))
+        return connected_components(bonds,directed=False)
+
+    def step(self,sigma):
+        '''
+        Build all clusters, accumulate improved estimators, and flip each cluster with probability 1/2
+
+        Returns:
+            Changes to energy and magnetization caused by flipping clusters
+        '''
+        n_clusters,labels = self.get_clusters(sigma)
+        sizes = np.bincount(labels,minlength=n_clusters).astype(float)
+        S2 = (sizes**2).sum()
+        self.n_samples += 1
+        self.sum_M2 += S2
+        self.sum_M4 += 3*S2**2 - 2*(sizes**4).sum()
+
+        flipped = (self.rng.random(n_clusters) < 0.5)[labels]
+        i,j = self.edges
+        broken = flipped[i] != flipped[j]                      # Bonds joining a flipped site to one that is not
+        delta_E = 2 * int((sigma[i[broken]] * sigma[j[broken]]).sum())
+        delta_M = -2 * int(sigma[flipped].sum())
+        sigma[flipped] *= -1
+        return delta_E, delta_M
+
+    def get_susceptibility(self):
+        '''
+        Improved estimator for magnetic susceptibility per site, beta <M**2>/N
+        '''
+        return self.beta * self.sum_M2 / (self.n_samples * self.N)
+
+    def get_binder(self):
+        '''
+        Improved estimator for Binder cumulant, 1 - <M**4>/(3 <M**2>**2)
+        '''
+        return 1 - (self.sum_M4 / self.n_samples) / (3 * (self.sum_M2 / self.n_samples)**2)
 
 class ClusterIsingTests(TestCase):
     def test_all_down(self):
@@ -192,6 +287,70 @@ class ClusterIsingTests(TestCase):
         self.assertEqual(+72,E)
         self.assertEqual(0,M)
 
+    def test_incremental(self):
+        '''
+        Verify that changes to energy and magnetization returned by step agree with recalculation
+        '''
+        for shape,periodic in [((6,6),True),((5,7),False),((3,4),True)]:
+            cluster_ising = ClusterIsing(rng=np.random.default_rng(23),shape=shape,periodic=periodic,beta=0.4)
+            sigma = cluster_ising.rng.choice([-1,1],size=cluster_ising.N)
+            E,M = cluster_ising.get_energy_magnetism(sigma)
+            for i in range(200):
+                delta_E,delta_M = cluster_ising.step(sigma)
+                E += delta_E
+                M += delta_M
+                self.assertEqual(cluster_ising.get_energy_magnetism(sigma),(E,M))
+            self.assertFalse(cluster_ising.in_cluster.any())
+
+    def test_boltzmann(self):
+        '''
+        Compare mean energy and magnetization squared with enumeration of all configurations
+        '''
+        shape,beta = (4,4),0.4
+        cluster_ising = ClusterIsing(rng=np.random.default_rng(29),shape=shape,periodic=True,beta=beta)
+        cluster_ising.run(Nsteps=20000)
+        E = np.array([e for e,_ in cluster_ising.data.generate_E()])
+        M = np.array([m for m,_ in cluster_ising.data.generate_M()])
+        mean_E,mean_M2,_ = get_exact_averages(shape,periodic=True,beta=beta)
+        self.assertAlmostEqual(mean_E,(E*cluster_ising.data.E).sum()/cluster_ising.data.E.sum(),delta=0.3)
+        self.assertAlmostEqual(mean_M2,(M**2*cluster_ising.data.M).sum()/cluster_ising.data.M.sum(),delta=5)
+
+    def test_swendsen_wang_incremental(self):
+        for shape,periodic in [((6,6),True),((5,7),False),((3,4),True)]:
+            swendsen_wang = SwendsenWangIsing(rng=np.random.default_rng(31),shape=shape,periodic=periodic,beta=0.4)
+            sigma = swendsen_wang.rng.choice([-1,1],size=swendsen_wang.N)
+            E,M = swendsen_wang.get_energy_magnetism(sigma)
+            for i in range(100):
+                delta_E,delta_M = swendsen_wang.step(sigma)
+                E += delta_E
+                M += delta_M
+                self.assertEqual(swendsen_wang.get_energy_magnetism(sigma),(E,M))
+
+    def test_swendsen_wang_boltzmann(self):
+        '''
+        Compare histograms and improved estimators with enumeration of all configurations
+        '''
+        shape,beta = (4,4),0.4
+        swendsen_wang = SwendsenWangIsing(rng=np.random.default_rng(37),shape=shape,periodic=True,beta=beta)
+        swendsen_wang.run(Nsteps=10000)
+        E = np.array([e for e,_ in swendsen_wang.data.generate_E()])
+        mean_E,mean_M2,mean_M4 = get_exact_averages(shape,periodic=True,beta=beta)
+        self.assertAlmostEqual(mean_E,(E*swendsen_wang.data.E).sum()/swendsen_wang.data.E.sum(),delta=0.3)
+        self.assertAlmostEqual(beta*mean_M2/16,swendsen_wang.get_susceptibility(),delta=0.02*beta*mean_M2/16)
+        self.assertAlmostEqual(1 - mean_M4/(3*mean_M2**2),swendsen_wang.get_binder(),delta=0.02)
+
+    def test_swendsen_wang_database(self):
+        '''
+        Verify that a run can be resumed from the database
+        '''
+        with TemporaryDirectory() as folder:
+            database = IsingDatabase(join(folder,'test.db'))
+            swendsen_wang = SwendsenWangIsing(rng=np.random.default_rng(41),shape=(4,4),periodic=True,beta=0.4)
+            self.assertEqual(100,swendsen_wang.run(Nsteps=100,database=database))
+            swendsen_wang = SwendsenWangIsing(rng=np.random.default_rng(43),shape=(4,4),periodic=True,beta=0.4)
+            self.assertEqual(250,swendsen_wang.run(Nsteps=150,database=database))
+            self.assertEqual(252,swendsen_wang.data.E.sum())
+
     def test_data_generate(self):
         '''
         Verify that IsingData.generate_E() starts at the correct place
@@ -18,6 +18,8 @@
 '''Algorithm 5.3: single flip enumeration for the Ising model.'''
 
 from collections import defaultdict
+from functools import lru_cache
+import numpy as np
 from ising import gray_flip, Nbr
 from unittest import main, TestCase, skip
 
@@ -40,7 +42,7 @@ def enumerate_ising(shape, periodic=True,frequency=0):
 
     Returns:
            Energy         Pairs (E,Count) for all possible energies
-           Magnetization  Pairs (M,Count) for all possible energies
+           Magnetization  Pairs ((E,M),Count) for all possible combinations of energy and magnetization
     '''
     N = shape[0]*shape[1]
     sigma = [-1]*N
@@ -68,6 +70,37 @@ def enumerate_ising(shape, periodic=True,frequency=0):
         sigma[k] *= -1  # Flip this site
     return [(E,Ns[E]) for E in sorted(Ns.keys())], [(M,Ms[M]) for M in sorted(Ms.keys())]
 
+@lru_cache
+def get_density_of_states(shape, periodic=True):
+    '''
+    Enumerate all configurations, and count those with each energy and magnetization.
+    Results are cached, as enumeration is slow.
+
+    Inputs: shape    Dimension of array
+            periodic Indicates whether to use periodic boundary conditions
+
+    Returns:
+           E, M, g   Arrays of energies, magnetizations, and number of configurations with each pair
+    '''
+    _,Magnetization = enumerate_ising(tuple(shape), periodic=periodic)
+    E,M = np.array([key for key,_ in Magnetization]).T
+    return E, M, np.array([count for _,count in Magnetization])
+
+def get_exact_averages(shape, periodic=True, beta=1.0):
+    '''
+    Calculate thermal averages exactly, from the density of states
+
+    Inputs: shape    Dimension of array
+            periodic Indicates whether to use periodic boundary conditions
+            beta     Inverse temperature
+
+    Returns:
+           Mean energy, mean square magnetization, and mean fourth power of magnetization
+    '''
+    E,M,g = get_density_of_states(tuple(shape), periodic=periodic)
+    weights = g * np.exp(-beta*(E - E.min()))
+    weights = weights / weights.sum()
+    return (E*weights).sum(), (M**2*weights).sum(), (M**4*weights).sum()
 
 class TestIsing(TestCase):
     '''Tests for enumerate_ising'''
@@ -87,6 +120,19 @@ class TestIsing(TestCase):
         for E,Ns in Energies:
             self.assertEqual(Expected[abs(E)],Ns)
 
+    def test_exact_averages(self):
+        '''
+        At infinite temperature spins are independent, so <M**2>=N and <M**4>=3N**2-2N;
+        at low temperature only the two ground states remain.
+        '''
+        mean_E,mean_M2,mean_M4 = get_exact_averages((2,2),beta=0)
+        self.assertAlmostEqual(0,mean_E)
+        self.assertAlmostEqual(4,mean_M2)
+        self.assertAlmostEqual(40,mean_M4)
+        mean_E,mean_M2,_ = get_exact_averages((2,2),periodic=False,beta=20)
+        self.assertAlmostEqual(-4,mean_E)
+        self.assertAlmostEqual(16,mean_M2)
+
     def test2b(self):
         Expected   = {  # From Table 5.2
             -4:2,
@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+
+#   Copyright (C) 2025 Simon Crase
+
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+    Equation of state for hard disks and spheres. Walk through a list of densities, starting each
+    from the final configuration at the previous density, and estimate the pressure at each density,
+    either from the contact value of the pair correlation function, or from the lifts of event chains.
+    Neither estimator includes the force exerted by the walls of a box, so event chains are only allowed
+    with periodic boundary conditions, and a warning is given if the contact value is used in a box.
+    Results are stored in a database indexed by density, so an interrupted sweep resumes from the
+    first density that has not been completed. Densities are divided into segments, which are
+    processed in parallel.
+'''
+
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from os.path import basename, join, splitext
+from tempfile import TemporaryDirectory
+from time import time
+from unittest import TestCase, main
+from warnings import catch_warnings, simplefilter, warn
+import sqlite3
+import numpy as np
+from event_chain import EventChain
+from geometry import Geometry, GeometryFactory, PairCorrelation
+from ising_db import ContextManager, IsingDatabase
+from lattice import Lattice
+from markov_disks import markov_disks, checkerboard_sweep, StepSizeController
+
+class EosDatabase:
+    '''
+    This class stores the pressure, and the final configuration, for each density.
+    Each record is indexed by packing fraction, number of disks, boundary conditions, and algorithm,
+    and records which estimator was used for the pressure.
+    '''
+    def __init__(self, file = 'eos.db', table = 'eos'):
+        sqlite3.register_adapter(np.ndarray, IsingDatabase.adapt_array)
+        sqlite3.register_converter('array', IsingDatabase.convert_array)
+        base,_ = splitext(file)
+        self.file_name = f'{base}.db'
+        self.table = table
+        with ContextManager(self.file_name) as con:
+            con.execute(f'CREATE TABLE IF NOT EXISTS {self.table} '
+                        '(eta FLOAT NOT NULL, N INTEGER NOT NULL, periodic INTEGER NOT NULL, algorithm TEXT NOT NULL,'
+                        ' sweeps INTEGER, pressure FLOAT, error FLOAT, contact FLOAT, estimator TEXT, X array,'
+                        ' CONSTRAINT PK_eos PRIMARY KEY (eta,N,periodic,algorithm))')
+            if 'estimator' not in [row[1] for row in con.execute(f'PRAGMA table_info({self.table})')]:
+                con.execute(f'ALTER TABLE {self.table} ADD COLUMN estimator TEXT')   # Database predates estimator
+            con.commit()
+
+    @staticmethod
+    def get_key(eta, N, periodic, algorithm):
+        '''
+        Standardize key, so that densities calculated in different ways will match
+        '''
+        return round(float(eta), 9), int(N), int(periodic), algorithm
+
+    def __contains__(self, key):
+        with ContextManager(self.file_name) as con:
+            return con.execute(f'SELECT COUNT(*) FROM {self.table} WHERE eta=? AND N=? AND periodic=? AND algorithm=?',
+                               EosDatabase.get_key(*key)).fetchone()[0] > 0
+
+    def __getitem__(self, key):
+        '''
+        Retrieve results for one density
+
+        Parameters:
+            key     eta, N, periodic, algorithm
+
+        Returns:
+            sweeps, pressure, error, contact, estimator, X
+        '''
+        with ContextManager(self.file_name) as con:
+            for row in con.execute(f'SELECT sweeps, pressure, error, contact, estimator, X FROM {self.table} '
+                                   'WHERE eta=? AND N=? AND periodic=? AND algorithm=?', EosDatabase.get_key(*key)):
+                return row
+        raise KeyError(f'{key} not found')
+
+    def __setitem__(self, key, value):
+        '''
+        Store results for one density, replacing any earlier results
+
+        Parameters:
+            key     eta, N, periodic, algorithm
+            value   sweeps, pressure, error, contact, estimator, X
+        '''
+        sweeps,pressure,error,contact,estimator,X = value
+        with ContextManager(self.file_name) as con:
+            con.execute(f'INSERT OR REPLACE INTO {self.table} '
+                        '(eta, N, periodic, algorithm, sweeps, pressure, error, contact, estimator, X) '
+                        'VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        EosDatabase.get_key(*key) + (int(sweeps), float(pressure), float(error), float(contact), estimator, X))
+            con.commit()
+
+    def generate_keys(self, N = None, periodic = None, algorithm = None):
+        '''
+        Iterate through keys in database, in order of increasing density
+
+        Parameters:
+            N, periodic, algorithm   Used to select keys (None matches anything)
+        '''
+        with ContextManager(self.file_name) as con:
+            for eta,n,p,a in con.execute(f'SELECT eta, N, periodic, algorithm FROM {self.table} ORDER BY eta'):
+                if (N == None or n == N) and (periodic == None or bool(p) == periodic) and (algorithm == None or a == algorithm):
+                    yield eta,n,bool(p),a
+
+def sweep(X, geometry, rng = np.random.default_rng(), algorithm = 'markov', delta = np.array([0.01,0.01]), chain = None):
+    '''
+    Attempt to move each disk once (on average)
+
+    Parameters:
+        X          Centres of disks, updated in place
+        geometry   Box or Torus
+        rng        Random number generator
+        algorithm  markov, checkerboard, or event-chain
+        delta      Maximum displacement along each axis
+        chain      Used to run event chains
+
+    Returns:
+        Number of moves accepted, number of trials
+    '''
+    N,d = X.shape
+    match algorithm:
+        case 'checkerboard':
+            return checkerboard_sweep(X, rng = rng, delta = delta, geometry = geometry), N
+        case 'event-chain':
+            for i in range(N):
+                chain.run(X, rng = rng, coordinate = i % d)
+            return N, N
+    n_accepted = 0
+    for _ in range(N):
+        k,_ = markov_disks(X, rng = rng, delta = delta, geometry = geometry)
+        if k > -1:
+            n_accepted += 1
+    return n_accepted, N
+
+def get_clearance(X, geometry, sigma):
+    '''
+    Find the largest radius that disks could have without overlapping each other, or the walls of a box
+
+    Parameters:
+        X          Centres of disks
+        geometry   Box or Torus
+        sigma      Only separations less than 2*sigma are examined: return sigma if there are none
+    '''
+    _,_,_,r = geometry.get_neighbour_pairs(X, 2*sigma)
+    clearance = min(0.5*r.min(), sigma) if len(r) > 0 else sigma
+    if not geometry.periodic:
+        clearance = min(clearance, X.min(), (geometry.L - X).min())
+    return clearance
+
+def compress(X, geometry, eta = 0.5, rng = np.random.default_rng(), algorithm = 'markov', delta = np.array([0.01,0.01]),
+             max_sweeps = 10000):
+    '''
+    Adjust a configuration to a new density. Expanding is trivial, as disks just shrink.
+    To compress, disks are enlarged as far as they can be without overlapping, then moved using
+    Markov chain Monte Carlo to make room, until they reach the required size.
+
+    Parameters:
+        X           Valid configuration for the current radius, updated in place
+        geometry    Box or Torus: sigma is set to give the required density
+        eta         Required density
+        rng         Random number generator
+        algorithm   Used to move disks between stages
+        delta       Maximum displacement for Markov moves
+        max_sweeps  Number of sweeps allowed
+
+    Returns:
+        Number of sweeps used
+    '''
+    N,_ = X.shape
+    geometry.set_sigma(eta = eta, N = N)
+    target = geometry.sigma
+    for i in range(max_sweeps):
+        sigma = get_clearance(X, geometry, target)
+        geometry.set_sigma(eta = eta * (sigma*(1 - 1e-9)/target)**geometry.d, N = N)
+        if sigma >= target:
+            geometry.set_sigma(eta = eta, N = N)
+            return i
+        sweep(X, geometry, rng = rng, algorithm = 'checkerboard' if algorithm == 'checkerboard' else 'markov', delta = delta)
+    raise RuntimeError(f'Failed to compress {N} disks to eta={eta} in {max_sweeps} sweeps')
+
+def get_virial_pressure(contact, eta, d = 2):
+    '''
+    Pressure of hard spheres from the pair correlation function at contact: beta*P/rho = 1 + 2**(d-1) * eta * g(2*sigma)
+    '''
+    return 1 + 2**(d - 1) * eta * contact
+
+def run_point(X, geometry, eta = 0.5, rng = np.random.default_rng(), algorithm = 'markov', burn = 100, sweeps = 1000,
+              blocks = 10, target = 0.5, ell = None, n_bins = 20, width = 0.1):
+    '''
+    Estimate pressure at one density, either from the lifts of event chains, or from the contact value
+    of g(r). Neither includes the force exerted by walls, so event chains are rejected in a box, and the
+    contact value is used with a warning.
+
+    Parameters:
+        X          Starting configuration (e.g. from previous density), updated in place
+        geometry   Box or Torus
+        eta        Density
+        rng        Random number generator
+        algorithm  markov, checkerboard, or event-chain
+        burn       Number of sweeps before measurement starts, during which delta is adjusted
+        sweeps     Number of sweeps used for measurement
+        blocks     Number of blocks used to estimate error
+        target     Target acceptance rate used to adjust delta
+        ell        Length of event chains (default: twice the diameter)
+        n_bins     Number of bins for g(r) near contact
+        width      Width of range used for g(r), as a fraction of the diameter
+
+    Returns:
+        sweeps, pressure, error, contact, estimator: where pressure is beta*P/rho, contact is g(2*sigma),
+        and estimator is 'lifts' for event chains, 'contact' for the contact value with periodic boundary
+        conditions, or 'contact-box' for the contact value in a box, without any correction for the walls
+    '''
+    if not geometry.periodic:
+        if algorithm == 'event-chain':
+            raise ValueError('Pressure from event chains needs periodic boundary conditions')
+        warn('The contact value of g(r) gives the bulk pressure, with no correction for the walls of the box')
+    N,d = X.shape
+    delta = np.full((d), 0.5*geometry.sigma)
+    compress(X, geometry, eta = eta, rng = rng, algorithm = algorithm, delta = delta)
+    controller = StepSizeController(delta = delta, target = target, window = 10*N,
+                                    upper = 0.25*geometry.L - geometry.sigma if algorithm == 'checkerboard' else 0.5*geometry.L)
+    chain = EventChain(geometry, ell = 4*geometry.sigma if ell == None else ell) if algorithm == 'event-chain' else None
+    for _ in range(burn):
+        controller.record(*sweep(X, geometry, rng = rng, algorithm = algorithm, delta = controller.delta, chain = chain))
+    delta = controller.freeze()
+
+    use_chain = chain != None
+    g = PairCorrelation(cutoff = 2*geometry.sigma*(1 + width), n = n_bins, r0 = 2*geometry.sigma)
+    estimates = []
+    for block in range(blocks):
+        g_block = PairCorrelation(cutoff = g.cutoff, n = n_bins, r0 = g.histogram.x0)
+        if use_chain:
+            chain.n_chains,chain.lift_sum = 0,0.0
+        for _ in range(sweeps // blocks):
+            sweep(X, geometry, rng = rng, algorithm = algorithm, delta = delta, chain = chain)
+            g_block.add(geometry, X)
+        estimates.append(chain.get_pressure(N = N) * np.prod(geometry.L) / N if use_chain
+                         else get_virial_pressure(g_block.get_contact(geometry), eta, d = d))
+        g.histogram.merge(g_block.histogram)
+        g.n_samples += g_block.n_samples
+        g.N = N
+    contact = g.get_contact(geometry)
+    pressure = np.mean(estimates) if use_chain else get_virial_pressure(contact, eta, d = d)
+    estimator = 'lifts' if use_chain else 'contact' if geometry.periodic else 'contact-box'
+    return blocks * (sweeps // blocks), pressure, np.std(estimates, ddof = 1) / np.sqrt(blocks), contact, estimator
+
+def run_segment(task):
+    '''
+    Process a sequence of densities, each starting from the configuration for the previous density:
+    executed by worker processes. Densities that are already in the database are skipped, but their
+    configurations are used to start the next density.
+
+    Parameters:
+        task    A tuple comprising the densities, a seed for the random number generator, and a dictionary
+                of parameters: file, N, d, L, periodic, algorithm, lattice, and parameters for run_point
+
+    Returns:
+        Densities that were calculated
+    '''
+    etas,seed,parameters = task
+    parameters = dict(parameters)
+    database = EosDatabase(parameters.pop('file'))
+    N = parameters.pop('N')
+    d = parameters.pop('d')
+    L = parameters.pop('L')
+    periodic = parameters.pop('periodic')
+    lattice = parameters.pop('lattice')
+    verbose = parameters.pop('verbose')
+    rng = np.random.default_rng(seed)
+    geometry = GeometryFactory(periodic = periodic, L = L, d = d)
+    X = None
+    calculated = []
+    for eta in etas:
+        key = (eta, N, periodic, parameters['algorithm'])
+        if key in database:
+            X = database[key][-1]
+            geometry.set_sigma(eta = eta, N = N)
+            continue
+        if X is None:
+            X = geometry.create_configuration(N = N, lattice = lattice, eta = eta)
+        value = run_point(X, geometry, eta = eta, rng = rng, **parameters)
+        database[key] = value + (X.copy(),)
+        calculated.append(eta)
+        if verbose:
+            _,pressure,error,_,estimator = value
+            print (f'eta={eta:.4g}, beta*P/rho={pressure:.5g} +/- {error:.2g} ({estimator})')
+    return calculated
+
+def get_henderson(eta):
+    '''
+    Henderson's equation of state for hard disks, beta*P/rho = (1 + eta**2/8)/(1 - eta)**2
+    '''
+    return (1 + eta**2/8) / (1 - eta)**2
+
+def parse_arguments():
+    parser = ArgumentParser(description = __doc__)
+    parser.add_argument('--show', action = 'store_true', help   = 'Show plot')
+    parser.add_argument('--seed',type=int,default=None,help='Root seed for random number generators')
+    parser.add_argument('-o', '--out', default = basename(splitext(__file__)[0]),help='Name of output file (also used for database)')
+    parser.add_argument('--figs', default = './figs', help = 'Name of folder where plots are to be stored')
+    parser.add_argument('--eta', type = float, nargs = '+', default = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.65, 0.7],
+                        help = 'Densities, in the order in which they are to be visited')
+    parser.add_argument('--segments', type = int, default = 1, help = 'Number of segments that densities are divided into')
+    parser.add_argument('--processes', type = int, default = None, help = 'Number of processes (default: one for each core)')
+    parser.add_argument('--Disks', type = int, default = 64, help = 'Number of disks/spheres')
+    parser.add_argument('--d', type = int, choices = [2,3], default = 2, help = 'Number of dimensions for space')
+    parser.add_argument('--L', type = float, nargs = '+', default = [1], help = 'Length of each side of box (just one value for square/cube)')
+    parser.add_argument('--periodic', action = 'store_true', help = 'Use periodic boundary conditions')
+    parser.add_argument('--algorithm', default = 'markov', choices = ['markov', 'event-chain', 'checkerboard'],
+                        help = 'Algorithm 2.9, event-chain Monte Carlo, or Algorithm 2.9 applied to all disks in checkerboard sweeps')
+    parser.add_argument('--lattice', default = Lattice.FCC, choices = [Lattice.SC, Lattice.BCC, Lattice.FCC],
+                        help = 'Lattice for initial configuration (d=3 only)')
+    parser.add_argument('--burn', type = int, default = 100, help = 'Number of sweeps at each density before measurement')
+    parser.add_argument('--sweeps', type = int, default = 1000, help = 'Number of sweeps used for measurement at each density')
+    parser.add_argument('--blocks', type = int, default = 10, help = 'Number of blocks used to estimate errors')
+    parser.add_argument('--target', type = float, default = 0.5, help = 'Target acceptance rate')
+    parser.add_argument('--ell', type = float, default = None, help = 'Length of each chain for event-chain Monte Carlo')
+    return parser.parse_args()
+
+def get_file_name(name,default_ext='png',seq=None):
+    '''
+    Used to create file names
+
+    Parameters:
+        name          Basis for file name
+        default_ext   Extension if non specified
+        seq           Used if there are multiple files
+    '''
+    base,ext = splitext(name)
+    if len(ext) == 0:
+        ext = default_ext
+    if seq != None:
+        base = f'{base}{seq}'
+    qualified_name = f'{base}.{ext}'
+    if ext == 'png':
+        return join(args.figs,qualified_name)
+    else:
+        return qualified_name
+
+class TestEos(TestCase):
+    '''
+    Compare with Henderson's equation of state, and verify that an interrupted sweep resumes
+    '''
+    def test_sweep(self):
+        with TemporaryDirectory() as folder:
+            parameters = dict(file = join(folder, 'eos.db'), N = 64, d = 2, L = np.array([1.0,1.0]), periodic = True,
+                              lattice = None, verbose = False, algorithm = 'checkerboard', burn = 100, sweeps = 1000, blocks = 10)
+            self.assertEqual([0.2,0.4], run_segment(([0.2,0.4], 67, parameters)))
+            self.assertEqual([0.3], run_segment(([0.2,0.4,0.3], 71, parameters)))
+            database = EosDatabase(parameters['file'])
+            keys = list(database.generate_keys(N = 64))
+            self.assertEqual([0.2,0.3,0.4], [eta for eta,_,_,_ in keys])
+            for key in keys:
+                sweeps,pressure,error,contact,estimator,X = database[key]
+                self.assertEqual(1000, sweeps)
+                self.assertEqual('contact', estimator)
+                self.assertAlmostEqual(get_henderson(key[0]), pressure, delta = 0.1*get_henderson(key[0]))
+                self.assertEqual((64,2), X.shape)
+
+    def test_box(self):
+        '''
+        Verify that event chains are rejected in a box, and that the contact value is used with a warning
+        '''
+        with TemporaryDirectory() as folder:
+            parameters = dict(file = join(folder, 'eos.db'), N = 16, d = 2, L = np.array([1.0,1.0]), periodic = False,
+                              lattice = None, verbose = False, algorithm = 'event-chain', burn = 10, sweeps = 20, blocks = 2)
+            with self.assertRaises(ValueError):
+                run_segment(([0.2], 79, parameters))
+            parameters['algorithm'] = 'markov'
+            with catch_warnings(record = True) as warnings:
+                simplefilter('always')
+                self.assertEqual([0.2], run_segment(([0.2], 83, parameters)))
+            self.assertEqual(1, len(warnings))
+            database = EosDatabase(parameters['file'])
+            self.assertEqual('contact-box', database[(0.2, 16, False, 'markov')][4])
+
+    def test_compress(self):
+        geometry = GeometryFactory(periodic = False, L = np.array([1.0,1.0]), d = 2)
+        X = geometry.create_configuration(N = 50, eta = 0.2)
+        compress(X, geometry, eta = 0.5, rng = np.random.default_rng(73), delta = np.array([0.01,0.01]))
+        self.assertAlmostEqual(0.5, geometry.get_density(N = 50))
+        self.assertGreaterEqual(geometry.get_distances(X).min(), 2*geometry.sigma)
+        self.assertTrue(all(geometry.is_within_bounds(x) for x in X))
+
+if __name__=='__main__':
+    args = parse_arguments()
+    from matplotlib import rc
+    from matplotlib.pyplot import figure, show
+    start  = time()
+    database_file = get_file_name(args.out, default_ext = 'db')
+    parameters = dict(file = database_file, N = args.Disks, d = args.d, L = Geometry.create_L(args.L, args.d),
+                      periodic = args.periodic, lattice = args.lattice, verbose = True, algorithm = args.algorithm,
+                      burn = args.burn, sweeps = args.sweeps, blocks = args.blocks, target = args.target, ell = args.ell)
+    segments = [list(etas) for etas in np.array_split(args.eta, args.segments) if len(etas) > 0]
+    seeds = np.random.SeedSequence(args.seed).spawn(len(segments))
+    with Pool(args.processes) as pool:
+        for calculated in pool.imap_unordered(run_segment, [(etas, seed, parameters) for etas,seed in zip(segments,seeds)]):
+            print (f'Completed {len(calculated)} densities')
+
+    database = EosDatabase(database_file)
+    keys = list(database.generate_keys(N = args.Disks, periodic = args.periodic, algorithm = args.algorithm))
+    etas = np.array([eta for eta,_,_,_ in keys])
+    results = np.array([database[key][1:3] for key in keys])
+    rc('font',**{'family':'serif','serif':['Palatino']})
+    rc('text', usetex=True)
+    fig = figure(figsize=(12,12))
+    ax1 = fig.add_subplot(1,1,1)
+    ax1.errorbar(etas, results[:,0], yerr = results[:,1], fmt = 'o', color = 'blue', label = args.algorithm)
+    if args.d == 2:
+        eta = np.linspace(0, max(etas), 100)
+        ax1.plot(eta, get_henderson(eta), color = 'red', linestyle = 'dashed', label = 'Henderson')
+    ax1.set_title(fr'Equation of state: {args.Disks} spheres, d={args.d}, '
+                  + ('periodic boundary conditions' if args.periodic else 'box'))
+    ax1.set_xlabel(r'$\eta$')
+    ax1.set_ylabel(r'$\beta P/\rho$')
+    ax1.legend()
+    fig.savefig(get_file_name(args.out))
+
+    elapsed = time() - start
+    minutes = int(elapsed/60)
+    seconds = elapsed - 60*minutes
+    print (f'Elapsed Time {minutes} m {seconds:.2f} s')
+
+    if args.show:
+        show()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2025 Simon Crase
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+    Event-chain Monte Carlo for hard disks: a rejection free alternative to Algorithm 2.9.
+    One disk moves along a coordinate axis until it strikes another disk; the remainder
+    of the displacement is then handed on to the disk that was struck, and so on, until
+    the total displacement reaches a specified length.
+
+    With periodic boundary conditions, disks only ever move in the positive direction.
+    In a box, the direction is chosen at random for each chain, and a disk that reaches
+    a wall reverses direction, so each chain can be retraced by running it backwards.
+'''
+
+from unittest import TestCase, main
+import numpy as np
+from numpy.random import default_rng
+from geometry import GeometryFactory, Torus
+
+class EventChain:
+    '''
+    Run event chains, and accumulate the statistics needed to estimate pressure
+
+    Attributes:
+        geometry    Box or Torus in which disks move
+        ell         Total displacement for each chain
+        n_chains    Number of chains run so far
+        n_lifts     Number of times a displacement has been handed from one disk to another
+        lift_sum    Total distance along the chains between the centres of disks at each lift
+    '''
+    def __init__(self, geometry = GeometryFactory(), ell = 0.5):
+        '''
+        Parameters:
+            geometry    Box or Torus in which disks move
+            ell         Total displacement for each chain
+        '''
+        self.geometry = geometry
+        self.ell = ell
+        self.periodic = isinstance(geometry, Torus)
+        if self.periodic and any(geometry.L <= 4*geometry.sigma):
+            raise ValueError(f'Sides of torus {geometry.L} must exceed 4*sigma={4*geometry.sigma}')
+        self.n_chains = 0
+        self.n_lifts = 0
+        self.lift_sum = 0.0
+
+    def run(self, X, rng = default_rng(), coordinate = 0):
+        '''
+        Run one chain, starting from a randomly selected disk
+
+        Parameters:
+            X           Centres of disks: updated in place
+            rng         Random number generator
+            coordinate  Index of the axis along which disks are to move
+
+        Returns:
+            Number of lifts in this chain
+        '''
+        N,_ = X.shape
+        k = rng.integers(0, high = N)
+        direction = 1 if self.periodic else rng.choice([-1,1])
+        remaining = self.ell
+        n_lifts = 0
+        n_stalled = 0
+        while remaining > 0:
+            distance,j,along = self.get_next_collision(X, k, coordinate, direction)
+            wall = self.get_wall_distance(X[k,coordinate], coordinate, direction)
+            step = min(distance, wall, remaining)
+            X[k,coordinate] += direction * step
+            if self.periodic:
+                X[k,coordinate] %= self.geometry.L[coordinate]
+            remaining -= step
+            if remaining <= 0: break
+            if step == distance:
+                n_stalled = n_stalled + 1 if step == 0 else 0
+                if n_stalled > N: break       # Closed ring of touching disks, which cannot move along this axis
+                self.lift_sum += along
+                n_lifts += 1
+                k = j
+            elif step == wall and not self.periodic:
+                direction *= -1
+        self.n_chains += 1
+        self.n_lifts += n_lifts
+        self.geometry.index = None          # Any index used by markov_disks is now out of date
+        return n_lifts
+
+    def get_next_collision(self, X, k, coordinate, direction):
+        '''
+        Find the first disk that will be struck by a moving disk
+
+        Parameters:
+            X           Centres of disks
+            k           Index of disk that is moving
+            coordinate  Index of the axis along which disk is moving
+            direction   +1 or -1
+
+        Returns:
+            distance, j, along: the distance disk k can move before it strikes disk j,
+            and the separation of their centres along the axis when they touch.
+            distance is infinite if no disk is in the way.
+        '''
+        Delta = (self.geometry.diff_vec(X, X[k]) if self.periodic else X - X[k])
+        along = direction * Delta[:,coordinate]
+        perpendicular2 = (Delta**2).sum(axis = 1) - Delta[:,coordinate]**2
+        touching2 = 4*self.geometry.sigma**2 - perpendicular2
+        candidates = np.flatnonzero((touching2 > 0) & (along > 0))
+        candidates = candidates[candidates != k]
+        if len(candidates) == 0:
+            return float('inf'), -1, 0.0
+        separation = np.sqrt(touching2[candidates])
+        distances = np.maximum(along[candidates] - separation, 0)
+        i = np.argmin(distances)
+        return distances[i], candidates[i], separation[i]
+
+    def get_wall_distance(self, x, coordinate, direction):
+        '''
+        Find how far a disk can move before it reaches a wall. With periodic boundary conditions
+        there are no walls, but a disk is limited to half the side, less a diameter, so that no disk can
+        be missed by using the minimum image to find collisions.
+
+        Parameters:
+            x           Position of disk along axis
+            coordinate  Index of the axis along which disk is moving
+            direction   +1 or -1
+        '''
+        if self.periodic:
+            return 0.5*self.geometry.L[coordinate] - 2*self.geometry.sigma
+        if direction > 0:
+            return max(self.geometry.UpperBound[coordinate] - x, 0)
+        else:
+            return max(x - self.geometry.LowerBound[coordinate], 0)
+
+    def get_pressure(self, N = 4):
+        '''
+        Estimate pressure from the lifts: beta*P*V/N = 1 + <sum of separations at lifts>/ell.
+        This estimator is only valid with periodic boundary conditions.
+
+        Parameters:
+            N      Number of disks
+
+        Returns:
+            beta*P, or NaN if the estimate is not available
+        '''
+        if not self.periodic or self.n_chains == 0:
+            return float('nan')
+        return (1 + self.lift_sum / (self.n_chains * self.ell)) * N / np.prod(self.geometry.L)
+
+class TestEventChain(TestCase):
+    '''
+    Tests for EventChain
+    '''
+    def test_lift(self):
+        geometry = GeometryFactory(periodic = False, L = np.array([1,1]), sigma = 0.1, d = 2)
+        chain = EventChain(geometry, ell = 0.3)
+        X = np.array([[0.2,0.5], [0.5,0.5]])
+        distance,j,along = chain.get_next_collision(X, 0, 0, 1)
+        self.assertAlmostEqual(0.1, distance)
+        self.assertEqual(1, j)
+        self.assertAlmostEqual(0.2, along)
+        self.assertEqual(float('inf'), chain.get_next_collision(X, 0, 0, -1)[0])
+
+    def test_conserves_validity(self):
+        for periodic in [False,True]:
+            geometry = GeometryFactory(periodic = periodic, L = np.array([1,1]), sigma = 0.08, d = 2)
+            X = geometry.create_configuration(N = 30)
+            chain = EventChain(geometry, ell = 0.4)
+            rng = default_rng(3)
+            for i in range(200):
+                chain.run(X, rng = rng, coordinate = i % 2)
+            k,l = np.triu_indices(len(X), k = 1)
+            distances = [geometry.get_distance(X[i],X[j]) for i,j in zip(k,l)]
+            self.assertGreaterEqual(min(distances), 2*geometry.sigma*(1 - 1e-9))
+            for x in X:
+                self.assertTrue(geometry.is_within_bounds(x))
+            self.assertGreater(chain.n_lifts, 0)
+
+    def test_pressure_dilute(self):
+        geometry = GeometryFactory(periodic = True, L = np.array([1,1]), sigma = 0.01, d = 2)
+        X = geometry.create_configuration(N = 16)
+        chain = EventChain(geometry, ell = 0.2)
+        rng = default_rng(5)
+        for i in range(2000):
+            chain.run(X, rng = rng, coordinate = i % 2)
+        self.assertAlmostEqual(1.0, chain.get_pressure(N = 16) / 16, delta = 0.05)
+
+    def test_pressure_dense(self):
+        '''
+        Compare with Henderson's equation of state, beta*P/rho = (1 + eta**2/8)/(1 - eta)**2
+        '''
+        geometry = GeometryFactory(periodic = True, L = np.array([1,1]), d = 2)
+        N = 36
+        eta = 0.3
+        geometry.set_sigma(eta = eta, N = N)
+        X = geometry.create_configuration(N = N)
+        chain = EventChain(geometry, ell = 0.3)
+        rng = default_rng(11)
+        for i in range(2000):
+            chain.run(X, rng = rng, coordinate = i % 2)
+        chain.n_chains,chain.lift_sum = 0,0.0
+        for i in range(6000):
+            chain.run(X, rng = rng, coordinate = i % 2)
+        self.assertAlmostEqual((1 + eta**2/8)/(1 - eta)**2, chain.get_pressure(N = N) / N, delta = 0.15)
+
+if __name__=='__main__':
+    main()
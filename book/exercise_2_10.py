@@ -101,11 +101,7 @@ if __name__=='__main__':
     for i in range(args.N):
         configuration = geometry.direct_disks(N=args.Disks,NTrials=args.NTrials)
         x_coordinates[i,:] = configuration[:,0]
-        l = 0
-        for j in range(args.Disks):
-            for k in range(j):
-                distances[i,l] = geometry.get_distance(configuration[j,:], configuration[k,:])
-                l += 1
+        distances[i,:] = geometry.get_distances(configuration)
     hist,bin_edges = np.histogram( np.reshape(x_coordinates, args.N*args.Disks), bins = args.bins, density = True)
 
 
@@ -115,11 +111,7 @@ if __name__=='__main__':
     n_accepted = 0
     for i in range(1,args.N):
         k,X[i,:,:] = markov_disks(X[i-1,:,:], rng = rng, delta = args.delta, geometry = geometry)
-        l = 0
-        for j in range(args.Disks):
-            for kk in range(j):
-                distances_markov[i-1,l] = geometry.get_distance(X[i,j,:], X[i,kk,:])
-                l += 1
+        distances_markov[i-1,:] = geometry.get_distances(X[i,:,:])
         if k > -1:
             n_accepted += 1
         if i%args.frequency ==0:
@@ -29,7 +29,12 @@ from time import time
 import numpy as np
 from matplotlib import rc
 from matplotlib.pyplot import figure, show
-from md import create_config, get_next_pair, get_next_wall, collide_pair, get_L, Collision
+from geometry import Histogram
+from md import create_config, get_L, EventCalendar
+from lattice import Lattice
+from md_ensemble import Ensemble
+from trajectory import TrajectoryRecorder
+from checkpoint import Checkpointer
 from smacfiletoken import Registry
 
 def parse_arguments():
@@ -49,6 +54,17 @@ def parse_arguments():
     parser.add_argument('--DeltaT', type = float, default = 1.0, help = 'For sampling')
     parser.add_argument('--bins', default='sqrt', type=get_bins, help = 'Binning strategy or number of bins')
     parser.add_argument('--restart', default = None, help  = 'Restart from checkpoint')
+    parser.add_argument('--cells', action = 'store_true', help = 'Use cell lists to find neighbours')
+    parser.add_argument('--periodic', action = 'store_true', help = 'Use periodic boundary conditions')
+    parser.add_argument('--strategy', default = 'tabula-rasa', choices = ['tabula-rasa', 'lattice', 'rsa', 'compress'],
+                        help = 'Strategy used to create initial configuration')
+    parser.add_argument('--lattice', default = None, choices = [Lattice.SC, Lattice.HEX, Lattice.BCC, Lattice.FCC],
+                        help = 'Lattice used by lattice strategy')
+    parser.add_argument('--folder', default = 'configs', help = 'Folder to store checkpoints')
+    parser.add_argument('--retention', type = int, default = 3, help = 'Number of checkpoints to be retained')
+    parser.add_argument('--interval', type = float, default = None, help = 'Time between checkpoints (seconds)')
+    parser.add_argument('--every', type = int, default = None, help = 'Number of collisions between checkpoints')
+    parser.add_argument('--replicas', type = int, default = 1, help = 'Number of independent replicas to be run together')
     return parser.parse_args()
 
 def get_bins(bins):
@@ -98,85 +114,91 @@ if __name__=='__main__':
         sigma = args.sigma
         M = args.M
         DeltaT = args.DeltaT
-        Xs,Vs = create_config(n = n, d = d, L = L, sigma = sigma, rng = rng, M = M)
-        bins = get_bins(args.bins)
-        binsv = get_bins(args.bins)
-        binsvx = get_bins(args.bins)
+        periodic = args.periodic
+        if args.replicas > 1:
+            ensemble = Ensemble.create(R = args.replicas, n = n, d = d, L = L, sigma = sigma, rng = rng, M = M,
+                                       strategy = args.strategy, lattice = args.lattice)
+            Xs,Vs = ensemble.Xs,ensemble.Vs
+        else:
+            Xs,Vs = create_config(n = n, d = d, L = L, sigma = sigma, rng = rng, M = M,
+                                  strategy = args.strategy, lattice = args.lattice)
+        V_max = np.sqrt((Vs**2).sum())    # Kinetic energy is conserved, so no disk can exceed this speed
+        n_samples = args.N * (Xs.size // d)
+        histogram_x = Histogram.create(bins = args.bins, x0 = 0, xn = L[0], n_samples = n_samples)
+        histogram_vx = Histogram.create(bins = args.bins, x0 = -V_max, xn = V_max, n_samples = n_samples)
+        histogram_v = Histogram.create(bins = args.bins, x0 = 0, xn = V_max, n_samples = n_samples)
     else:
         with np.load(args.restart) as  npzfile:
             Xs = npzfile['Xs']
             Vs = npzfile['Vs']
-            counts = npzfile['counts']
-            bins =  npzfile['bins']
-            countsv = npzfile['countsv']
-            binsv =  npzfile['binsv']
-            countsvx = npzfile['countsvx']
-            binsvx =  npzfile['binsvx']
+            if 'X_h' in npzfile:
+                histogram_x = Histogram.load(npzfile, 'X', expand = True)
+                histogram_vx = Histogram.load(npzfile, 'Vx', expand = True)
+                histogram_v = Histogram.load(npzfile, 'V', expand = True)
+            else:
+                histogram_x = Histogram(n = len(npzfile['counts']), x0 = npzfile['bins'][0], xn = npzfile['bins'][-1],
+                                        h = npzfile['counts'].copy(), expand = True)
+                histogram_vx = Histogram(n = len(npzfile['countsvx']), x0 = npzfile['binsvx'][0], xn = npzfile['binsvx'][-1],
+                                         h = npzfile['countsvx'].copy(), expand = True)
+                histogram_v = Histogram(n = len(npzfile['countsv']), x0 = npzfile['binsv'][0], xn = npzfile['binsv'][-1],
+                                        h = npzfile['countsv'].copy(), expand = True)
             L = npzfile['L']
             sigma = float(npzfile['sigma'])
             DeltaT = float(npzfile['DeltaT'])
-            _,d = Xs.shape
+            periodic = bool(npzfile['periodic']) if 'periodic' in npzfile else False
+            d = Xs.shape[-1]
 
-    T = np.zeros((3)) # times to next wall collision, next pair colliion, and next sample time
-    X_all_disks = np.zeros((args.N,args.n))
-    Vx_all_disks = np.zeros((args.N,args.n))
-    V_all_disks = np.zeros((args.N,args.n))
+    if Xs.ndim == 3:
+        if periodic:
+            raise ValueError('Replicas are not supported with periodic boundary conditions')
+        ensemble = Ensemble(Xs, Vs, sigma = sigma, L = L)
+    else:
+        calendar = EventCalendar(Xs, Vs, sigma = sigma, d = d, L = L, cells = args.cells, periodic = periodic)
+    m_disks = Xs.size // d
+    trajectory_file = get_file_name(args.out,default_ext='traj')
+    recorder = TrajectoryRecorder(trajectory_file, shape = (3,m_disks), fields = ('X','Vx','V'),
+                                  append = args.restart != None)
+    sample = np.empty((3,m_disks))
+    checkpointer = (Checkpointer(file_patterns = f'{basename(args.out)}_.npz', folder = args.folder, retention = args.retention,
+                                 interval = args.interval, every = args.every)
+                    if args.interval != None or args.every != None else None)
+    n_collisions = np.zeros((2), dtype = np.int64)
     for i in range(args.N):
         if registry.is_kill_token_present():
-            X_all_disks = X_all_disks[0:i,:]
-            V_all_disks = V_all_disks[0:i,:]
-            Vx_all_disks = Vx_all_disks[0:i,:]
             break
 
         t = args.DeltaT * i
         if i%args.freq == 0:
             print (f'Epoch={i:,},t={t}')
-        T[Collision.SAMPLE] = args.DeltaT + t
-        sampled = False
+        t_sample = args.DeltaT + t
         # Iterate through a sequence of collisions until
         # we reach a time step so we can sample
-        while not sampled:
-            dt_wall,wall,j = get_next_wall(Xs, Vs, sigma = args.sigma, d = args.d, L = L)
-            dt_pair, k, l = get_next_pair(Xs,Vs,sigma=args.sigma)
-            T[Collision.WALL] = t + dt_wall
-            T[Collision.PAIR] = t + dt_pair
-            match np.argmin(T):
-                case Collision.WALL:
-                    Xs += dt_wall * Vs
-                    Vs[j][wall] = - Vs[j][wall]
-                    t += dt_wall
-                case Collision.PAIR:
-                    Xs += dt_pair * Vs
-                    Vs[k], Vs[l] = collide_pair(Xs[k], Xs[l], Vs[k], Vs[l])
-                    t += dt_pair
-                case Collision.SAMPLE:
-                    dt = (T[2] - t)
-                    Xs += dt * Vs
-                    X_all_disks[i,:] = Xs[:,0]
-                    _,m_disks = V_all_disks.shape
-                    for j in range(m_disks):
-                        Vx_all_disks[i,j] = Vs[j,0]
-                        V_all_disks[i,j] = np.sqrt(sum([Vs[j,k]**2 for k in range(d)]))
-                    sampled = True
-
-    n,bins = np.histogram(X_all_disks,bins=bins)
-    if args.restart == None:
-        counts = n
-    else:
-        counts += n
-
-    nvx,binsvx = np.histogram(Vx_all_disks,bins=binsvx)
-
-    if args.restart == None:
-        countsvx = nvx
-    else:
-        countsvx += nvx
-
-    nv,binsv = np.histogram(V_all_disks,bins=binsv)
-    if args.restart == None:
-        countsv = nv
-    else:
-        countsv += nv
+        if Xs.ndim == 3:
+            ensemble.advance(t_sample)
+            n_collisions = ensemble.n_collisions.sum(axis = 0)
+            if checkpointer != None and checkpointer.is_due(n_collisions.sum()):
+                checkpointer.save(n_collisions.sum(), epoch = n_collisions.sum(), Xs = Xs, Vs = Vs, n_collisions = n_collisions,
+                                  d = d, L = L, sigma = sigma, periodic = periodic)
+        else:
+            while calendar.peek() < t_sample:
+                kind,_,_,_ = calendar.next_event()
+                n_collisions[kind] += 1
+                if checkpointer != None and checkpointer.is_due(n_collisions.sum()):
+                    calendar.synchronize()
+                    checkpointer.save(n_collisions.sum(), epoch = n_collisions.sum(), Xs = Xs, Vs = Vs, n_collisions = n_collisions,
+                                      d = d, L = L, sigma = sigma, periodic = periodic)
+            calendar.synchronize(t_sample)
+        sample[0,:] = Xs[...,0].ravel()
+        sample[1,:] = Vs[...,0].ravel()
+        sample[2,:] = np.linalg.norm(Vs, axis = -1).ravel()
+        recorder.append(sample)
+        histogram_x.add_many(sample[0])
+        histogram_vx.add_many(sample[1])
+        histogram_v.add_many(sample[2])
+
+    recorder.close()
+    if checkpointer != None:
+        checkpointer.close()
 
     save_file = get_file_name(args.out,default_ext='npz')
     if exists(save_file):
@@ -184,9 +206,13 @@ if __name__=='__main__':
         replace(save_file,backup_file)
 
     np.savez(save_file,
-             Xs=Xs,Vs=Vs,counts=counts,bins=bins,countsvx=countsvx,binsvx=binsvx,countsv=countsv,binsv=binsv,L=L,sigma=sigma,DeltaT=DeltaT)
+             Xs=Xs,Vs=Vs,L=L,sigma=sigma,DeltaT=DeltaT,periodic=periodic,
+             **histogram_x.save('X'),**histogram_vx.save('Vx'),**histogram_v.save('V'))
 
-    Disks,_ = Xs.shape
+    Disks = m_disks
+    counts,bins = histogram_x.h,histogram_x.get_edges()
+    countsvx,binsvx = histogram_vx.h,histogram_vx.get_edges()
+    countsv,binsv = histogram_v.h,histogram_v.get_edges()
 
     fig1 = figure(figsize=(12,12))
     fig1.suptitle(fr'{args.n} Disks, '
@@ -195,8 +221,9 @@ if __name__=='__main__':
 
     ax1 = fig1.add_subplot(1,1,1)
     ax1.plot(0.5*(bins[0:-1]+bins[1:]),counts/counts.sum())
-    ax1.axvline(x=args.sigma,color='red',linestyle='dashed')
-    ax1.axvline(x=L[0]-args.sigma,color='red',linestyle='dashed')
+    if not periodic:
+        ax1.axvline(x=args.sigma,color='red',linestyle='dashed')
+        ax1.axvline(x=L[0]-args.sigma,color='red',linestyle='dashed')
     ax1.set_xlabel('X')
     ax1.set_ylabel('Frequency')
     ax1.set_title('Positions')
@@ -38,6 +38,7 @@ def parse_arguments():
     parser.add_argument('--figs', default = './figs', help = 'Name of folder where plots are to be stored')
     parser.add_argument('--N', type = int, default = 10000, help='Number of configurations to be tried')
     parser.add_argument('--NTrials', type = int, default = maxsize, help='Number of attempts to create configuration')
+    parser.add_argument('--batch', type = int, default = 256, help='Number of configurations to be proposed at once')
     parser.add_argument('--Disks', type = int, default = 4, help='Number of disks in each configuration')
     parser.add_argument('--sigma', type = float,  nargs   = '+',  default = [0.125],  help='Radius of a disk')
     parser.add_argument('--d', type = int, default =2,  help='Dimensionality of space')
@@ -83,10 +84,8 @@ if __name__=='__main__':
                                        d = args.d)
             eta = geometry.get_density(N = args.Disks)
             print (f'sigma = {sigma}, eta = {eta:.3}')
-            x_coordinates = np.empty((args.N,args.Disks))
-            for j in range(args.N):
-                configuration = geometry.direct_disks(N=args.Disks,NTrials=args.NTrials)
-                x_coordinates[j,:] = configuration[:,0]
+            configurations = geometry.direct_disks_many(M=args.N,N=args.Disks,NTrials=args.NTrials,rng=rng,K=args.batch)
+            x_coordinates = configurations[:,:,0]
             hist,bin_edges = np.histogram( np.reshape(x_coordinates, args.N*args.Disks), bins = args.bins, density = True)
             actual_bins = [0.5*(bin_edges[i] + bin_edges[i+1]) for i in range(len(bin_edges)-1)]
             ax1 = fig.add_subplot(m,n,i+1)
@@ -49,6 +49,7 @@ def parse_arguments():
     parser.add_argument('--figs', default = './figs', help = 'Name of folder where plots are to be stored')
     parser.add_argument('--N', type = int, default = 100000, help='Number of configurations to be tried')
     parser.add_argument('--NTrials', type = int, default = maxsize, help='Number of attempts to create configuration')
+    parser.add_argument('--batch', type = int, default = 256, help='Number of configurations to be proposed at once')
     parser.add_argument('--Disks', type = int, default = 2, help='Number of disks in each configuration')
     parser.add_argument('--sigma', type = float,  default = 0.251,  help='Radius of a disk')
     parser.add_argument('--d', type = int, default =2,  help='Dimensionality of space')
@@ -90,12 +91,9 @@ if __name__=='__main__':
     geometry = GeometryFactory(periodic=True,L=get_L(args.L, args.d),sigma = args.sigma,d = args.d)
     eta = geometry.get_density(N = args.Disks)
     print (f'sigma = {args.sigma}, eta = {eta:.3}')
-    x_coordinates = np.empty((args.N,args.Disks))
-    distances = np.empty((args.N))
-    for j in range(args.N):
-        configuration = geometry.direct_disks(N=args.Disks,NTrials=args.NTrials)
-        x_coordinates[j,:] = configuration[:,0]
-        distances[j] = geometry.get_distance(configuration[0,:], configuration[1,:])
+    configurations = geometry.direct_disks_many(M=args.N,N=args.Disks,NTrials=args.NTrials,rng=rng,K=args.batch)
+    x_coordinates = configurations[:,:,0]
+    distances = geometry.get_distances(configurations[:,0:2,:])[:,0]
     hist,bin_edges = np.histogram( np.reshape(x_coordinates, args.N*args.Disks), bins = args.bins, density = True)
     actual_bins = [0.5*(bin_edges[i] + bin_edges[i+1]) for i in range(len(bin_edges)-1)]
 
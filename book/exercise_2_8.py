@@ -27,8 +27,10 @@ from time import time
 import numpy as np
 from matplotlib import rc
 from matplotlib.pyplot import figure, show
-from markov_disks import markov_disks
-from geometry import Geometry, GeometryFactory
+from markov_disks import markov_disks, checkerboard_sweep, StepSizeController
+from event_chain import EventChain
+from lattice import Lattice
+from geometry import Geometry, GeometryFactory, Histogram, Structure
 from smacfiletoken import Registry
 
 def parse_arguments():
@@ -47,7 +49,18 @@ def parse_arguments():
     parser.add_argument('--burn', type = int, default = 0, help = 'Used to skip over early steps without accumulating stats')
     parser.add_argument('--frequency', type = int, default = 1000,  help  = 'For reporting progress')
     parser.add_argument('--restart', default = None, help  = 'Restart from checkpoint')
+    parser.add_argument('--algorithm', default = 'markov', choices = ['markov', 'event-chain', 'checkerboard'],
+                        help = 'Algorithm 2.9, event-chain Monte Carlo, or Algorithm 2.9 applied to all disks in checkerboard sweeps')
+    parser.add_argument('--ell', type = float, default = 0.5, help = 'Length of each chain for event-chain Monte Carlo')
+    parser.add_argument('--periodic', action = 'store_true', help = 'Use periodic boundary conditions')
     parser.add_argument('--eta', type = float, default = None, help = 'Used to specify density (override sigma)')
+    parser.add_argument('--lattice', default = Lattice.FCC, choices = [Lattice.SC, Lattice.BCC, Lattice.FCC],
+                        help = 'Lattice for initial configuration (d=3 only)')
+    parser.add_argument('--adapt', action = 'store_true', help = 'Adjust delta during burn in, to approach target acceptance rate')
+    parser.add_argument('--target', type = float, default = 0.5, help = 'Target acceptance rate for --adapt')
+    parser.add_argument('--window', type = int, default = 100, help = 'Number of trials between adjustments for --adapt')
+    parser.add_argument('--cutoff', type = float, default = None, help = 'Accumulate g(r) and psi_6 for separations up to cutoff (multiple of sigma)')
+    parser.add_argument('--every', type = int, default = 100, help = 'Number of iterations between updates of g(r) and psi_6')
     return parser.parse_args()
 
 def get_bins(bins):
@@ -91,45 +104,77 @@ if __name__=='__main__':
         Disks = args.Disks
         delta = np.array(args.delta if len(args.delta)==args.d else args.delta * args.d)
         L = Geometry.create_L(args.L,args.d)
-        geometry = GeometryFactory(L = L, sigma = args.sigma, d = args.d)
+        periodic = args.periodic
+        geometry = GeometryFactory(periodic = periodic, L = L, sigma = args.sigma, d = args.d)
         if args.eta != None:
             geometry.set_sigma(eta = args.eta, N = Disks)
-        X = geometry.create_configuration(N = Disks)
-        bins = get_bins(args.bins)
+        X = geometry.create_configuration(N = Disks, lattice = args.lattice)
+        histogram = Histogram.create(bins = args.bins, x0 = 0, xn = L[0], n_samples = args.N * Disks)
+        delta_trace = []
+        if args.cutoff != None:
+            geometry.create_structure(cutoff = args.cutoff * geometry.sigma, n = args.bins if isinstance(args.bins,int) else 50,
+                                      every = args.every)
     else:
         npzfile = np.load(args.restart)
         X = npzfile['X']
-        counts = npzfile['counts']
-        bins =  npzfile['bins']
+        if 'X_h' in npzfile:
+            histogram = Histogram.load(npzfile, 'X', expand = True)
+        else:
+            histogram = Histogram(n = len(npzfile['counts']), x0 = npzfile['bins'][0], xn = npzfile['bins'][-1],
+                                  h = npzfile['counts'].copy(), expand = True)
         L = npzfile['L']
         sigma = float(npzfile['sigma'])
         delta = npzfile['delta']
+        delta_trace = npzfile['delta_trace'] if 'delta_trace' in npzfile else []
+        periodic = bool(npzfile['periodic']) if 'periodic' in npzfile else False
         Disks,d = X.shape
-        geometry = GeometryFactory(L = L, sigma = sigma, d = d)
+        geometry = GeometryFactory(periodic = periodic, L = L, sigma = sigma, d = d)
+        geometry.structure = Structure.load(npzfile, d = d)
 
     eta = geometry.get_density(N = Disks)
     n_accepted = 0
-    X_all_disks = np.empty((args.N,Disks))
-
-    for _ in range(args.burn):
-        _,X = markov_disks(X, rng = rng, delta = delta, geometry = geometry)
+    chain = EventChain(geometry, ell = args.ell) if args.algorithm == 'event-chain' else None
+    controller = StepSizeController(delta = delta, target = args.target, window = args.window,
+                                    upper = 0.25*L - geometry.sigma if args.algorithm == 'checkerboard' else 0.5*L,
+                                    trace = delta_trace)
+
+    for epoch in range(args.burn):
+        if args.algorithm == 'checkerboard':
+            n = checkerboard_sweep(X, rng = rng, delta = controller.delta, geometry = geometry)
+            if args.adapt:
+                controller.record(n, n_trials = Disks)
+        elif chain == None:
+            k,X = markov_disks(X, rng = rng, delta = controller.delta, geometry = geometry)
+            if args.adapt:
+                controller.record(1 if k > -1 else 0)
+        else:
+            chain.run(X, rng = rng, coordinate = epoch % geometry.d)
+    delta = controller.freeze()
+    if args.adapt and chain == None:
+        print (f'delta={delta}')
+    if chain != None:
+        chain = EventChain(geometry, ell = args.ell)     # Discard statistics from burn in
     for epoch in range(args.N):
         if registry.is_kill_token_present():
-            X_all_disks = X_all_disks[0:epoch,:]
             break
-        k,X = markov_disks(X, rng = rng, delta = delta, geometry = geometry)
-        X_all_disks[epoch,:] = X[:,0]
-        if k >- 1:
+        if args.algorithm == 'checkerboard':
+            n_accepted += checkerboard_sweep(X, rng = rng, delta = delta, geometry = geometry)
+        elif chain == None:
+            k,X = markov_disks(X, rng = rng, delta = delta, geometry = geometry)
+            if k >- 1:
+                n_accepted += 1
+        else:
+            chain.run(X, rng = rng, coordinate = epoch % geometry.d)
             n_accepted += 1
+        histogram.add_many(X[:,0])
+        if geometry.structure != None:
+            geometry.structure.update(geometry, X, step = epoch)
 
         if epoch%args.frequency ==0:
             print (f'Epoch {epoch:,} Accepted: {n_accepted:,}')
 
-    n,bins = np.histogram(X_all_disks,bins=bins)
-    if args.restart == None:
-        counts = n
-    else:
-        counts += n
+    if chain != None and periodic:
+        print (f'Pressure: beta*P={chain.get_pressure(N = Disks):.6g}, beta*P/rho={chain.get_pressure(N = Disks)*np.prod(L)/Disks:.6g}')
 
     save_file = get_file_name(args.out,default_ext='npz')
     if exists(save_file):
@@ -137,23 +182,48 @@ if __name__=='__main__':
         replace(save_file,backup_file)
 
     np.savez(save_file,
-             X=X,counts=counts,bins=bins,L=L,sigma=geometry.sigma,delta=delta)
+             X=X,L=L,sigma=geometry.sigma,delta=delta,periodic=periodic,delta_trace=controller.get_trace(),**histogram.save('X'),
+             **(geometry.structure.save() if geometry.structure != None else {}))
+    counts,bins = histogram.h,histogram.get_edges()
 
     fig = figure(figsize=(12,12))
 
-    ax1 = fig.add_subplot(1,1,1)
+    ax1 = fig.add_subplot(2 if geometry.structure != None else 1,1,1)
     ax1.plot(0.5*(bins[0:-1]+bins[1:]),counts/counts.sum(),color='blue')
+    if args.algorithm == 'checkerboard':
+        details = (fr'$\delta=${max(delta):.2g}, checkerboard sweeps, '
+                   fr'acceptance = {100*n_accepted/(args.N*Disks):.3g}%')
+    elif chain == None:
+        details = (fr'$\delta=${max(delta):.2g}, '
+                   fr'acceptance = {100*n_accepted/(args.N-args.burn):.3g}%')
+    else:
+        details = fr'event chains, $\ell=${args.ell:.2g}'
+        if periodic:
+            details += fr', $\beta P/\rho=${chain.get_pressure(N = Disks)*np.prod(L)/Disks:.4g}'
     ax1.set_title(fr'{Disks} Disks {geometry.get_description()}: '
                   fr'{counts.sum()//Disks:,} iterations, '
                   fr'$\sigma=${geometry.sigma:.3g}, '
                   fr'$\eta=${eta:.3g}, '
-                  fr'$\delta=${max(args.delta):.2g}, '
-                fr'acceptance = {100*n_accepted/(args.N-args.burn):.3g}%')
-    ax1.axvline(x=geometry.sigma,color='red',linestyle='dashed')
-    ax1.axvline(x=L[0]-geometry.sigma,color='red',linestyle='dashed')
+                  + details)
+    if not periodic:
+        ax1.axvline(x=geometry.sigma,color='red',linestyle='dashed')
+        ax1.axvline(x=L[0]-geometry.sigma,color='red',linestyle='dashed')
     ax1.set_xlabel('X')
     ax1.set_ylabel('Frequency')
 
+    if geometry.structure != None:
+        r,g = geometry.structure.g.get_g(geometry)
+        ax2 = fig.add_subplot(2,1,2)
+        ax2.plot(r/(2*geometry.sigma), g, color = 'blue')
+        title = fr'Pair correlation from {geometry.structure.g.n_samples:,} configurations'
+        if geometry.structure.psi != None and geometry.structure.psi.sums[0] > 0:
+            mean,variance = geometry.structure.psi.get_mean()
+            print (f'|Psi_6|={mean:.4g}, variance={variance:.4g}')
+            title += fr', $|\Psi_6|=${mean:.3g}'
+        ax2.set_title(title)
+        ax2.set_xlabel(r'$r/2\sigma$')
+        ax2.set_ylabel('g(r)')
+
     fig.savefig(get_file_name(args.out))
 
     elapsed = time() - start
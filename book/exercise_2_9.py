@@ -25,6 +25,7 @@ from time import time
 import numpy as np
 from matplotlib import rc
 from matplotlib.pyplot import figure, show
+from geometry import GeometryFactory
 
 def parse_arguments():
    '''Parse command line arguments'''
@@ -35,6 +36,7 @@ def parse_arguments():
    parser.add_argument('--show', action = 'store_true', help   = 'Show plot')
    parser.add_argument('-M','--M', type=int, default=1000000,help='Number of iterations')
    parser.add_argument('-N','--N', type=int, default=16,help='Number of spheres')
+   parser.add_argument('--batch', type=int, default=4096,help='Number of configurations to be generated at once')
    parser.add_argument('--bins', default='sqrt', type=get_bins, help = 'Binning strategy or number of bins')
    parser.add_argument('--L', type = float, nargs   = '+', default = [1,1], help='Lengths of walls')
    return parser.parse_args()
@@ -61,7 +63,7 @@ def get_file_name(name,default_ext='png',seq=None):
       return qualified_name
 
 
-def direct_disks_any(N,L=np.array([1,1]), rng = np.random.default_rng()):
+def direct_disks_any(N,L=np.array([1,1]), rng = np.random.default_rng(), K = None):
    '''
    Algorithm 2-8: compute the acceptance rate of Algorithm 2-7,
    direct-disks, in a rectangular box.
@@ -70,21 +72,11 @@ def direct_disks_any(N,L=np.array([1,1]), rng = np.random.default_rng()):
       N         Number of disks
       L         Array of lenghts of sides for box
       rng       Random number generator
+      K         Number of configurations to be generated at once: if specified,
+                an array of K densities is returned
    '''
-   def get_sigma2(pts):
-      '''
-      Get minimum distance between points
-
-      Parameters:
-          pts    The array of points
-      '''
-      sigma2 = float('inf')
-      for i in range(N):
-         for j in range(i+1,N):
-            sigma2 = min(sigma2,np.linalg.norm(pts[i,:]-pts[j,:]))
-      return sigma2
-
-   sigma = 0.5 * get_sigma2(L * rng.random((N,2)))
+   pts = L * rng.random((N,2) if K == None else (K,N,2))
+   sigma = 0.5 * GeometryFactory(periodic = False, L = L).get_distances(pts).min(axis = -1)
    return np.pi * sigma**2 * N / (L[0]*L[1])
 
 def get_bins(bins):
@@ -105,7 +97,8 @@ if __name__=='__main__':
    args = parse_arguments()
    rng = np.random.default_rng(args.seed)
 
-   etas = np.fromfunction(np.vectorize(lambda x:direct_disks_any(args.N,np.array(args.L),rng=rng)),(args.M,))
+   etas = np.concatenate([direct_disks_any(args.N,np.array(args.L),rng=rng,K=min(args.batch,args.M-i))
+                          for i in range(0,args.M,args.batch)])
    n,bins = np.histogram(etas,bins=args.bins,density=True)
    centres = 0.5 *(bins[1:] + bins[:-1])
 
@@ -25,7 +25,7 @@ from time import time
 import numpy as np
 from matplotlib import rc
 from matplotlib.pyplot import figure, show
-from markov_ising import MarkovIsing
+from markov_ising import MarkovIsing, CheckerboardIsing, MultiSpinIsing
 from thermo_db import thermo
 
 def parse_arguments():
@@ -36,6 +36,10 @@ def parse_arguments():
     parser.add_argument('--Nsteps', type = int, default = 10000, help = 'Number of steps')
     parser.add_argument('--Nburn', type = int, default = 0, help = 'Number of steps for burn in')
     parser.add_argument('--Niterations', type = int, default = 5, help = 'Number of iterations of Markov chain')
+    parser.add_argument('--checkerboard', default=False, action = 'store_true',
+                        help = 'Update spins in checkerboard sweeps: Nsteps and Nburn count sweeps instead of steps')
+    parser.add_argument('--multispin', default=False, action = 'store_true',
+                        help = 'Run 64 replicas in checkerboard sweeps using multi-spin coding, and pool their statistics')
     parser.add_argument('-f', '--frequency',type = int, default = 1000, help = 'How often to report progress')
     parser.add_argument('--seed',type=int,default=None,help='Seed for random number generator')
     parser.add_argument('-o', '--out', default = basename(splitext(__file__)[0]),help='Name of output file')
@@ -69,11 +73,12 @@ if __name__=='__main__':
     NObservations = args.m*args.n
     beta = 1/args.T
 
-    markov = MarkovIsing(rng = np.random.default_rng(args.seed),
-                         shape=(args.m,args.n),
-                         periodic=args.periodic,
-                         Niterations=args.Niterations,
-                         beta=beta)
+    Engine = MultiSpinIsing if args.multispin else CheckerboardIsing if args.checkerboard else MarkovIsing
+    markov = Engine(rng = np.random.default_rng(args.seed),
+                    shape=(args.m,args.n),
+                    periodic=args.periodic,
+                    Niterations=args.Niterations,
+                    beta=beta)
     e = np.zeros((args.Niterations))
     cV = np.zeros((args.Niterations))
     for i in range(args.Niterations):
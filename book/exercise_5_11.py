@@ -15,7 +15,7 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-'''Exercise 5-11/Algorithm 5-9: cluster ising'''
+'''Exercise 5-11/Algorithm 5-9: cluster ising, optionally using the Swendsen-Wang algorithm'''
 
 from argparse import ArgumentParser
 from collections import defaultdict
@@ -24,7 +24,7 @@ from time import time
 import numpy as np
 from matplotlib import rc
 from matplotlib.pyplot import figure, show
-from cluster_ising import ClusterIsing
+from cluster_ising import ClusterIsing, SwendsenWangIsing
 from ising_db import IsingDatabase
 
 def parse_arguments():
@@ -42,6 +42,8 @@ def parse_arguments():
     parser.add_argument('--Tc',default=False,action = 'store_true', help   = 'Include critical temperature')
     parser.add_argument('--verbose', default=False, action = 'store_true', help   = 'More messages')
     parser.add_argument('--fresh', default=False, action = 'store_true', help='Start with a fresh database')
+    parser.add_argument('--swendsen-wang', default=False, action = 'store_true',
+                        help='Flip many clusters at each step, and report improved estimators for susceptibility')
     return parser.parse_args()
 
 def get_range(T,deltaT=0.1):
@@ -99,15 +101,18 @@ if __name__=='__main__':
         T_range = sorted(list(T_range) + [2/np.log(1+np.sqrt(2))])
 
     fig = figure(figsize=(12,12))
-    fig.suptitle(rf'Cluster Ising {args.m}$\times${args.n}, {get_periodic(args.periodic)}')
+    Engine = SwendsenWangIsing if args.swendsen_wang else ClusterIsing
+    fig.suptitle(rf'{"Swendsen-Wang" if args.swendsen_wang else "Cluster"} Ising {args.m}$\times${args.n}, {get_periodic(args.periodic)}')
     ax1 = fig.add_subplot(2,1,1)
     ax2 = fig.add_subplot(2,1,2)
     N = args.m*args.n
     width = 25/len(T_range)  # Established empirically
 
     for i,T in enumerate(T_range):
-        markov = ClusterIsing(rng=np.random.default_rng(args.seed),shape=(args.m,args.n),periodic=args.periodic,beta=1/T)
+        markov = Engine(rng=np.random.default_rng(args.seed),shape=(args.m,args.n),periodic=args.periodic,beta=1/T)
         nIterations = markov.run(Nsteps=args.Nsteps,database=database)
+        if args.swendsen_wang:
+            print (f'T={T:.3}, susceptibility={markov.get_susceptibility():.6g}, Binder cumulant={markov.get_binder():.6g}')
         E = np.array([[e,n] for e,n in markov.data.generate_E()],dtype=int)
         ax1.bar(E[:,0],E[:,1],width=width,label=f'T={T:.3},Nsteps={nIterations}')
         M = np.array([[m,n] for m,n in markov.data.generate_M()],dtype=int)
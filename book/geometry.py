@@ -21,9 +21,14 @@
 '''
 
 from abc import ABC, abstractmethod
+from itertools import product
+from math import gamma
 from sys import maxsize
+from tempfile import TemporaryDirectory
 from unittest import TestCase, main
 import numpy as np
+from cells import CellGrid
+from lattice import Lattice
 
 class Geometry(ABC):
     '''
@@ -33,7 +38,12 @@ class Geometry(ABC):
         L      A vector representing the length of one side of the space
         sigma  Radius of a sphere
         d      Dimension of space
+        index      A grid of cells recording which disks lie near each other, or None
+        indexed    The array of centres that was used to build index
+        structure  Accumulators for pair correlation and bond order, or None
     '''
+    periodic = False
+
     @staticmethod
     def create_L(L,d):
         '''
@@ -101,6 +111,10 @@ class Geometry(ABC):
         self.L = L
         self.sigma = sigma
         self.d = d
+        self.index = None
+        self.indexed = None
+        self.pairs = {}
+        self.structure = None
 
     def get_density(self, N = 4):
         '''
@@ -109,7 +123,13 @@ class Geometry(ABC):
         Parameters:
             N      Number of spheres
         '''
-        return N * (np.pi * self.sigma**2)/np.prod(self.L)
+        return N * self.get_ball_volume() * self.sigma**self.d/np.prod(self.L)
+
+    def get_ball_volume(self):
+        '''
+        Volume of a sphere of unit radius: pi for a disk, 4*pi/3 for a sphere
+        '''
+        return np.pi**(self.d/2) / gamma(self.d/2 + 1)
 
     def set_sigma(self, eta = 1.0, N   = 4):
         '''
@@ -119,28 +139,38 @@ class Geometry(ABC):
             eta    The density that we want
             N      Number of spheres
         '''
-        self.sigma = np.sqrt(np.prod(self.L)*eta/(N*np.pi))
+        self.sigma = (np.prod(self.L)*eta/(N*self.get_ball_volume()))**(1/self.d)
+        self.index = None
 
-    def create_configuration(self,N=4):
+    def create_configuration(self,N=4,lattice=None,eta=None):
         '''
         Create an initial configuration, spread uniformly through space
 
         Parameters:
-            N      Number of spheres
+            N        Number of spheres
+            lattice  Lattice.SC, Lattice.BCC, or Lattice.FCC (default) for d=3; ignored for d=2
+            eta      Target packing fraction: if specified, sigma is changed to achieve it
         '''
-        if self.d == 2:
-            return self.pack_disks(N)
+        if eta != None:
+            self.set_sigma(eta = eta, N = N)
+        if self.d in [2,3]:
+            return self.pack_disks(N, lattice = lattice)
         else:
-            raise ValueError(f'Not implemented for d={d}')
+            raise ValueError(f'Not implemented for d={self.d}')
 
-    def pack_disks(self, N=4):
+    def pack_disks(self, N=4, lattice=None):
         '''
             Create an initial configuration of disks, spread uniformly through a rectangle,
-            using Lagrange's formula https://en.wikipedia.org/wiki/Circle_packing#Densest_packing
+            using Lagrange's formula https://en.wikipedia.org/wiki/Circle_packing#Densest_packing.
+            For d=3, spheres are placed on a cubic lattice instead.
 
         Parameters:
-            N      Number of disks
+            N        Number of disks
+            lattice  Lattice.SC, Lattice.BCC, or Lattice.FCC (default), used for d=3 only
         '''
+        if self.d == 3:
+            return self.pack_spheres(N, lattice = Lattice.FCC if lattice == None else lattice)
+
         def alloc(i,j):
             '''Determine position of one disk'''
             offset = 0 if i%2==0 else 0.5*Delta[1]
@@ -159,6 +189,58 @@ class Geometry(ABC):
         coordinates = [alloc(i,j) for i in range(m) for j in range(n)]
         return np.array(coordinates[0:N])
 
+    def pack_spheres(self, N=4, lattice=Lattice.FCC):
+        '''
+            Create an initial configuration of spheres on a cubic lattice. The number of cells along
+            each side is chosen to keep neighbouring spheres as far apart as possible; if the lattice has
+            more sites than spheres, vacancies are spread evenly through it. In a box the cells are sized
+            so that the outermost sites lie on the bounds, so no space is wasted next to the walls.
+
+        Parameters:
+            N        Number of spheres
+            lattice  Lattice.SC, Lattice.BCC, or Lattice.FCC
+        '''
+        _,basis,_ = Lattice.get_cell(lattice, 3)
+        eta_max = Lattice.get_packing_fraction(lattice, 3)
+        eta = self.get_density(N=N)
+        if eta > eta_max:
+            raise ValueError(f'Density of {eta} exceeds {eta_max} for {lattice} lattice')
+
+        offsets = np.array(list(product([-1,0,1], repeat = 3)))
+        separations = ((basis[:,np.newaxis,:] - basis[np.newaxis,:,:]).reshape(-1,1,3) + offsets).reshape(-1,3)
+        separations = separations[np.any(separations != 0, axis = 1)]
+
+        def get_nearest(a):
+            '''Distance between nearest neighbours for cells with specified sides'''
+            return np.sqrt(((separations * a)**2).sum(axis = 1)).min()
+
+        def get_sides(m):
+            '''Sides of cells: in a box, a single plane of sites is treated as spanning the whole side'''
+            if self.periodic:
+                return Available/m
+            spans = m - 1 + basis.max(axis = 0)
+            return Available/np.where(spans > 0, spans, 1)
+
+        Available = self.UpperBound - self.LowerBound
+        c = (N / (len(basis) * np.prod(Available)))**(1/3)
+        best = None
+        for m in product(*[range(max(int(np.floor(c*A)),1), int(np.ceil(c*A)) + 2) for A in Available]):
+            m = np.array(m)
+            if np.prod(m) * len(basis) < N: continue
+            nearest = get_nearest(get_sides(m))
+            if best == None or nearest > best[0]:
+                best = (nearest, m)
+
+        nearest,m = best
+        if nearest < 2*self.sigma:
+            raise ValueError(f'Cannot place {N} spheres of radius {self.sigma} on {lattice} lattice: neighbours would be {nearest:.4g} apart')
+        a = get_sides(m)
+        origins = np.stack(np.meshgrid(*[np.arange(k) for k in m], indexing = 'ij'), axis = -1).reshape(-1,1,3)
+        sites = (self.LowerBound + (origins + basis) * a).reshape(-1,3)
+        if not self.periodic:
+            sites = np.clip(sites, self.LowerBound, self.UpperBound)   # Guard against rounding at the walls
+        return sites[np.linspace(0, len(sites), N, endpoint = False).astype(int)]
+
     def create_Histograms(self,n=10,HistogramBins=np.zeros(0)):
         '''
         Used to instantiate a dynamic histogram
@@ -166,6 +248,113 @@ class Geometry(ABC):
         self.HistogramBins = np.zeros((n,self.d), dtype=np.int64) if HistogramBins.size==0 else HistogramBins
         return [Histogram(n, h = self.HistogramBins[:,j]) for j in range(self.d)]
 
+    def create_index(self, X):
+        '''
+        Build an index of disk centres, so that the disks near a point can be found
+        without examining every disk. Each cell is at least as wide as a disk.
+
+        Parameters:
+            X      Centres of all disks
+        '''
+        self.index = CellGrid(self.L, width = 2*self.sigma, periodic = self.periodic)
+        self.index.fill(X)
+        self.indexed = X
+
+    def is_indexed(self, X, k):
+        '''
+        Verify that the index can be used to find disks near one that is about to move: it must have been
+        built from the same array of centres, its cells must still be wide enough for the current sigma,
+        and it must place the moving disk in the right cell.
+
+        Parameters:
+            X      Centres of all disks
+            k      Index of the disk that is about to move
+        '''
+        return (self.index != None and self.indexed is X and all(self.index.w >= 2*self.sigma)
+                and self.index.cell_of.get(k) == self.index.get_cell(X[k]))
+
+    def get_neighbours(self, x, k = -1):
+        '''
+        Find all disks whose centres lie in the same cell as a point, or in an adjacent cell.
+        These are the only disks that can overlap a disk centred on the point.
+
+        Parameters:
+            x      The point
+            k      Index of a disk to be excluded, e.g. the one that is moving
+        '''
+        for cell in self.index.get_adjacent(self.index.get_cell(x)):
+            for j in self.index.cells.get(cell, ()):
+                if j != k:
+                    yield j
+
+    def update_index(self, k, x):
+        '''
+        Record that a disk has moved
+
+        Parameters:
+            k      Index of disk
+            x      New position of disk
+        '''
+        cell = self.index.get_cell(x)
+        if cell != self.index.cell_of[k]:
+            self.index.move(k, cell)
+
+    def get_neighbour_pairs(self, X, cutoff):
+        '''
+        Find all pairs of points that are closer than a cutoff. Points are sorted into a grid of cells
+        at least as wide as the cutoff, so each point is only compared with points in the same or adjacent
+        cells, and no distance matrix is needed.
+
+        Parameters:
+            X        Centres of disks
+            cutoff   Largest separation of interest: must not exceed half the side of a torus
+
+        Returns:
+            i, j, Delta, r: indices of points in each pair (i < j), the vector from point i to point j, and the distance
+        '''
+        if self.periodic and any(2*cutoff > self.L):
+            raise ValueError(f'Cutoff {cutoff} exceeds half the side of torus {self.L}')
+        N,d = X.shape
+        grid = CellGrid(self.L, width = cutoff, periodic = self.periodic)
+        C = np.floor(X / grid.w).astype(int)
+        C = C % grid.m if self.periodic else np.clip(C, 0, grid.m - 1)
+        cell_ids = np.ravel_multi_index(C.T, grid.m)
+        n_cells = int(np.prod(grid.m))
+        order = np.argsort(cell_ids, kind = 'stable')
+        first = np.searchsorted(cell_ids[order], np.arange(n_cells))
+        occupancy = np.bincount(cell_ids, minlength = n_cells)
+        contents = np.full((n_cells + 1, max(occupancy.max(), 1)), -1)    # Last row is an empty cell, used outside box
+        contents[cell_ids[order], np.arange(N) - first[cell_ids[order]]] = order
+        candidates = []
+        for offset in product([-1,0,1], repeat = d):
+            adjacent = C + offset
+            if self.periodic:
+                adjacent_ids = np.ravel_multi_index((adjacent % grid.m).T, grid.m)
+            else:
+                inside = np.all((adjacent >= 0) & (adjacent < grid.m), axis = 1)
+                adjacent_ids = np.where(inside, np.ravel_multi_index(np.clip(adjacent, 0, grid.m - 1).T, grid.m), n_cells)
+            candidates.append(contents[adjacent_ids])
+        j = np.concatenate(candidates, axis = 1)
+        i = np.broadcast_to(np.arange(N)[:,np.newaxis], j.shape)
+        keys = np.unique(i[j > i] * N + j[j > i])        # The same cell may be adjacent more than once if the grid is small
+        i,j = keys // N, keys % N
+        Delta = self.get_differences(X[j], X[i])
+        r = np.sqrt(np.einsum('ij,ij->i', Delta, Delta))
+        close = r < cutoff
+        return i[close], j[close], Delta[close], r[close]
+
+    def create_structure(self, cutoff = 0.25, n = 50, every = 1):
+        '''
+        Attach accumulators for pair correlation and (in two dimensions) bond order
+
+        Parameters:
+            cutoff   Largest separation for pair correlation, and for neighbours used for bond order
+            n        Number of bins for each histogram
+            every    Number of steps between updates
+        '''
+        self.structure = Structure(cutoff = cutoff, n = n, every = every, d = self.d)
+        return self.structure
+
     @abstractmethod
     def get_description(self):
         '''Used in titles of plots'''
@@ -180,35 +369,151 @@ class Geometry(ABC):
         This function is used to propose a move
         '''
 
-    def admissable(self,proposed):
-        '''Determine whether proposed configuration is admissable, i.e. no two spheres overlap'''
-        m,_ = proposed.shape
-        for i in range(m):
-            for j in range(i+1,m):
-                if self.get_distance(proposed[i,:],proposed[j,:]) < 2*self.sigma:
-                    return False
+    @abstractmethod
+    def get_differences(self, X0, X1):
+        '''
+        Calculate the vectors between corresponding points of two arrays, which may have any
+        shape that NumPy can broadcast, e.g. (N,d) and (d,), or (K,P,d) and (K,P,d)
+        '''
+
+    def get_pairs(self, N):
+        '''
+        Find indices of all pairs of points, in the same order as np.triu_indices(N, k = 1).
+        Indices are calculated once for each N, then reused.
+
+        Parameters:
+            N      Number of points
+        '''
+        if N not in self.pairs:
+            self.pairs[N] = np.triu_indices(N, k = 1)
+        return self.pairs[N]
+
+    def get_squared_distances(self, X):
+        '''
+        Calculate the squared distances between all pairs of points
+
+        Parameters:
+            X      Array of points, shape (...,N,d): leading axes are treated as a batch
+
+        Returns:
+            Array of shape (...,N*(N-1)/2), with pairs in the order of get_pairs(N)
+        '''
+        k,l = self.get_pairs(X.shape[-2])
+        Delta = self.get_differences(X[...,k,:], X[...,l,:])
+        return np.einsum('...i,...i->...', Delta, Delta)
+
+    def get_distances(self, X):
+        '''
+        Calculate the distances between all pairs of points
+
+        Parameters:
+            X      Array of points, shape (...,N,d): leading axes are treated as a batch
+
+        Returns:
+            Array of shape (...,N*(N-1)/2), with pairs in the order of get_pairs(N)
+        '''
+        return np.sqrt(self.get_squared_distances(X))
+
+    def admissable(self, proposed, block = 1024):
+        '''
+        Determine whether proposed configuration is admissable, i.e. no two spheres overlap.
+        Pairs are checked a block at a time, so we can stop as soon as an overlap is found.
+
+        Parameters:
+            proposed   Centres of spheres
+            block      Number of pairs to be checked at a time
+        '''
+        k,l = self.get_pairs(len(proposed))
+        for start in range(0, len(k), block):
+            Delta = self.get_differences(proposed[k[start:start+block]], proposed[l[start:start+block]])
+            if np.any(np.einsum('ij,ij->i', Delta, Delta) < 4*self.sigma**2):
+                return False
         return True
 
-    def direct_disks(self, N = 4, NTrials = maxsize,  rng = np.random.default_rng()):
+    def get_admissable(self, proposed):
+        '''
+        Determine which of a batch of configurations are admissable
+
+        Parameters:
+            proposed   Centres of spheres for a batch of configurations, shape (K,N,d)
+
+        Returns:
+            An array of K booleans, True for each configuration in which no two spheres overlap
+        '''
+        return np.all(self.get_squared_distances(proposed) >= 4*self.sigma**2, axis = -1)
+
+    def direct_disks(self, N = 4, NTrials = maxsize,  rng = np.random.default_rng(), K = 1):
         '''
         Prepare one admissable configuration of disks
 
         Parameters:
-            N         Number of attempts
+            N         Number of disks
             NTrials   Maximum number of attempts to create configuration (tabula rasa)
             rng       Random number generator
+            K         Number of configurations to be proposed and tested at once
 
         Returns:
             X, an array containing the coordinates of N points such that we can position N
             disks of radius sigma, with the centre of each disk at the corresponding point
             of X.
         '''
+        if K == 1:
+            for k in range(NTrials):
+                proposed = self.propose(N,rng =rng)
+                if self.admissable(proposed): return proposed
+        else:
+            for k in range(0, NTrials, K):
+                admissable = self.direct_disks_batch(N = N, K = min(K, NTrials - k), rng = rng)
+                if len(admissable) > 0: return admissable[0]
+
+        raise RuntimeError(f'Failed to place {N} spheres within {NTrials} attempts for sigma={self.sigma}')
+
+    def direct_disks_batch(self, N = 4, K = 256, rng = np.random.default_rng()):
+        '''
+        Propose a batch of configurations, and keep the admissable ones. Since each is
+        an independent sample, all of them may be used when collecting statistics.
+
+        Parameters:
+            N         Number of disks
+            K         Number of configurations to be proposed
+            rng       Random number generator
+
+        Returns:
+            An array of shape (M,N,d), where M is the number of admissable configurations,
+            so M/K estimates the acceptance rate
+        '''
+        proposed = self.propose(N, rng = rng, K = K)
+        return proposed[self.get_admissable(proposed)]
 
-        for k in range(NTrials):
-            proposed = self.propose(N,rng =rng)
-            if self.admissable(proposed): return proposed
+    def direct_disks_many(self, M = 1000, N = 4, NTrials = maxsize, rng = np.random.default_rng(), K = 256):
+        '''
+        Prepare many admissable configurations of disks, using every admissable configuration from each batch
 
-        raise RuntimeError(f'Failed to place {N} spheres within {NTrials} attempts for sigma={sigma}')
+        Parameters:
+            M         Number of configurations
+            N         Number of disks
+            NTrials   Maximum number of consecutive attempts that fail to create a configuration
+            rng       Random number generator
+            K         Number of configurations to be proposed and tested at once
+
+        Returns:
+            An array of shape (M,N,d)
+        '''
+        configurations = np.empty((M,N,self.d))
+        m = 0
+        n_failed = 0
+        while m < M:
+            admissable = self.direct_disks_batch(N = N, K = K, rng = rng)
+            if len(admissable) == 0:
+                n_failed += K
+                if n_failed >= NTrials:
+                    raise RuntimeError(f'Failed to place {N} spheres within {n_failed} attempts for sigma={self.sigma}')
+                continue
+            n_failed = 0
+            n = min(len(admissable), M - m)
+            configurations[m:m+n] = admissable[0:n]
+            m += n
+        return configurations
 
 
 class BoundedGeometry(Geometry):
@@ -245,7 +550,7 @@ class BoundedGeometry(Geometry):
         if any(self.UpperBound < X): return False
         return True
 
-    def propose(self,N,rng = np.random.default_rng()):
+    def propose(self,N,rng = np.random.default_rng(), K = None):
         '''
         Used to propose a configuration of centroids of spheres,
         which is not guaranteed to be admissable.
@@ -253,8 +558,9 @@ class BoundedGeometry(Geometry):
         Parameters:
             N     Number of spheres
             rng   Random number generator
+            K     Number of configurations: if specified, the result has shape (K,N,d)
         '''
-        return self.LowerBound + (self.UpperBound-self.LowerBound) * rng.random(size=(N,self.d))
+        return self.LowerBound + (self.UpperBound-self.LowerBound) * rng.random(size=(N,self.d) if K == None else (K,N,self.d))
 
 class Box(BoundedGeometry):
     '''
@@ -269,11 +575,27 @@ class Box(BoundedGeometry):
         '''
         super().__init__(L = L, sigma = sigma, d = d,LowerBound = sigma*np.ones(d),UpperBound =  L - sigma*np.ones(d))  #FIXME
 
+    def set_sigma(self, eta = 1.0, N   = 4):
+        '''
+        Calculate the radius of spheres needed to give a specified density,
+        and keep centres at least one radius from the walls
+
+        Parameters:
+            eta    The density that we want
+            N      Number of spheres
+        '''
+        super().set_sigma(eta = eta, N = N)
+        self.LowerBound = self.sigma*np.ones(self.d)
+        self.UpperBound = self.L - self.sigma*np.ones(self.d)
 
     def get_distance(self, X0,X1):
         '''Calculate Euclidean distance between two points'''
         return np.linalg.norm(X0-X1)
 
+    def get_differences(self, X0, X1):
+        '''Calculate the vectors between corresponding points of two arrays'''
+        return X0 - X1
+
     def move_to(self,X):
         '''
         This function is used to propose a move.
@@ -288,6 +610,8 @@ class Box(BoundedGeometry):
 
 class Torus(BoundedGeometry):
     '''This class represents a  box geometry with periodic boundary conditions, i.e. a torus.'''
+    periodic = True
+
     def __init__(self, L = np.array([1,1]), sigma = 0.125, d = 2):
         '''
         Parameters:
@@ -302,6 +626,14 @@ class Torus(BoundedGeometry):
         '''Calculate distance between two points using periodic boundary conditions'''
         return np.linalg.norm(self.diff_vec(X0,X1))
 
+    def get_differences(self, X0, X1):
+        '''
+        Calculate the vectors between corresponding points of two arrays, using the minimum image.
+        This gives the same distances as diff_vec, but uses fewer operations on large arrays.
+        '''
+        Delta = X0 - X1
+        return Delta - self.L * np.round(Delta / self.L)
+
     def move_to(self,X):
         '''
         This function is used to propose a move
@@ -328,7 +660,7 @@ class Torus(BoundedGeometry):
 
         '''
         Delta  = self.box_it(X0 - X1)
-        return np.minimum(Delta, Delta - self.L/2)
+        return np.where(Delta > self.L/2, Delta - self.L, Delta)
 
     def get_description(self):
         '''Used in titles of plots'''
@@ -357,16 +689,38 @@ class Histogram:
         h        The collection of counts for all bins
         x0       Lowest sample value expected
         xn       Highest sample value expected
+        expand   If True, bins are added whenever a sample falls outside [x0,xn], so
+                 no samples are lost. Otherwise samples are counted in the first or last bin.
     '''
     def __init__(self,
                  n  = 10,
                  x0 = 0,
                  xn = 1,
-                 h  = np.zeros((0,0))):
+                 h  = np.zeros((0,0)),
+                 expand = False):
         self.n = n
         self.h = np.zeros((n)) if h.size == 0 else h
         self.x0 = x0
         self.xn = xn
+        self.expand = expand
+
+    @staticmethod
+    def create(bins = 10, x0 = 0, xn = 1, n_samples = 1000, expand = True):
+        '''
+        Create an empty histogram, using either a specified number of bins or a binning strategy
+
+        Parameters:
+            bins       Number of bins, or name of a binning strategy, as for np.histogram_bin_edges.
+                       Since samples have not been collected yet, a strategy is evaluated
+                       for the expected number of samples, spread evenly across the range.
+            x0         Lowest sample value expected
+            xn         Highest sample value expected
+            n_samples  Expected number of samples
+            expand     Indicates whether bins will be added for samples outside [x0,xn]
+        '''
+        n = bins if np.ndim(bins) == 0 and not isinstance(bins,str) else \
+            len(np.histogram_bin_edges(np.linspace(x0, xn, max(n_samples,2)), bins = bins, range = (x0,xn))) - 1
+        return Histogram(n = int(n), x0 = x0, xn = xn, h = np.zeros((int(n)), dtype = np.int64), expand = expand)
 
     def __len__(self):
         '''
@@ -380,6 +734,21 @@ class Histogram:
         '''
         return self.h[i]
 
+    def get_width(self):
+        '''
+        Width of one bin
+        '''
+        return (self.xn-self.x0)/self.n
+
+    def get_bins(self, xs):
+        '''
+        Determine which bins samples belong to
+
+        Parameters:
+             xs    The values to be added
+        '''
+        return np.clip(np.floor(self.n * (np.asarray(xs)-self.x0)/(self.xn-self.x0)).astype(int), 0, len(self)-1)
+
     def add(self,x):
         '''
         Add one value to histogram. This increases the count of the relevant bin by 1
@@ -387,7 +756,62 @@ class Histogram:
         Parameters:
              x     The value to be added
         '''
-        self.h[min(int(self.n * (x-self.x0)/(self.xn-self.x0)),len(self)-1)]+=1
+        if self.expand:
+            self.extend(x,x)
+        self.h[self.get_bins(x)]+=1
+
+    def add_many(self,xs):
+        '''
+        Add an array of values to histogram, counting them all at once
+
+        Parameters:
+             xs     The values to be added
+        '''
+        xs = np.ravel(xs)
+        if len(xs) == 0: return
+        if self.expand:
+            self.extend(xs.min(),xs.max())
+        self.h += np.bincount(self.get_bins(xs),minlength=self.n)
+
+    def extend(self,lo,hi):
+        '''
+        Add empty bins of the same width, so that histogram covers a specified range
+
+        Parameters:
+            lo     Lowest value that is to be covered
+            hi     Highest value that is to be covered
+        '''
+        width = self.get_width()
+        n_below = max(int(np.ceil((self.x0 - lo)/width)), 0)
+        n_above = int(np.ceil((hi - self.xn)/width)) if hi > self.xn else 0
+        if n_below + n_above == 0: return
+        self.h = np.concatenate((np.zeros((n_below),dtype=self.h.dtype), self.h, np.zeros((n_above),dtype=self.h.dtype)))
+        self.n += n_below + n_above
+        self.x0 -= n_below * width
+        self.xn += n_above * width
+
+    def merge(self,other):
+        '''
+        Add the counts from another histogram, e.g. one accumulated by another worker.
+        Both histograms must have the same bin width, and their edges must line up.
+
+        Parameters:
+            other    The histogram that is to be added
+        '''
+        width = self.get_width()
+        offset = (other.x0 - self.x0)/width
+        if not np.isclose(width, other.get_width()) or not np.isclose(offset, np.round(offset)):
+            raise ValueError(f'Cannot merge histograms with edges [{self.x0},{self.xn}]/{self.n} and [{other.x0},{other.xn}]/{other.n}')
+        self.extend(other.x0 + 0.5*width, other.xn - 0.5*width)
+        start = int(np.round((other.x0 - self.x0)/width))
+        self.h[start:start+other.n] += other.h
+        return self
+
+    def get_edges(self):
+        '''
+        Retrieve the boundaries of all bins
+        '''
+        return np.linspace(self.x0, self.xn, self.n + 1)
 
     def get_hist(self):
         '''
@@ -404,6 +828,335 @@ class Histogram:
         for i in range(self.n):
             yield(self.h[i])
 
+    def save(self, prefix = 'h'):
+        '''
+        Package histogram so it can be stored in an npz file alongside other data, e.g.
+            np.savez(file, X = X, **histogram.save('X'))
+
+        Parameters:
+            prefix    Used to distinguish the arrays for this histogram from other data
+        '''
+        return {f'{prefix}_h' : self.h, f'{prefix}_edges' : np.array([self.x0, self.xn])}
+
+    @staticmethod
+    def load(npzfile, prefix = 'h', expand = False):
+        '''
+        Restore a histogram that was stored using save(...)
+
+        Parameters:
+            npzfile   Data loaded from npz file
+            prefix    Used to distinguish the arrays for this histogram from other data
+            expand    Indicates whether bins will be added for samples outside current range
+        '''
+        h = npzfile[f'{prefix}_h']
+        x0,xn = npzfile[f'{prefix}_edges']
+        return Histogram(n = len(h), x0 = x0, xn = xn, h = h.copy(), expand = expand)
+
+class PairCorrelation:
+    '''
+    Accumulate the pair correlation function g(r), for separations up to a cutoff, one configuration at a time.
+    In a box, pairs near the walls are not corrected for, so g(r) falls below 1 at large r.
+
+    Attributes:
+        cutoff      Largest separation
+        histogram   Counts of pairs by separation
+        n_samples   Number of configurations
+        N           Number of disks in each configuration
+    '''
+    def __init__(self, cutoff = 0.25, n = 50, h = np.zeros((0)), n_samples = 0, N = 0, r0 = 0):
+        self.cutoff = cutoff
+        self.histogram = Histogram(n = n, x0 = r0, xn = cutoff, h = np.zeros((n), dtype = np.int64) if h.size == 0 else h)
+        self.n_samples = n_samples
+        self.N = N
+
+    def add(self, geometry, X):
+        '''
+        Add the separations of all pairs of disks in one configuration
+        '''
+        _,_,_,r = geometry.get_neighbour_pairs(X, self.cutoff)
+        self.histogram.add_many(r)
+        self.n_samples += 1
+        self.N = len(X)
+
+    def get_g(self, geometry):
+        '''
+        Normalize counts by the number of pairs expected in each shell for an ideal gas
+
+        Returns:
+            r, g: the centre of each bin, and the value of g(r)
+        '''
+        edges = self.histogram.get_edges()
+        shells = np.pi**(geometry.d/2) / gamma(geometry.d/2 + 1) * np.diff(edges**geometry.d)
+        expected = self.n_samples * 0.5 * self.N * (self.N - 1) * shells / np.prod(geometry.L)
+        return 0.5*(edges[:-1] + edges[1:]), self.histogram.h / np.maximum(expected, np.finfo(float).tiny)
+
+    def get_contact(self, geometry, n_fit = 5):
+        '''
+        Estimate g(r) at contact, r = 2*sigma, by fitting log g(r) to a straight line over the
+        first few bins beyond contact, and extrapolating back
+
+        Parameters:
+            geometry   Box or Torus
+            n_fit      Number of bins used for fit
+        '''
+        r,g = self.get_g(geometry)
+        edges = self.histogram.get_edges()
+        beyond = (edges[:-1] >= 2*geometry.sigma*(1 - 1e-9)) & (g > 0)
+        r,g = r[beyond][0:n_fit],g[beyond][0:n_fit]
+        if len(r) < 2: return float('nan')
+        slope,intercept = np.polyfit(r - 2*geometry.sigma, np.log(g), 1)
+        return np.exp(intercept)
+
+class BondOrder:
+    '''
+    Accumulate the local hexatic order parameter, psi_6 = <exp(6 i theta)> over the nearest neighbours
+    of each disk, and the magnitude of its average over the configuration. Two dimensions only.
+
+    Attributes:
+        cutoff        Neighbours must be closer than this
+        n_neighbours  Maximum number of neighbours for each disk
+        histogram     Counts of |psi_6| for individual disks
+        sums          Number of configurations, sum of |Psi_6|, and sum of |Psi_6|**2, where Psi_6 is the average over disks
+    '''
+    def __init__(self, cutoff = 0.25, n = 50, h = np.zeros((0)), sums = np.zeros((3)), n_neighbours = 6):
+        self.cutoff = cutoff
+        self.n_neighbours = n_neighbours
+        self.histogram = Histogram(n = n, x0 = 0, xn = 1, h = np.zeros((n), dtype = np.int64) if h.size == 0 else h)
+        self.sums = np.array(sums, dtype = float)
+
+    def get_local(self, geometry, X):
+        '''
+        Calculate psi_6 for each disk, from the nearest neighbours within the cutoff
+
+        Returns:
+            An array of complex numbers, one for each disk (zero if a disk has no neighbours)
+        '''
+        N,_ = X.shape
+        i,j,Delta,r = geometry.get_neighbour_pairs(X, self.cutoff)
+        k = np.concatenate((i,j))
+        Delta = np.concatenate((Delta,-Delta))
+        order = np.lexsort((np.concatenate((r,r)), k))   # Neighbours of each disk, nearest first
+        k,Delta = k[order],Delta[order]
+        rank = np.arange(len(k)) - np.searchsorted(k, np.arange(N))[k]
+        k,Delta = k[rank < self.n_neighbours],Delta[rank < self.n_neighbours]
+        z = np.exp(6j * np.arctan2(Delta[:,1], Delta[:,0]))
+        counts = np.bincount(k, minlength = N)
+        sums = np.bincount(k, weights = z.real, minlength = N) + 1j*np.bincount(k, weights = z.imag, minlength = N)
+        return sums / np.maximum(counts, 1)
+
+    def add(self, geometry, X):
+        '''
+        Add local and global order parameters for one configuration
+        '''
+        psi = self.get_local(geometry, X)
+        self.histogram.add_many(np.abs(psi))
+        Psi = abs(psi.mean())
+        self.sums += [1, Psi, Psi**2]
+
+    def get_mean(self):
+        '''
+        Mean and variance of |Psi_6| over all configurations
+        '''
+        n,s1,s2 = self.sums
+        return s1/n, s2/n - (s1/n)**2
+
+class Structure:
+    '''
+    Streaming accumulators for structural analysis of disk configurations: pair correlation, and
+    (in two dimensions) bond order. Configurations are only analyzed every few steps, as neighbouring
+    configurations in a Markov chain are strongly correlated.
+
+    Attributes:
+        every     Number of steps between updates
+        g         Accumulator for pair correlation
+        psi       Accumulator for bond order, or None
+    '''
+    def __init__(self, cutoff = 0.25, n = 50, every = 1, d = 2):
+        self.every = every
+        self.g = PairCorrelation(cutoff = cutoff, n = n)
+        self.psi = BondOrder(cutoff = cutoff, n = n) if d == 2 else None
+
+    def update(self, geometry, X, step = 0):
+        '''
+        Add a configuration to accumulators, if it is time for an update
+
+        Parameters:
+            geometry   Box or Torus
+            X          Centres of disks
+            step       Number of steps so far
+        '''
+        if step % self.every != 0: return
+        self.g.add(geometry, X)
+        if self.psi != None:
+            self.psi.add(geometry, X)
+
+    def save(self):
+        '''
+        Package accumulators so they can be stored in an npz file alongside other data
+        '''
+        arrays = dict(self.g.histogram.save('g'), g_samples = np.array([self.g.n_samples, self.g.N]), structure_every = self.every)
+        if self.psi != None:
+            arrays.update(self.psi.histogram.save('psi'), psi_sums = self.psi.sums)
+        return arrays
+
+    @staticmethod
+    def load(npzfile, d = 2):
+        '''
+        Restore accumulators that were stored using save(), or return None if there are none
+        '''
+        if 'g_h' not in npzfile: return None
+        h = npzfile['g_h']
+        r0,cutoff = npzfile['g_edges']
+        structure = Structure(cutoff = float(cutoff), n = len(h), every = int(npzfile['structure_every']), d = d)
+        n_samples,N = npzfile['g_samples']
+        structure.g = PairCorrelation(cutoff = float(cutoff), n = len(h), h = h.copy(), n_samples = int(n_samples), N = int(N),
+                                      r0 = float(r0))
+        if 'psi_h' in npzfile:
+            structure.psi = BondOrder(cutoff = float(cutoff), n = len(npzfile['psi_h']), h = npzfile['psi_h'].copy(),
+                                      sums = npzfile['psi_sums'])
+        return structure
+
+class TestTorus(TestCase):
+    def test_diff_vec(self):
+        torus = Torus(L = np.array([1,1]), sigma = 0.1)
+        np.testing.assert_allclose([0.1,-0.2], torus.diff_vec(np.array([0.05,0.9]), np.array([0.95,0.1])))
+        self.assertAlmostEqual(np.sqrt(0.05), torus.get_distance(np.array([0.05,0.9]), np.array([0.95,0.1])))
+
+class TestDistances(TestCase):
+    '''
+    Verify that vectorized distances and overlap tests agree with the pairwise versions
+    '''
+    def test_distances(self):
+        rng = np.random.default_rng(23)
+        for periodic in [False,True]:
+            geometry = GeometryFactory(periodic = periodic, L = np.array([1,2]), sigma = 0.05, d = 2)
+            X = geometry.propose(20, rng = rng)
+            distances = geometry.get_distances(X)
+            k,l = np.triu_indices(20, k = 1)
+            for i,j,distance in zip(k,l,distances):
+                self.assertAlmostEqual(geometry.get_distance(X[i],X[j]), distance)
+            Xs = geometry.propose(60, rng = rng).reshape(3,20,2)
+            np.testing.assert_allclose([geometry.get_distances(x) for x in Xs], geometry.get_distances(Xs))
+
+    def test_admissable(self):
+        rng = np.random.default_rng(29)
+        for periodic in [False,True]:
+            geometry = GeometryFactory(periodic = periodic, L = np.array([1,1]), sigma = 0.05, d = 2)
+            for _ in range(100):
+                X = geometry.propose(10, rng = rng)
+                expected = all(geometry.get_distance(X[i],X[j]) >= 2*geometry.sigma for i in range(10) for j in range(i))
+                self.assertEqual(expected, geometry.admissable(X))
+                self.assertEqual(expected, geometry.admissable(X, block = 7))
+
+    def test_batch(self):
+        rng = np.random.default_rng(31)
+        for periodic in [False,True]:
+            geometry = GeometryFactory(periodic = periodic, L = np.array([1,1]), sigma = 0.1, d = 2)
+            proposed = geometry.propose(8, rng = rng, K = 200)
+            np.testing.assert_array_equal([geometry.admissable(X) for X in proposed], geometry.get_admissable(proposed))
+            X = geometry.direct_disks(N = 8, rng = rng, K = 64)
+            self.assertTrue(geometry.admissable(X))
+            Xs = geometry.direct_disks_many(M = 50, N = 8, rng = rng, K = 64)
+            self.assertEqual((50,8,2), Xs.shape)
+            self.assertTrue(all(geometry.admissable(X) for X in Xs))
+            with self.assertRaises(RuntimeError):
+                geometry.direct_disks(N = 40, NTrials = 100, rng = rng, K = 32)
+
+    def test_minimum_image(self):
+        geometry = GeometryFactory(periodic = True, L = np.array([1,1]), sigma = 0.05, d = 2)
+        self.assertFalse(geometry.admissable(np.array([[0.01,0.5], [0.99,0.5]])))
+        self.assertTrue(GeometryFactory(periodic = False, L = np.array([1,1]), sigma = 0.05, d = 2).admissable(np.array([[0.06,0.5], [0.94,0.5]])))
+
+class TestStructure(TestCase):
+    '''
+    Tests for neighbour search and structural accumulators
+    '''
+    def test_neighbour_pairs(self):
+        rng = np.random.default_rng(59)
+        for periodic in [False,True]:
+            for L in [np.array([1,1]), np.array([1,1.5,1])]:
+                geometry = GeometryFactory(periodic = periodic, L = L, sigma = 0.01, d = len(L))
+                X = geometry.propose(300, rng = rng)
+                for cutoff in [0.1, 0.3]:
+                    i,j,Delta,r = geometry.get_neighbour_pairs(X, cutoff)
+                    distances = geometry.get_distances(X)
+                    k,l = geometry.get_pairs(len(X))
+                    expected = distances < cutoff
+                    self.assertEqual(set(zip(k[expected],l[expected])), set(zip(i,j)))
+                    np.testing.assert_allclose(np.linalg.norm(Delta, axis = 1), r)
+
+    def test_ideal_gas(self):
+        geometry = GeometryFactory(periodic = True, L = np.array([1,1]), sigma = 0.0, d = 2)
+        structure = geometry.create_structure(cutoff = 0.2, n = 10, every = 2)
+        rng = np.random.default_rng(61)
+        for step in range(100):
+            structure.update(geometry, geometry.propose(200, rng = rng), step = step)
+        self.assertEqual(50, structure.g.n_samples)
+        _,g = structure.g.get_g(geometry)
+        np.testing.assert_allclose(np.ones(9), g[1:], atol = 0.05)
+
+    def test_hexagonal(self):
+        geometry = GeometryFactory(periodic = True, L = np.array([1, np.sqrt(3)/2]), sigma = 0.05, d = 2)
+        X = np.array([[0.1*i + 0.05*(j%2), np.sqrt(3)/2*0.1*j] for i in range(10) for j in range(10)])
+        structure = geometry.create_structure(cutoff = 0.15)
+        np.testing.assert_allclose(np.ones(100), np.abs(structure.psi.get_local(geometry, X)))
+        structure.update(geometry, X)
+        mean,variance = structure.psi.get_mean()
+        self.assertAlmostEqual(1.0, mean)
+        with TemporaryDirectory() as folder:
+            np.savez(f'{folder}/test.npz', **structure.save())
+            with np.load(f'{folder}/test.npz') as npzfile:
+                restored = Structure.load(npzfile)
+        np.testing.assert_array_equal(structure.g.histogram.h, restored.g.histogram.h)
+        np.testing.assert_array_equal(structure.psi.sums, restored.psi.sums)
+        self.assertEqual(100, restored.g.N)
+
+class TestPacking(TestCase):
+    '''
+    Tests for create_configuration
+    '''
+    def test_lattices(self):
+        for periodic in [False,True]:
+            for lattice in [Lattice.SC, Lattice.BCC, Lattice.FCC]:
+                eta_max = Lattice.get_packing_fraction(lattice, 3)
+                for N in [27, 100, 250]:
+                    geometry = GeometryFactory(periodic = periodic, L = np.array([1,1,1]), d = 3)
+                    X = geometry.create_configuration(N = N, lattice = lattice, eta = 0.25*eta_max)
+                    self.assertEqual((N,3), X.shape)
+                    self.assertGreaterEqual(geometry.get_distances(X).min(), 2*geometry.sigma)
+                    self.assertTrue(all(geometry.is_within_bounds(x) for x in X))
+
+    def test_dense(self):
+        geometry = GeometryFactory(periodic = True, L = np.array([1,1,1]), d = 3)
+        X = geometry.create_configuration(N = 256, lattice = Lattice.FCC, eta = 0.74)
+        self.assertAlmostEqual(0.74, geometry.get_density(N = 256))
+        self.assertGreaterEqual(geometry.get_distances(X).min(), 2*geometry.sigma)
+        with self.assertRaises(ValueError):
+            geometry.create_configuration(N = 256, lattice = Lattice.SC, eta = 0.6)
+        with self.assertRaises(ValueError):
+            geometry.create_configuration(N = 200, lattice = Lattice.FCC, eta = 0.74)
+
+    def test_dense_box(self):
+        '''
+        In a box the outermost sites lie on the bounds: 5x5x5 FCC cells reach eta=0.656
+        '''
+        geometry = GeometryFactory(periodic = False, L = np.array([1,1,1]), d = 3)
+        X = geometry.create_configuration(N = 500, lattice = Lattice.FCC, eta = 0.65)
+        self.assertAlmostEqual(0.65, geometry.get_density(N = 500))
+        self.assertGreaterEqual(geometry.get_distances(X).min(), 2*geometry.sigma)
+        self.assertTrue(all(geometry.is_within_bounds(x) for x in X))
+        X = geometry.create_configuration(N = 27, lattice = Lattice.SC, eta = 0.52)
+        self.assertGreaterEqual(geometry.get_distances(X).min(), 2*geometry.sigma)
+        self.assertTrue(all(geometry.is_within_bounds(x) for x in X))
+        with self.assertRaises(ValueError):
+            geometry.create_configuration(N = 500, lattice = Lattice.FCC, eta = 0.66)
+
+    def test_dimensions(self):
+        geometry = GeometryFactory(periodic = False, L = np.array([1,1]), d = 2)
+        geometry.set_sigma(eta = 0.5, N = 10)
+        self.assertAlmostEqual(np.sqrt(0.05/np.pi), geometry.sigma)
+        with self.assertRaisesRegex(ValueError, 'd=4'):
+            GeometryFactory(periodic = True, L = np.ones(4), sigma = 0.1, d = 4).create_configuration(N = 4)
 
 class TestHistogram(TestCase):
     def setUp(self):
@@ -423,5 +1176,53 @@ class TestHistogram(TestCase):
         self.histogram.add(1)
         self.assertEqual(1,self.histogram[-1])
 
+    def test_add_many(self):
+        xs = np.random.default_rng(1).random(1000)
+        self.histogram.add_many(xs)
+        for x in xs[0:100]:
+            self.histogram.add(x)
+        expected,_ = np.histogram(np.concatenate((xs,xs[0:100])),bins=10,range=(0,1))
+        np.testing.assert_array_equal(expected,self.histogram.h)
+
+    def test_expand(self):
+        histogram = Histogram(n = 4, x0 = 0, xn = 1, expand = True)
+        histogram.add_many([-0.3, 0.1, 1.0, 1.6])
+        self.assertEqual(9, len(histogram))
+        self.assertAlmostEqual(-0.5, histogram.x0)
+        self.assertAlmostEqual(1.75, histogram.xn)
+        np.testing.assert_array_equal([1,0,1,0,0,0,1,0,1], histogram.h)
+        histogram = Histogram(n = 4, x0 = 0, xn = 1, expand = True)
+        histogram.add(1.0)
+        self.assertEqual(4, len(histogram))
+        self.assertEqual(1, histogram[-1])
+        histogram.add_many([0.2, 1.5])
+        self.assertEqual(6, len(histogram))
+        self.assertAlmostEqual(1.5, histogram.xn)
+        np.testing.assert_array_equal([1,0,0,1,0,1], histogram.h)
+
+    def test_merge(self):
+        histogram1 = Histogram(n = 4, x0 = 0, xn = 1)
+        histogram1.add_many([0.1, 0.3, 0.6])
+        histogram2 = Histogram(n = 4, x0 = 0.5, xn = 1.5)
+        histogram2.add_many([0.6, 1.4])
+        histogram1.merge(histogram2)
+        self.assertAlmostEqual(1.5, histogram1.xn)
+        np.testing.assert_array_equal([1,1,2,0,0,1], histogram1.h)
+        with self.assertRaises(ValueError):
+            histogram1.merge(Histogram(n = 3, x0 = 0, xn = 1))
+
+    def test_create(self):
+        self.assertEqual(5, len(Histogram.create(bins = 5)))
+        self.assertEqual(10, len(Histogram.create(bins = 'sqrt', x0 = -1, xn = 1, n_samples = 100)))
+
+    def test_save_load(self):
+        self.histogram.add_many([0.05, 0.95, 0.95])
+        with TemporaryDirectory() as folder:
+            np.savez(f'{folder}/test.npz', **self.histogram.save('X'))
+            with np.load(f'{folder}/test.npz') as npzfile:
+                histogram = Histogram.load(npzfile, 'X')
+        np.testing.assert_array_equal(self.histogram.h, histogram.h)
+        np.testing.assert_array_equal(self.histogram.get_edges(), histogram.get_edges())
+
 if __name__ =='__main__':
     main()
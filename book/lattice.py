@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2025 Simon Crase
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+    Lattices used to seed configurations of disks and spheres, shared by md.py and geometry.py
+'''
+
+from itertools import product
+from math import gamma
+from unittest import TestCase, main
+import numpy as np
+
+class Lattice:
+    '''
+    Unit cells used to seed configurations: each is described by the shape of a
+    conventional cell (as a multiple of the lattice spacing), the positions of sites
+    as fractions of the cell, and the distance between nearest neighbours.
+    '''
+    SC = 'sc'
+    HEX = 'hex'
+    BCC = 'bcc'
+    FCC = 'fcc'
+
+    @staticmethod
+    def get_cell(lattice = 'sc', d = 2):
+        '''
+        Describe the unit cell of a lattice
+
+        Parameters:
+            lattice   Lattice.SC (square for d=2, simple cubic for d=3), Lattice.HEX (d=2 only),
+                      Lattice.BCC or Lattice.FCC (d=3 only)
+            d         Dimension of space
+
+        Returns:
+            cell, basis, nearest: shape of cell, sites within cell, and distance between nearest neighbours
+        '''
+        match lattice, d:
+            case Lattice.SC, _:
+                return np.ones((d)), np.zeros((1,d)), 1.0
+            case Lattice.HEX, 2:
+                return np.array([1, np.sqrt(3)]), np.array([[0,0], [0.5,0.5]]), 1.0
+            case Lattice.BCC, 3:
+                return np.ones((3)), np.array([[0,0,0], [0.5,0.5,0.5]]), np.sqrt(0.75)
+            case Lattice.FCC, 3:
+                return np.ones((3)), np.array([[0,0,0], [0.5,0.5,0], [0.5,0,0.5], [0,0.5,0.5]]), np.sqrt(0.5)
+        raise ValueError(f'Lattice {lattice} is not supported for d={d}')
+
+    @staticmethod
+    def get_packing_fraction(lattice = 'sc', d = 2):
+        '''
+        Fraction of space occupied when spheres on neighbouring sites touch
+        '''
+        cell,basis,nearest = Lattice.get_cell(lattice, d)
+        return len(basis) * np.pi**(d/2) / gamma(d/2 + 1) * (nearest/2)**d / np.prod(cell)
+
+    @staticmethod
+    def get_sites(a = 1.0, lattice = 'sc', d = 2, L = np.array([1,1]), sigma = 0.1):
+        '''
+        Find all sites of a lattice with specified spacing that lie in a box, at least sigma from every wall
+
+        Parameters:
+            a         Lattice spacing
+            lattice   Lattice.SC, Lattice.HEX, Lattice.BCC, or Lattice.FCC
+            d         Dimension of space
+            L         Lengths of all sides
+            sigma     Radius of sphere
+        '''
+        cell,basis,_ = Lattice.get_cell(lattice, d)
+        m = np.floor((L - 2*sigma)/(a*cell)).astype(int) + 1
+        origins = np.stack(np.meshgrid(*[np.arange(k) for k in m], indexing = 'ij'), axis = -1).reshape(-1,d)
+        sites = (sigma + a * (origins[:,np.newaxis,:] + basis[np.newaxis,:,:]) * cell).reshape(-1,d)
+        return sites[np.all(sites <= L - sigma, axis = 1)]
+
+class TestLattice(TestCase):
+    '''
+    Tests for Lattice
+    '''
+    def test_packing_fraction(self):
+        self.assertAlmostEqual(np.pi/4, Lattice.get_packing_fraction(Lattice.SC, 2))
+        self.assertAlmostEqual(np.pi*np.sqrt(3)/6, Lattice.get_packing_fraction(Lattice.HEX, 2))
+        self.assertAlmostEqual(np.pi/6, Lattice.get_packing_fraction(Lattice.SC, 3))
+        self.assertAlmostEqual(np.pi*np.sqrt(3)/8, Lattice.get_packing_fraction(Lattice.BCC, 3))
+        self.assertAlmostEqual(np.pi*np.sqrt(2)/6, Lattice.get_packing_fraction(Lattice.FCC, 3))
+        with self.assertRaises(ValueError):
+            Lattice.get_cell(Lattice.FCC, 2)
+
+    def test_nearest(self):
+        '''
+        Verify the distance between nearest neighbours by generating neighbouring cells
+        '''
+        for lattice,d in [(Lattice.SC,2), (Lattice.HEX,2), (Lattice.SC,3), (Lattice.BCC,3), (Lattice.FCC,3)]:
+            cell,basis,nearest = Lattice.get_cell(lattice, d)
+            offsets = np.array(list(product([-1,0,1], repeat = d)))
+            sites = ((offsets[:,np.newaxis,:] + basis) * cell).reshape(-1,d)
+            distances = np.linalg.norm(sites - basis[0] * cell, axis = 1)
+            self.assertAlmostEqual(nearest, distances[distances > 0].min())
+
+if __name__=='__main__':
+    main()
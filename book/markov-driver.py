@@ -25,7 +25,7 @@ from time import time
 import numpy as np
 from matplotlib import rc
 from matplotlib.pyplot import figure, show
-from markov_ising import MarkovIsing
+from markov_ising import MarkovIsing, CheckerboardIsing, MultiSpinIsing
 
 def parse_arguments():
     parser = ArgumentParser(__doc__)
@@ -35,6 +35,10 @@ def parse_arguments():
     parser.add_argument('--Nsteps', type = int, default = 10000, help = 'Number of steps')
     parser.add_argument('--Nburn', type = int, default = 0, help = 'Number of steps for burn in')
     parser.add_argument('--Niterations', type = int, default = 5, help = 'Number of iterations of Markov chain')
+    parser.add_argument('--checkerboard', default=False, action = 'store_true',
+                        help = 'Update spins in checkerboard sweeps: Nsteps and Nburn count sweeps instead of steps')
+    parser.add_argument('--multispin', default=False, action = 'store_true',
+                        help = 'Run 64 replicas in checkerboard sweeps using multi-spin coding, and pool their statistics')
     parser.add_argument('-f', '--frequency',type = int, default = 100, help = 'How often to report progress')
     parser.add_argument('-T', '--T', default=[1000], nargs='+', type=float, help = 'Range for temperature: [start, ]stop, [step, ]')
     parser.add_argument('--seed',type=int,default=None,help='Seed for random number generator')
@@ -105,6 +109,14 @@ def get_burn_in(Nburn):
         case _:
             return f'after a burn in of {Nburn} steps'
 
+def get_trials_per_step(args):
+    '''
+    Number of attempted flips for each step counted by Nsteps
+    '''
+    if args.multispin:
+        return MultiSpinIsing.R*args.m*args.n
+    return args.m*args.n if args.checkerboard else 1
+
 if __name__=='__main__':
     rc('font',**{'family':'serif','serif':['Palatino']})
     rc('text', usetex=True)
@@ -113,13 +125,14 @@ if __name__=='__main__':
 
     rng = np.random.default_rng(args.seed)
     T_range = get_range(args.T)
+    Engine = MultiSpinIsing if args.multispin else CheckerboardIsing if args.checkerboard else MarkovIsing
 
     for j,T in enumerate(T_range):
-        markov = MarkovIsing(rng=rng,
-                             shape=(args.m,args.n),
-                             periodic=args.periodic,
-                             Niterations=args.Niterations,
-                             beta=1/T)
+        markov = Engine(rng=rng,
+                        shape=(args.m,args.n),
+                        periodic=args.periodic,
+                        Niterations=args.Niterations,
+                        beta=1/T)
         accepted = 0
         for i in range(args.Niterations):
             markov.run(Nsteps=args.Nsteps,Nburn=args.Nburn,frequency=args.frequency,iteration=i)
@@ -128,7 +141,7 @@ if __name__=='__main__':
         Es,means, stds,M,magnetization = markov.get_stats()
         fig = figure(figsize=(12,12))
         fig.suptitle(fr'{get_boundary_conditions(args.periodic)}, ' +
-                     fr'{args.m}$\times${args.n} sites, T={T}, accepted={accepted/(args.Niterations*args.Nsteps)} ')
+                     fr'{args.m}$\times${args.n} sites, T={T}, accepted={accepted/(args.Niterations*args.Nsteps*get_trials_per_step(args))} ')
 
         ax1 = fig.add_subplot(2,1,1)
         ax1.bar(Es,get_scaled_means(means,m=args.m,n=args.n),color='blue')
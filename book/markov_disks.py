@@ -24,18 +24,22 @@ from os.path import  exists
 from shutil import copyfile
 from unittest import TestCase,main
 import numpy as np
+from itertools import product
 from numpy.random import default_rng
-from geometry import GeometryFactory
+from geometry import GeometryFactory, Structure
 
 def markov_disks(X, rng = default_rng(), delta = np.array([0.01,0.01]), geometry = GeometryFactory()):
     '''
-    Algorithm 2.9. Generating a hard disk configuration from an earlier valid configuration using MCMC
+    Algorithm 2.9. Generating a hard disk configuration from an earlier valid configuration using MCMC.
+    The geometry keeps an index of which disks lie near each other, so only nearby disks need to be
+    checked for overlaps. The index is rebuilt whenever it was not built from X itself, or no longer
+    agrees with the position of the disk that is to move, so a chain should keep updating the same array.
 
     Parameters:
-        X
-        rng
-        delta
-        geometry
+        X          Centres of disks
+        rng        Random number generator
+        delta      Maximum displacement along each axis
+        geometry   Box or Torus
 
     Returns:
         k,X, where
@@ -51,35 +55,189 @@ def markov_disks(X, rng = default_rng(), delta = np.array([0.01,0.01]), geometry
         '''
         if not geometry.is_within_bounds(X_proposed): return False
 
-        for i in range(N):
-            if i != k and geometry.get_distance(X[i,:],X_proposed) < 2*geometry.sigma:
+        for i in geometry.get_neighbours(X_proposed, k):
+            if geometry.get_distance(X[i,:],X_proposed) < 2*geometry.sigma:
                 return False
 
         return True
 
     N,d = X.shape
     k = rng.integers(0,high=N)
+    if not geometry.is_indexed(X, k):
+        geometry.create_index(X)
     Delta = -delta + 2* delta*rng.random(size=d)
     X_proposed = geometry.move_to(X[k,:]+Delta)
     if can_move(k,X_proposed):
         X[k,:] = X_proposed
+        geometry.update_index(k,X_proposed)
         return k,X
     else:
         return -1,X
 
 
+def checkerboard_sweep(X, rng = default_rng(), delta = np.array([0.01,0.01]), geometry = GeometryFactory()):
+    '''
+    Move every disk once, using a checkerboard of cells so that many disks can be moved at the same time.
+
+    The space is divided into cells at least 2*sigma + 2*delta wide, and the grid is shifted by a random
+    offset for each sweep. Cells are coloured like a checkerboard, and the colours are visited in random
+    order. A disk may only move within its own cell, so disks in different cells of the same colour can
+    never touch: one disk from each active cell is moved at the same time, and the overlap test only
+    needs to check disks in the same and adjacent cells.
+
+    Parameters:
+        X          Centres of disks, updated in place
+        rng        Random number generator
+        delta      Maximum displacement along each axis
+        geometry   Box or Torus
+
+    Returns:
+        Number of moves that were accepted
+    '''
+    N,d = X.shape
+    delta = np.broadcast_to(delta, (d,))
+    L = np.asarray(geometry.L, dtype = float)
+    m = np.floor(L / (2*geometry.sigma + 2*delta)).astype(int)
+    if geometry.periodic:
+        m -= m % 2                                       # An even number of cells, so colours alternate across the boundary
+        if any(m < 2):
+            raise ValueError(f'Torus {L} is too small for a checkerboard with sigma={geometry.sigma}, delta={delta}')
+        w = L / m
+        origin = rng.random(d) * w
+        shape = m
+    else:
+        m = np.maximum(m, 1)
+        w = L / m
+        origin = (rng.random(d) - 1) * w                 # Shifted grid has an extra, partial, cell along each axis
+        shape = m + 1
+
+    def get_cells(Y):
+        '''Find the cell containing each point'''
+        C = np.floor((Y - origin) / w).astype(int)
+        return C % shape if geometry.periodic else C
+
+    C = get_cells(X)
+    cell_ids = np.ravel_multi_index(C.T, shape)
+    n_cells = int(np.prod(shape))
+    order = np.lexsort((rng.random(N), cell_ids))        # Disks grouped by cell, in random order within each cell
+    first = np.searchsorted(cell_ids[order], np.arange(n_cells))
+    rank = np.empty((N), dtype = int)
+    rank[order] = np.arange(N) - first[cell_ids[order]]
+    occupancy = np.bincount(cell_ids, minlength = n_cells)
+    contents = np.full((n_cells + 1, max(occupancy.max(), 1)), -1)    # Last row is an empty cell, used outside box
+    contents[cell_ids[order], rank[order]] = order
+
+    offsets = np.array(list(product([-1,0,1], repeat = d)))
+    colours = (C % 2) @ (2 ** np.arange(d))
+    n_accepted = 0
+    for colour in rng.permutation(2**d):
+        active = colours == colour
+        for r in range(occupancy.max()):
+            movers = np.flatnonzero(active & (rank == r))
+            if len(movers) == 0: continue
+            X_proposed = geometry.move_to(X[movers] + delta * (2*rng.random((len(movers),d)) - 1))
+            accepted = np.all(get_cells(X_proposed) == C[movers], axis = 1)
+            if not geometry.periodic:
+                accepted &= np.all((geometry.LowerBound <= X_proposed) & (X_proposed <= geometry.UpperBound), axis = 1)
+            adjacent = C[movers][:,np.newaxis,:] + offsets
+            if geometry.periodic:
+                adjacent_ids = np.ravel_multi_index(np.moveaxis(adjacent % shape, -1, 0), shape)
+            else:
+                inside = np.all((adjacent >= 0) & (adjacent < shape), axis = -1)
+                adjacent_ids = np.where(inside, np.ravel_multi_index(np.moveaxis(np.clip(adjacent, 0, shape - 1), -1, 0), shape), n_cells)
+            neighbours = contents[adjacent_ids].reshape(len(movers), -1)
+            Delta = geometry.get_differences(X[neighbours], X_proposed[:,np.newaxis,:])
+            overlaps = (np.einsum('ijk,ijk->ij', Delta, Delta) < 4*geometry.sigma**2) & (neighbours >= 0) & (neighbours != movers[:,np.newaxis])
+            accepted &= ~np.any(overlaps, axis = 1)
+            X[movers[accepted]] = X_proposed[accepted]
+            n_accepted += np.count_nonzero(accepted)
+
+    geometry.index = None          # Any index used by markov_disks is now out of date
+    return n_accepted
+
+class StepSizeController:
+    '''
+    Adjust the maximum displacement during burn in, so that the acceptance rate approaches a target.
+    Acceptance is counted over windows of trials: after each window, delta is multiplied by the ratio
+    of the observed rate to the target (limited to a factor of 2 either way), then limited to a maximum
+    for each axis. Once freeze() has been called, delta no longer changes, so the chain used for
+    measurement satisfies detailed balance.
+
+    Attributes:
+        delta       Maximum displacement along each axis
+        target      Target acceptance rate
+        window      Number of trials in each window
+        upper       Largest value allowed for delta along each axis
+        trace       Acceptance rate, followed by delta, for each window
+        frozen      Indicates that delta is no longer to be changed
+    '''
+    def __init__(self, delta = np.array([0.01,0.01]), target = 0.5, window = 100, upper = np.array([0.5,0.5]), trace = []):
+        '''
+        Parameters:
+            delta       Initial maximum displacement along each axis
+            target      Target acceptance rate
+            window      Number of trials in each window
+            upper       Largest value allowed for delta along each axis, e.g. half the side of a torus
+            trace       Trace from an earlier run, to be extended
+        '''
+        self.delta = np.array(delta, dtype = float)
+        self.target = target
+        self.window = window
+        self.upper = np.broadcast_to(upper, self.delta.shape)
+        self.trace = [list(row) for row in trace]
+        self.frozen = False
+        self.n_trials = 0
+        self.n_accepted = 0
+
+    def record(self, n_accepted, n_trials = 1):
+        '''
+        Record the outcome of some trials, and adjust delta at the end of each window
+
+        Parameters:
+            n_accepted   Number of trials that were accepted
+            n_trials     Number of trials
+        '''
+        if self.frozen: return
+        self.n_accepted += n_accepted
+        self.n_trials += n_trials
+        if self.n_trials < self.window: return
+        rate = self.n_accepted / self.n_trials
+        self.delta = np.minimum(self.delta * np.clip(rate / self.target, 0.5, 2.0), self.upper)
+        self.trace.append([rate] + list(self.delta))
+        self.n_trials = 0
+        self.n_accepted = 0
+
+    def freeze(self):
+        '''
+        Stop adjusting delta
+
+        Returns:
+            Final value of delta
+        '''
+        self.frozen = True
+        return self.delta
+
+    def get_trace(self):
+        '''
+        Acceptance rate and delta for each window, as an array with one row for each window
+        '''
+        return np.array(self.trace).reshape(-1, 1 + len(self.delta))
+
 class Checkpointer:
     '''
-    Used to save a configuration to a checkpoint, and restore from saved checkpoint
+    Used to save a configuration to a checkpoint, and restore from saved checkpoint,
+    together with any structural accumulators attached to the geometry
     '''
     def __init__(self,file='check'):
         self.path = f'{file}.npz'
         self.backup = f'{self.path}~'
 
-    def load(self):
-        with load(self.path) as data:
+    def load(self, geometry = None):
+        with np.load(self.path) as data:
             X = data['X']
             HistogramBins = data['HistogramBins']
+            if geometry != None:
+                geometry.structure = Structure.load(data, d = X.shape[1])
             return X,HistogramBins
 
     def save(self, X = [], geometry = None):
@@ -88,8 +246,106 @@ class Checkpointer:
             copyfile(self.path,self.backup)
 
         np.savez(self.path,
-              X = X, HistogramBins = geometry.HistogramBins)
+              X = X, HistogramBins = geometry.HistogramBins,
+              **(geometry.structure.save() if geometry.structure != None else {}))
+
+class TestMarkovDisks(TestCase):
+    '''
+    Verify that using the index to find nearby disks gives the same chain as checking every disk
+    '''
+    def run_chain(self, geometry, X, n = 2000, seed = 13):
+        rng = default_rng(seed)
+        Xs = []
+        for _ in range(n):
+            k,X = markov_disks(X, rng = rng, delta = np.array([0.05,0.05]), geometry = geometry)
+            Xs.append(X.copy())
+        return np.array(Xs)
+
+    def test_new_configuration(self):
+        '''
+        Starting a chain from a different configuration with the same number of disks must not reuse the index
+        '''
+        geometry = GeometryFactory(periodic = True, L = np.array([1,1]), sigma = 0.05, d = 2)
+        A = geometry.create_configuration(N = 60)
+        rng = default_rng(17)
+        markov_disks(A, rng = rng, delta = np.array([0.05,0.05]), geometry = geometry)
+        X = (A + 0.37) % 1
+        for _ in range(20000):
+            _,X = markov_disks(X, rng = rng, delta = np.array([0.05,0.05]), geometry = geometry)
+        self.assertGreaterEqual(geometry.get_distances(X).min(), 2*geometry.sigma)
+
+    def test_index(self):
+        for periodic in [False,True]:
+            geometry = GeometryFactory(periodic = periodic, L = np.array([1,1]), sigma = 0.04, d = 2)
+            X0 = geometry.create_configuration(N = 100)
+            Xs = self.run_chain(geometry, X0.copy())
+
+            rng = default_rng(13)
+            X = X0.copy()
+            for i in range(len(Xs)):
+                N,d = X.shape
+                k = rng.integers(0,high=N)
+                Delta = -0.05 + 0.1*rng.random(size=d)
+                X_proposed = geometry.move_to(X[k,:]+Delta)
+                if (geometry.is_within_bounds(X_proposed) and
+                    all(geometry.get_distance(X[j,:],X_proposed) >= 2*geometry.sigma for j in range(N) if j != k)):
+                    X[k,:] = X_proposed
+                np.testing.assert_array_equal(X, Xs[i])
+            for k,cell in geometry.index.cell_of.items():
+                self.assertEqual(geometry.index.get_cell(X[k]), cell)
+
+class TestCheckerboard(TestCase):
+    '''
+    Tests for checkerboard_sweep
+    '''
+    def test_valid(self):
+        for periodic in [False,True]:
+            geometry = GeometryFactory(periodic = periodic, L = np.array([1,1]), d = 2)
+            geometry.set_sigma(eta = 0.5, N = 200)
+            X = geometry.create_configuration(N = 200)
+            rng = default_rng(37)
+            n_accepted = sum(checkerboard_sweep(X, rng = rng, delta = np.array([0.01,0.01]), geometry = geometry) for _ in range(20))
+            self.assertGreater(n_accepted, 0)
+            self.assertLessEqual(n_accepted, 20*200)
+            self.assertGreaterEqual(geometry.get_distances(X).min(), 2*geometry.sigma)
+            self.assertTrue(all(geometry.is_within_bounds(x) for x in X))
+
+    def test_three_dimensions(self):
+        geometry = GeometryFactory(periodic = True, L = np.array([1,1,1]), sigma = 0.05, d = 3)
+        X = geometry.direct_disks(N = 30, rng = default_rng(41), K = 64)
+        checkerboard_sweep(X, rng = default_rng(43), delta = np.array([0.05,0.05,0.05]), geometry = geometry)
+        self.assertGreaterEqual(geometry.get_distances(X).min(), 2*geometry.sigma)
+
+class TestStepSizeController(TestCase):
+    '''
+    Tests for StepSizeController
+    '''
+    def test_target(self):
+        geometry = GeometryFactory(periodic = True, L = np.array([1,1]), d = 2)
+        geometry.set_sigma(eta = 0.4, N = 64)
+        X = geometry.create_configuration(N = 64)
+        rng = default_rng(53)
+        controller = StepSizeController(delta = np.array([0.5,0.5]), target = 0.4, window = 200, upper = 0.5*geometry.L)
+        for _ in range(10000):
+            k,X = markov_disks(X, rng = rng, delta = controller.delta, geometry = geometry)
+            controller.record(1 if k > -1 else 0)
+        delta = controller.freeze().copy()
+        self.assertEqual((50,3), controller.get_trace().shape)
+        n_accepted = 0
+        for _ in range(10000):
+            k,X = markov_disks(X, rng = rng, delta = delta, geometry = geometry)
+            controller.record(1 if k > -1 else 0)
+            if k > -1:
+                n_accepted += 1
+        self.assertAlmostEqual(0.4, n_accepted/10000, delta = 0.05)
+        np.testing.assert_array_equal(delta, controller.delta)
+        self.assertEqual(50, len(controller.trace))
 
+    def test_upper(self):
+        controller = StepSizeController(delta = np.array([0.1,0.2]), target = 0.5, window = 10, upper = np.array([0.15,0.25]))
+        controller.record(10, n_trials = 10)
+        np.testing.assert_array_equal([0.15,0.25], controller.delta)
+        np.testing.assert_array_equal([[1.0,0.15,0.25]], controller.get_trace())
 
 if __name__=='__main__':
     main()
@@ -22,7 +22,7 @@ from enum import Enum
 from unittest import TestCase, main
 import numpy as np
 from ising import Nbr,get_energy_magnetism,get_max_neighbours,Neighbours
-from enumerate_ising import get_initial_energy
+from enumerate_ising import get_initial_energy, get_exact_averages
 
 class Datum(Enum):
     '''
@@ -78,7 +78,7 @@ class IsingData:
         E = self.energies[iteration,non_zero,0]
         N = np.zeros_like(E)
         for i in range(len(E)):
-            mask = np.in1d(self.energies[iteration,:,0],E[i])
+            mask = np.isin(self.energies[iteration,:,0],E[i])
             N[i] = self.energies[iteration,mask,1].sum()
         return E,N
 
@@ -100,6 +100,15 @@ class Weights:
         '''
         return self.cache[deltaE//2-1] if deltaE > 0 else np.inf
 
+    def get_upsilons(self,deltaE):
+        '''
+        Used to decide whether to accept many proposed moves at once.
+
+        Parameters:
+            deltaE   Array of changes in energy
+        '''
+        return np.where(deltaE > 0, self.cache[np.maximum(deltaE//2-1,0)], np.inf)
+
 class MarkovIsing:
     '''
     This class uses Markov Chain Monte Carlo (MCMC) to sample an Ising Model
@@ -195,6 +204,291 @@ class MarkovIsing:
         '''
         return self.data.get_stats()
 
+class CheckerboardIsing(MarkovIsing):
+    '''
+    This class performs Metropolis sweeps, updating every site of one colour at once.
+    Spins are stored as an (m,n) array, and no two neighbours share a colour, so the local field
+    at every site of one colour can be calculated from the other colours in a single step.
+    Normally there are two colours, like a checkerboard; but with periodic boundary conditions
+    a side with an odd number of sites wraps round onto a site of the same colour, so the last row
+    or column is given colours of its own.
+
+    Attributes:
+        colours        Colour of each site
+    '''
+    def __init__(self,rng=np.random.default_rng(),shape=(4,5),periodic=False,Niterations=5,beta=0.001):
+        super().__init__(rng=rng,shape=shape,periodic=periodic,Niterations=Niterations,beta=beta)
+        def get_labels(size):
+            labels = np.arange(size) % 2
+            if periodic and size % 2 == 1 and size > 1:
+                labels[-1] = 2
+            return labels
+        I,J = np.meshgrid(get_labels(self.m),get_labels(self.n),indexing='ij')
+        self.colours = np.where((I < 2) & (J < 2), (I + J) % 2, 2 + I + 3*J)
+
+    def get_fields(self,sigma):
+        '''
+        Calculate the sum of the neighbouring spins for every site
+
+        Parameters:
+            sigma     Spins, an (m,n) array
+        '''
+        if self.periodic:
+            return (np.roll(sigma,1,axis=0) + np.roll(sigma,-1,axis=0) +
+                    np.roll(sigma,1,axis=1) + np.roll(sigma,-1,axis=1))
+        padded = np.pad(sigma,1)
+        return padded[:-2,1:-1] + padded[2:,1:-1] + padded[1:-1,:-2] + padded[1:-1,2:]
+
+    def get_energy_magnetism(self,sigma):
+        '''
+        Calculate energy and magnetization for a configuration, counting edges in the same way as ising.get_energy_magnetism
+
+        Parameters:
+            sigma     Spins, an (m,n) array
+        '''
+        return -int((sigma.astype(int) * self.get_fields(sigma)).sum())//2, int(sigma.sum(dtype=int))
+
+    def sweep(self,sigma,E,M):
+        '''
+        Attempt to flip every spin once, one colour at a time
+
+        Parameters:
+            sigma     Spins before sweep, an (m,n) array of int8, updated in place
+            E         Energy before sweep
+            M         Magnetization before sweep
+
+        Returns:
+            sigma     Spins after sweep
+            E         Energy after sweep
+            M         Magnetization after sweep
+        '''
+        for colour in np.unique(self.colours):
+            active = self.colours == colour
+            deltaE = 2 * sigma[active].astype(int) * self.get_fields(sigma)[active]
+            accepted = self.rng.random(size=len(deltaE)) < self.weights.get_upsilons(deltaE)
+            flips = np.zeros_like(active)
+            flips[active] = accepted
+            M -= 2*int(sigma[flips].sum(dtype=int))
+            E += int(deltaE[accepted].sum())
+            sigma[flips] *= -1
+            self.accepted_moves += int(accepted.sum())
+        return sigma,E,M
+
+    def run(self,Nsteps=100000,Nburn=100,frequency=10000,iteration=0):
+        '''
+        Initialize configuration and carry out a specified number of sweeps,
+        recording energy and magnetization after each sweep
+
+        Parameters:
+             Nsteps     Number of sweeps to be performed and recorded
+             Nburn      Number of sweeps to be performed at start and not recorded
+             frequency  Report to user after this many sweeps
+             iteration  Iteration number: used for storing data and reporting
+        '''
+        self.accepted_moves = 0
+        sigma = self.rng.choice(np.array([-1,1],dtype=np.int8),size=(self.m,self.n))
+        E,M = self.get_energy_magnetism(sigma)
+        Ns = np.zeros((4*self.N+1),dtype=np.int64)
+        NMs = np.zeros((2*self.N+1),dtype=np.int64)
+
+        for i in range(Nsteps + Nburn):
+            sigma,E,M = self.sweep(sigma,E,M)
+            if i < Nburn: continue
+            Ns[E + 2*self.N] += 1
+            NMs[M + self.N] += 1
+            if frequency > 0 and i%frequency == 0 and i > 0:
+                print (f'Iteration {iteration}, sweep {i}')
+
+        self.data.store_data(table=Datum.ENERGY,iteration=iteration,
+                             Ns={int(k) - 2*self.N : int(Ns[k]) for k in np.flatnonzero(Ns)})
+        self.data.store_data(table=Datum.MAGNETIZATION,iteration=iteration,
+                             Ns={int(k) - self.N : int(NMs[k]) for k in np.flatnonzero(NMs)})
+
+class MultiSpinIsing(CheckerboardIsing):
+    '''
+    This class runs 64 independent replicas at once, using multi-spin coding: each site is
+    represented by a 64 bit word, with one bit for each replica (1 for spin down). Sites of one
+    colour are updated together, as for CheckerboardIsing, using bitwise logic to count the
+    neighbours that oppose each spin, and to compare random numbers with the Metropolis weights,
+    so every replica has its own random numbers. Energies and magnetizations of all replicas are
+    pooled in the same histograms.
+
+    Attributes:
+        K              Number of random bits used to compare with each weight
+        groups         For each colour, the sites of that colour, grouped by number of neighbours
+        thresholds     Bits of weights, indexed by number of neighbours and number of opposing neighbours
+    '''
+    R = 64
+
+    def __init__(self,rng=np.random.default_rng(),shape=(4,5),periodic=False,Niterations=5,beta=0.001,K=32):
+        super().__init__(rng=rng,shape=shape,periodic=periodic,Niterations=Niterations,beta=beta)
+        self.K = K
+        z = self.get_fields(np.ones((self.m,self.n),dtype=int))
+        self.groups = [[(z_value,np.flatnonzero((self.colours == colour) & (z == z_value)))
+                        for z_value in np.unique(z[self.colours == colour])]
+                       for colour in np.unique(self.colours)]
+        self.thresholds = {}
+        for z_value in np.unique(z):
+            for a in range(z_value + 1):
+                deltaE = 2*(z_value - 2*a)
+                if deltaE > 0:
+                    p = int(self.weights.get_upsilon(deltaE) * 2**K)
+                    self.thresholds[(int(z_value),a)] = [(p >> (K - 1 - i)) & 1 for i in range(K)]
+        if periodic:
+            self.bonds = [(np.arange(self.N), np.roll(np.arange(self.N).reshape(self.m,self.n),-1,axis=axis).ravel())
+                          for axis in [0,1]]
+        else:
+            sites = np.arange(self.N).reshape(self.m,self.n)
+            self.bonds = [(sites[:-1,:].ravel(), sites[1:,:].ravel()), (sites[:,:-1].ravel(), sites[:,1:].ravel())]
+
+    def get_random_words(self,size):
+        '''
+        Generate words whose bits are independent and uniformly distributed
+
+        Parameters:
+            size   Number of words
+        '''
+        return np.frombuffer(self.rng.bytes(8*size),dtype=np.uint64)
+
+    def get_less_than(self,U,bits):
+        '''
+        For each replica, compare a K bit random number with a weight
+
+        Parameters:
+            U      Random numbers: a (K,n) array, whose rows are successive bits, most significant first
+            bits   Bits of weight, most significant first
+
+        Returns:
+            Words with bits set for replicas whose random numbers are less than the weight
+        '''
+        less = np.zeros(U.shape[1],dtype=np.uint64)
+        equal = np.full(U.shape[1],np.iinfo(np.uint64).max,dtype=np.uint64)
+        for i,bit in enumerate(bits):
+            if bit:
+                less |= equal & ~U[i]
+                equal &= U[i]
+            else:
+                equal &= ~U[i]
+        return less
+
+    @staticmethod
+    def get_count(words):
+        '''
+        Count set bits for each replica, without separating replicas: the result is a sequence of
+        words, the first holding the least significant bit of each count
+
+        Parameters:
+            words    Sequence of arrays of words
+        '''
+        planes = [np.zeros_like(words[0]) for _ in range(3)]
+        for x in words:
+            carry = x
+            for i in range(len(planes)):
+                planes[i],carry = planes[i] ^ carry, planes[i] & carry
+        return planes
+
+    @staticmethod
+    def get_equal(planes,a):
+        '''
+        Find replicas for which a count has a specified value
+
+        Parameters:
+            planes   Count, as returned by get_count
+            a        Value to be matched
+        '''
+        result = ~np.zeros_like(planes[0])
+        for i,plane in enumerate(planes):
+            result &= plane if (a >> i) & 1 else ~plane
+        return result
+
+    @staticmethod
+    def get_lanes(words):
+        '''
+        Separate the bits of each word
+
+        Parameters:
+            words    Array of words
+
+        Returns:
+            An array with an extra axis, of length 64, containing 0 or 1 for each replica
+        '''
+        return np.unpackbits(words.view(np.uint8).reshape(words.shape + (8,)),axis=-1,bitorder='little')
+
+    def get_energy_magnetism(self,words):
+        '''
+        Calculate energy and magnetization of every replica
+
+        Parameters:
+            words    Spins: one word for each site
+
+        Returns:
+            E, M: arrays with one entry for each replica
+        '''
+        down = MultiSpinIsing.get_lanes(words).sum(axis=0,dtype=np.int64)
+        n_bonds = sum(len(i) for i,_ in self.bonds)
+        opposed = sum(MultiSpinIsing.get_lanes(words[i] ^ words[j]).sum(axis=0,dtype=np.int64) for i,j in self.bonds)
+        return 2*opposed - n_bonds, self.N - 2*down
+
+    def get_replicas(self,words):
+        '''
+        Convert words to spins
+
+        Returns:
+            An array of shape (64,m,n), containing spins for each replica
+        '''
+        return (1 - 2*MultiSpinIsing.get_lanes(words).T.astype(np.int8)).reshape(self.R,self.m,self.n)
+
+    def sweep(self,words):
+        '''
+        Attempt to flip every spin of every replica once, one colour at a time
+
+        Parameters:
+            words    Spins: one word for each site, updated in place
+        '''
+        for groups in self.groups:
+            for z,sites in groups:
+                neighbours = self.neighbours[sites,0:z]
+                planes = MultiSpinIsing.get_count([words[sites] ^ words[neighbours[:,k]] for k in range(z)])
+                U = self.get_random_words(self.K*len(sites)).reshape(self.K,len(sites))
+                flip = np.zeros(len(sites),dtype=np.uint64)
+                for a in range(z + 1):
+                    if (z,a) in self.thresholds:
+                        flip |= MultiSpinIsing.get_equal(planes,a) & self.get_less_than(U,self.thresholds[(z,a)])
+                    else:
+                        flip |= MultiSpinIsing.get_equal(planes,a)
+                words[sites] ^= flip
+                self.accepted_moves += int(MultiSpinIsing.get_lanes(flip).sum())
+        return words
+
+    def run(self,Nsteps=100000,Nburn=100,frequency=10000,iteration=0):
+        '''
+        Initialize 64 replicas and carry out a specified number of sweeps, recording energy and
+        magnetization of every replica after each sweep
+
+        Parameters:
+             Nsteps     Number of sweeps to be performed and recorded
+             Nburn      Number of sweeps to be performed at start and not recorded
+             frequency  Report to user after this many sweeps
+             iteration  Iteration number: used for storing data and reporting
+        '''
+        self.accepted_moves = 0
+        words = self.get_random_words(self.N).copy()
+        Ns = np.zeros((4*self.N+1),dtype=np.int64)
+        NMs = np.zeros((2*self.N+1),dtype=np.int64)
+
+        for i in range(Nsteps + Nburn):
+            words = self.sweep(words)
+            if i < Nburn: continue
+            E,M = self.get_energy_magnetism(words)
+            Ns += np.bincount(E + 2*self.N,minlength=len(Ns))
+            NMs += np.bincount(M + self.N,minlength=len(NMs))
+            if frequency > 0 and i%frequency == 0 and i > 0:
+                print (f'Iteration {iteration}, sweep {i}')
+
+        self.data.store_data(table=Datum.ENERGY,iteration=iteration,
+                             Ns={int(k) - 2*self.N : int(Ns[k]) for k in np.flatnonzero(Ns)})
+        self.data.store_data(table=Datum.MAGNETIZATION,iteration=iteration,
+                             Ns={int(k) - self.N : int(NMs[k]) for k in np.flatnonzero(NMs)})
 
 class TestMarkov(TestCase):
     '''
@@ -220,5 +514,75 @@ class TestMarkov(TestCase):
         self.assertAlmostEqual(13568,normalized[8],delta=75)
         self.assertAlmostEqual(424,normalized[11],delta=15)
 
+class TestCheckerboard(TestCase):
+    '''
+    Verify that checkerboard sweeps sample the Boltzmann distribution, by comparison with enumeration
+    '''
+    def test_colours(self):
+        for shape in [(4,4),(3,5),(5,4),(3,3)]:
+            for periodic in [False,True]:
+                markov = CheckerboardIsing(shape=shape,periodic=periodic)
+                colours = markov.colours.ravel()
+                for k in range(markov.N):
+                    for j in Nbr(k,shape=shape,periodic=periodic):
+                        self.assertNotEqual(colours[k],colours[j])
+
+    def test_energy(self):
+        rng = np.random.default_rng(79)
+        for shape in [(4,4),(3,5),(2,3)]:
+            for periodic in [False,True]:
+                markov = CheckerboardIsing(shape=shape,periodic=periodic)
+                sigma = rng.choice(np.array([-1,1],dtype=np.int8),size=shape)
+                self.assertEqual(get_energy_magnetism(sigma.ravel(),shape=shape,periodic=periodic),
+                                 markov.get_energy_magnetism(sigma))
+
+    def test_boltzmann(self):
+        beta = 0.4
+        for shape,periodic in [((4,4),True),((3,5),True),((4,3),False)]:
+            markov = CheckerboardIsing(rng=np.random.default_rng(83),shape=shape,periodic=periodic,Niterations=1,beta=beta)
+            markov.run(Nsteps=8000,Nburn=100,frequency=0)
+            E = markov.data.energies[0,:,0]
+            N = markov.data.energies[0,:,1]
+            M = markov.data.magnetization[0,:,0]
+            NM = markov.data.magnetization[0,:,1]
+            mean_E,mean_M2,_ = get_exact_averages(shape,periodic=periodic,beta=beta)
+            self.assertAlmostEqual(mean_E,(E*N).sum()/N.sum(),delta=0.05*abs(mean_E))
+            self.assertAlmostEqual(mean_M2,(M**2*NM).sum()/NM.sum(),delta=0.05*mean_M2)
+            self.assertEqual(8000,N.sum())
+
+class TestMultiSpin(TestCase):
+    '''
+    Verify that multi-spin coding agrees with single spin calculations and with enumeration
+    '''
+    def test_energy(self):
+        for shape in [(4,4),(3,5)]:
+            for periodic in [False,True]:
+                markov = MultiSpinIsing(rng=np.random.default_rng(89),shape=shape,periodic=periodic)
+                words = markov.get_random_words(markov.N)
+                E,M = markov.get_energy_magnetism(words)
+                for r,sigma in enumerate(markov.get_replicas(words)):
+                    self.assertEqual(get_energy_magnetism(sigma.ravel(),shape=shape,periodic=periodic),(E[r],M[r]))
+
+    def test_less_than(self):
+        markov = MultiSpinIsing(rng=np.random.default_rng(97),K=16)
+        U = markov.get_random_words(16*1000).reshape(16,1000)
+        for p in [0.0, 0.1, 0.75]:
+            bits = [(int(p * 2**16) >> (15 - i)) & 1 for i in range(16)]
+            self.assertAlmostEqual(p,MultiSpinIsing.get_lanes(markov.get_less_than(U,bits)).mean(),delta=0.01)
+
+    def test_boltzmann(self):
+        beta = 0.4
+        for shape,periodic in [((4,4),True),((3,5),True),((4,3),False)]:
+            markov = MultiSpinIsing(rng=np.random.default_rng(101),shape=shape,periodic=periodic,Niterations=1,beta=beta)
+            markov.run(Nsteps=1000,Nburn=50,frequency=0)
+            E = markov.data.energies[0,:,0]
+            N = markov.data.energies[0,:,1]
+            M = markov.data.magnetization[0,:,0]
+            NM = markov.data.magnetization[0,:,1]
+            mean_E,mean_M2,_ = get_exact_averages(shape,periodic=periodic,beta=beta)
+            self.assertAlmostEqual(mean_E,(E*N).sum()/N.sum(),delta=0.05*abs(mean_E))
+            self.assertAlmostEqual(mean_M2,(M**2*NM).sum()/NM.sum(),delta=0.05*mean_M2)
+            self.assertEqual(64*1000,N.sum())
+
 if __name__=='__main__':
     main()
@@ -24,6 +24,7 @@ from matplotlib import rc
 from matplotlib.pyplot import figure, show
 import numpy as np
 from md import reload,get_path_to_config
+from trajectory import Trajectory
 from scipy.optimize import curve_fit
 
 def get_file_name(name,default_ext='png',seq=None):
@@ -55,8 +56,26 @@ def parse_arguments():
     parser.add_argument('--figs', default = './figs', help = 'Name of folder where plots are to be stored')
     parser.add_argument('--folder',default = 'configs', help= 'Folder to store config files')
     parser.add_argument('--bins', default='sqrt', type=get_bins, help = 'Binning strategy or number of bins')
+    parser.add_argument('--trajectory', default = None, help = 'Plot histograms from trajectory file (which may still be being written)')
     return parser.parse_args()
 
+def plot_trajectory(file_name,bins='sqrt'):
+    '''
+    Plot histograms of positions and velocities from a trajectory recorded by exercise_2_3.py.
+    The file is mapped into memory, and histograms are accumulated one chunk at a time.
+    '''
+    trajectory = Trajectory(file_name)
+    fig = figure(figsize = (12,12))
+    for i,(field,label) in enumerate([('X','$x$'),('Vx','$v_x$'),('V','$v$')]):
+        counts,edges = trajectory.get_histogram(field, bins = bins)
+        ax = fig.add_subplot(2,2,i+1)
+        ax.stairs(counts/counts.sum(),edges,color='blue')
+        ax.set_xlabel(label)
+        ax.set_ylabel('Frequency')
+    fig.suptitle(f'{file_name}: {len(trajectory):,} samples')
+    fig.tight_layout(h_pad=5,pad=2)
+    return fig
+
 
 
 def create_energies(Vs):
@@ -91,8 +110,13 @@ if __name__=='__main__':
     rc('text', usetex=True)
     start  = time()
     args = parse_arguments()
+    if args.trajectory != None:
+        plot_trajectory(args.trajectory,bins=args.bins).savefig(get_file_name(args.out,seq='T'))
+        if args.show:
+            show()
+        exit()
     file,_ = get_path_to_config(file_patterns = args.file,folder = args.folder,increment=0)
-    Xs, Vs, epoch,n_collisions,d,L,sigma = reload(file,folder=None)
+    Xs, Vs, epoch,n_collisions,d,L,sigma,periodic = reload(file,folder=None)
     Es = create_energies(Vs)
     ys,bins = np.histogram(Es,bins=100)
     xs = np.zeros_like(ys,dtype=float)
@@ -142,7 +166,8 @@ if __name__=='__main__':
         ax4.set_ylabel('$y$')
         ax4.set_title('Positions and Velocities')
 
-    fig.suptitle(fr'{args.file}: Epoch={epoch:,}, L={L}, $\sigma=${sigma}, n={len(Es)}')
+    fig.suptitle(fr'{args.file}: Epoch={epoch:,}, L={L}, $\sigma=${sigma}, n={len(Es)}'
+                 fr'{", periodic" if periodic else ""}')
     fig.tight_layout(h_pad=5,pad=2)
     fig.savefig(get_file_name(args.out))
 
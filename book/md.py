@@ -22,19 +22,28 @@
 
 
 from glob import glob
+from heapq import heapify, heappop, heappush
+from itertools import product
 from re import search
 from os import remove
-from os.path import splitext
+from os.path import join, splitext
 from sys import maxsize
+from tempfile import TemporaryDirectory
 from unittest import TestCase, main
 import numpy as np
+from scipy.spatial import cKDTree
 from scipy.special import gamma
+from cells import CellGrid
+from checkpoint import load_npz_mmap, save_npz_atomic
+from geometry import Torus
+from lattice import Lattice
 
 class Collision:
     '''A class for keeping track of the mechanism for a collision'''
     WALL = 0
     PAIR = 1
     SAMPLE = 2
+    CELL = 3
 
 def get_pair_time(x1, x2, v1, v2, sigma = 0.01):
     '''
@@ -136,7 +145,98 @@ def get_next_wall(Xs, Vs, sigma = 0.1, d = 2, L = np.array([1,1])):
             next_wall = (t,wall,j)
     return next_wall
 
-def event_disks(Xs, Vs, sigma = 0.01, d = 2, L = np.array([1,1]), tolerance=1e-12):
+def get_pair_times(Xs, Vs, sigma = 0.1, k = None, l = None, torus = None):
+    '''
+    Algorithm 2.2 Pair Time, vectorized: calculate pair collision times for many pairs of spheres at once
+
+    Parameters:
+        Xs         Centres of all spheres: the last two axes are sphere and coordinate, and
+                   any leading axes (e.g. replicas) are treated as a batch
+        Vs         Velocities of all spheres
+        sigma      Radius of spheres
+        k          Indices of one sphere from each pair
+        l          Indices of the other sphere from each pair. If k and l are omitted,
+                   all pairs with k < l are used
+        torus      For periodic boundary conditions, a geometry.Torus. Separations are then
+                   reduced to the minimum image, and the images in adjacent boxes are also
+                   considered, so the result is correct provided that neither sphere travels
+                   more than half a box before the prediction is renewed.
+
+    Returns:
+        t, k, l where t[i] is the time at which spheres k[i] and l[i] will collide: may be np.inf
+    '''
+    if k is None or l is None:
+        k,l = np.triu_indices(Xs.shape[-2], k = 1)
+    Delta_v = Vs[...,k,:] - Vs[...,l,:]
+    if torus == None:
+        Delta_x = Xs[...,k,:] - Xs[...,l,:]
+    else:
+        d = Xs.shape[-1]
+        images = np.array(list(product([-1,0,1], repeat = d))) * torus.L
+        images = images.reshape((len(images),) + (1,) * (Delta_v.ndim - 1) + (d,))
+        Delta_x = torus.diff_vec(Xs[...,k,:], Xs[...,l,:])[np.newaxis,...] + images
+        Delta_v = np.broadcast_to(Delta_v, Delta_x.shape)
+    xv = np.einsum('...j,...j->...', Delta_x, Delta_v)
+    vv = np.einsum('...j,...j->...', Delta_v, Delta_v)
+    xx = np.einsum('...j,...j->...', Delta_x, Delta_x)
+    Upsilon = xv**2 - vv * (xx - 4*sigma**2)
+    approaching = (Upsilon > 0) & (xv < 0)
+    t = np.full(xv.shape, float('inf'))
+    t[approaching] = - (xv[approaching] + np.sqrt(Upsilon[approaching]))/vv[approaching]
+    return (t if torus == None else np.min(t, axis = 0)), k, l
+
+def get_next_pair_vectorized(Xs, Vs, sigma = 0.1):
+    '''
+    Algorithm 2.2 - calculate time to next pair collision, using get_pair_times
+    instead of a double loop
+
+    Returns:
+       t_pair   Time to next pair collision
+       k        Index of one sphere
+       l        Index of the other sphere: k < l
+    '''
+    if len(Xs) < 2:
+        return (float('inf'), None, None)
+    t,k,l = get_pair_times(Xs, Vs, sigma = sigma)
+    m = np.argmin(t)
+    return (t[m], k[m], l[m]) if t[m] < float('inf') else (float('inf'), None, None)
+
+def get_wall_times(Xs, Vs, sigma = 0.1, L = np.array([1,1])):
+    '''
+    Fig 2.3, vectorized: calculate the time for each sphere to collide with each wall
+
+    Parameters:
+        Xs      Centres of all spheres
+        Vs      Velocities of all spheres
+        sigma   Radius of sphere
+        L       Lengths of sides
+
+    Returns:
+        An array with one row for each sphere and one column for each coordinate
+    '''
+    t = np.full(Xs.shape, float('inf'))
+    positive = Vs > 0
+    negative = Vs < 0
+    Upper = np.broadcast_to(L - sigma, Xs.shape)
+    t[positive] = (Upper[positive] - Xs[positive]) / Vs[positive]
+    t[negative] = (Xs[negative] - sigma) / (-Vs[negative])
+    return t
+
+def get_next_wall_vectorized(Xs, Vs, sigma = 0.1, d = 2, L = np.array([1,1])):
+    '''
+    Calculate time to next wall collision, using get_wall_times instead of a loop
+
+    Returns:
+        t_wall   Time to next wall collision
+        wall     Index of wall
+        j        Index of sphere
+    '''
+    t = get_wall_times(Xs, Vs, sigma = sigma, L = L)
+    j,wall = np.unravel_index(np.argmin(t), t.shape)
+    return (t[j,wall], wall, j)
+
+def event_disks(Xs, Vs, sigma = 0.01, d = 2, L = np.array([1,1]), tolerance=1e-12, calendar = None, vectorized = True,
+                periodic = False):
     '''
     Algorithm 2.1: event driven molecular dynamics for particles in a box.
     Calculate time to next collision of a sphere with another sphere or
@@ -150,6 +250,18 @@ def event_disks(Xs, Vs, sigma = 0.01, d = 2, L = np.array([1,1]), tolerance=1e-1
         d         Dimension of space
         L         Lengths of sides
         tolerance Used in a wall collision to verify updated position is close to wall
+        calendar  An EventCalendar built from Xs and Vs. If this is supplied, the next
+                  event is taken from the calendar instead of being recomputed, so callers
+                  that invoke event_disks repeatedly should create the calendar once and
+                  pass it each time. Spheres are then updated lazily, so call
+                  calendar.synchronize() before using Xs.
+        vectorized If no calendar is supplied, all pairs and walls are rescanned; this
+                  selects get_next_pair_vectorized and get_next_wall_vectorized for the
+                  rescan, instead of get_next_pair and get_next_wall
+        periodic  Use periodic boundary conditions: there are no walls, and the
+                  spheres move on a torus. Ignored if a calendar is supplied; otherwise
+                  all pairs are rescanned using minimum image separations, which is only
+                  correct while spheres collide before travelling half way across the box.
 
     Returns:
         Collision.WALL or Collision.PAIR
@@ -157,14 +269,30 @@ def event_disks(Xs, Vs, sigma = 0.01, d = 2, L = np.array([1,1]), tolerance=1e-1
         Index of a other sphere or of wall, as appropriate
         Time to collision
     '''
+    if calendar != None:
+        return calendar.next_event()
+
+    if periodic:
+        torus = Torus(L = np.array(L, dtype = float), sigma = sigma, d = d)
+        t,k,l = get_pair_times(Xs, Vs, sigma = sigma, torus = torus)
+        m = np.argmin(t)
+        if t[m] == float('inf'):
+            raise ValueError('No pair of spheres will collide')
+        k,l,t_pair = k[m],l[m],t[m]
+        Xs[:] = torus.box_it(Xs + t_pair * Vs)
+        Vs[k], Vs[l] = collide_pair(Xs[k], Xs[k] - torus.diff_vec(Xs[k], Xs[l]), Vs[k], Vs[l])
+        return Collision.PAIR, k, l, t_pair
 
     # Work out which collision is next, wall or pair
-    t_wall,wall,j = get_next_wall(Xs, Vs, sigma = sigma, d = d, L = L)
-    t_pair, k, l  = get_next_pair(Xs,Vs,sigma=sigma)
+    if vectorized:
+        t_wall,wall,j = get_next_wall_vectorized(Xs, Vs, sigma = sigma, d = d, L = L)
+        t_pair, k, l  = get_next_pair_vectorized(Xs,Vs,sigma=sigma)
+    else:
+        t_wall,wall,j = get_next_wall(Xs, Vs, sigma = sigma, d = d, L = L)
+        t_pair, k, l  = get_next_pair(Xs,Vs,sigma=sigma)
 
     if t_wall < t_pair:
         Xs += t_wall * Vs     # Update to new position
-        # assert abs(abs(Xs[j,wall])-(L[wall]-sigma)) < tolerance
         Vs[j][wall] = - Vs[j][wall]
         return Collision.WALL, j, wall, t_wall
     else:
@@ -175,6 +303,287 @@ def event_disks(Xs, Vs, sigma = 0.01, d = 2, L = np.array([1,1]), tolerance=1e-1
         assert abs(E_before-E_after) < tolerance
         return Collision.PAIR, k, l, t_pair
 
+class EventCalendar:
+    '''
+    Event calendar for Algorithm 2.1. Predicted collisions are kept in a heap. Each prediction
+    is tagged with the number of collisions that its spheres had undergone when it was made,
+    so a prediction becomes stale as soon as either sphere collides with something else.
+    Stale events are discarded when they reach the top of the heap, and after each collision
+    only the events for the spheres that have just collided are recomputed.
+
+    Optionally the box is divided into a CellGrid, with cells at least 2*sigma wide, and pair
+    times are predicted only for spheres in the same or adjacent cells. Cell crossings are then
+    scheduled as events, so each sphere is moved to its new cell exactly when it crosses a boundary.
+
+    With periodic boundary conditions the spheres move on a geometry.Torus, so there are no wall
+    collisions, and pair times use minimum image separations. A CellGrid is always used in this case,
+    since cell crossings also ensure that pair predictions are renewed before a sphere can travel far
+    enough to make the minimum image ambiguous.
+
+    Spheres are updated lazily: each sphere keeps the time at which its position was last updated,
+    and is only moved when it takes part in an event, so the work per event does not depend on the
+    number of spheres. Call synchronize() before using Xs, e.g. to sample or save a configuration.
+
+    Attributes:
+        Xs           Centres of all spheres (updated in place): Xs[i] is the position at time T[i]
+        Vs           Velocities of all spheres (updated in place)
+        sigma        Radius of spheres
+        d            Dimension of space
+        L            Lengths of sides
+        tolerance    Used to verify that energy is conserved in a pair collision
+        t            Time that has elapsed since calendar was created
+        T            Time at which the position of each sphere was last updated
+        counts       Number of collisions for each sphere
+        heap         Predicted events (t, Collision, i, j, counts[i], counts[j]): j is the index of the wall
+                     for a wall collision, of the other sphere for a pair collision, or of the coordinate
+                     whose boundary is crossed for a cell crossing
+        grid         CellGrid used to find neighbours and to schedule cell crossings (may be None)
+        cells        Indicates whether grid is used to find neighbours
+        torus        Torus used for periodic boundary conditions (None for a box with walls)
+        heap_limit   Size at which heap will next be compacted
+    '''
+    def __init__(self, Xs, Vs, sigma = 0.01, d = 2, L = np.array([1,1]), tolerance = 1e-12, cells = False, periodic = False):
+        '''
+        Parameters:
+            Xs           Centres of all spheres
+            Vs           Velocities of all spheres
+            sigma        Radius of spheres
+            d            Dimension of space
+            L            Lengths of sides
+            tolerance    Used to verify that energy is conserved in a pair collision
+            cells        Use a CellGrid to limit pair predictions to nearby spheres
+            periodic     Use periodic boundary conditions
+        '''
+        self.Xs = Xs
+        self.Vs = Vs
+        self.sigma = sigma
+        self.d = d
+        self.L = L
+        self.tolerance = tolerance
+        self.t = 0.0
+        n,_ = Xs.shape
+        self.T = np.zeros((n))
+        self.counts = np.zeros((n),dtype=np.int64)
+        self.cells = cells
+        self.torus = None
+        self.grid = None
+        if periodic:
+            if any(np.array(L) <= 4*sigma):
+                raise ValueError(f'Box with L={L} is too small for periodic boundary conditions with sigma={sigma}')
+            self.torus = Torus(L = np.array(L, dtype = float), sigma = sigma, d = d)
+            Xs[:] = self.torus.box_it(Xs)
+            self.grid = CellGrid(L = L, width = 2*sigma if cells else min(L)/4, periodic = True)
+        elif cells:
+            self.grid = CellGrid(L = L, width = 2*sigma)
+        if self.grid != None:
+            self.grid.fill(Xs)
+        self.heap = []
+        if not self.cells:
+            for i in range(n):
+                self.predict(i, others = [])
+            self.push_pairs(*get_pair_times(Xs, Vs, sigma = sigma, torus = self.torus))
+        else:
+            for i in range(n):
+                self.predict(i, others = [j for j in self.get_neighbours(i) if j > i])
+        heapify(self.heap)
+        self.heap_limit = 4 * max(len(self.heap), n)
+
+    def __len__(self):
+        '''
+        Number of spheres
+        '''
+        return len(self.counts)
+
+    def get_neighbours(self, i):
+        '''
+        Find the spheres that could collide with a specified sphere before it leaves its cell
+
+        Parameters:
+            i        Index of sphere
+        '''
+        return self.grid.get_neighbours(i) if self.cells else range(len(self))
+
+    def predict(self, i, others = None, wall = True):
+        '''
+        Add predictions of the next wall collision and cell crossing for one sphere, and of its collisions with other spheres
+
+        Parameters:
+            i        Index of sphere
+            others   Indices of spheres to be considered (default: all neighbours)
+            wall     Indicates whether wall collision is to be predicted
+        '''
+        if wall and self.torus == None:
+            wall,t_wall = get_wall_time(self.Xs[i], self.Vs[i], sigma = self.sigma, d = self.d, L = self.L)
+            if t_wall < float('inf'):
+                self.push(t_wall, Collision.WALL, i, wall)
+        if self.grid != None:
+            k,t_cell = self.grid.get_crossing_time(i, self.Xs[i], self.Vs[i])
+            if t_cell < float('inf'):
+                self.push(t_cell, Collision.CELL, i, k)
+        l = np.fromiter(self.get_neighbours(i) if others == None else others, dtype = int)
+        l = l[l != i]
+        if len(l) > 0:
+            spheres = np.concatenate(([i], l))
+            t,_,_ = get_pair_times(self.get_positions(spheres), self.Vs[spheres], sigma = self.sigma,
+                                   k = np.zeros_like(l), l = np.arange(1, len(spheres)), torus = self.torus)
+            self.push_pairs(t, np.minimum(i,l), np.maximum(i,l))
+
+    def get_positions(self, spheres):
+        '''
+        Calculate current positions of selected spheres, without updating them
+
+        Parameters:
+            spheres  Indices of spheres
+        '''
+        return self.Xs[spheres] + (self.t - self.T[spheres])[:,np.newaxis] * self.Vs[spheres]
+
+    def update(self, i):
+        '''
+        Move one sphere to the current time
+
+        Parameters:
+            i        Index of sphere
+        '''
+        self.Xs[i] += (self.t - self.T[i]) * self.Vs[i]
+        if self.torus != None:
+            self.Xs[i] = self.torus.box_it(self.Xs[i])
+        self.T[i] = self.t
+
+    def synchronize(self, t = None):
+        '''
+        Move all spheres to the current time, so Xs is a snapshot of the whole configuration
+
+        Parameters:
+            t        If specified, advance to this time first
+        '''
+        if t != None:
+            self.advance(t)
+        self.Xs += (self.t - self.T)[:,np.newaxis] * self.Vs
+        if self.torus != None:
+            self.Xs[:] = self.torus.box_it(self.Xs)
+        self.T[:] = self.t
+
+    def push_pairs(self, t, k, l):
+        '''
+        Record predicted pair collisions, ignoring any that will never happen
+
+        Parameters:
+            t     Times from now until collisions
+            k     Indices of one sphere from each pair
+            l     Indices of the other sphere from each pair
+        '''
+        finite = t < float('inf')
+        for dt,i,j in zip(t[finite], k[finite], l[finite]):
+            self.push(dt, Collision.PAIR, int(i), int(j))
+
+    def push(self, dt, kind, i, j):
+        '''
+        Record one predicted event
+
+        Parameters:
+            dt      Time from now until event
+            kind    Collision.WALL, Collision.PAIR, or Collision.CELL
+            i       Index of a sphere
+            j       Index of wall, other sphere, or coordinate
+        '''
+        heappush(self.heap, (self.t + dt, kind, i, j, self.counts[i], self.counts[j] if kind == Collision.PAIR else -1))
+
+    def is_valid(self, event):
+        '''
+        Verify that neither sphere has collided since the event was predicted
+        '''
+        _, kind, i, j, count_i, count_j = event
+        return self.counts[i] == count_i and (kind != Collision.PAIR or self.counts[j] == count_j)
+
+    def peek(self):
+        '''
+        Discard stale events from top of heap, then find the time of the next valid event
+        '''
+        while len(self.heap) > 0 and not self.is_valid(self.heap[0]):
+            heappop(self.heap)
+        if len(self.heap) == 0:
+            raise RuntimeError('No more collisions are possible')
+        return self.heap[0][0]
+
+    def advance(self, t):
+        '''
+        Run time forward, without processing any collisions. Spheres are
+        not moved until they are updated or synchronized.
+
+        Parameters:
+            t       Time to move to: must not be later than the next event
+        '''
+        assert t <= self.peek()
+        self.t = t
+
+    def next_event(self):
+        '''
+        Run time forward until the next valid collision, then adjust velocities
+        to immediately after, and predict new events for the spheres that collided.
+        Any cell crossings that occur first are processed along the way. Only the
+        spheres that take part in the collision are moved.
+
+        Returns:
+            Collision.WALL or Collision.PAIR
+            Index of a sphere involved in collision
+            Index of a other sphere or of wall, as appropriate
+            Time to collision
+        '''
+        t0 = self.t
+        while True:
+            self.advance(self.peek())
+            _, kind, i, j, _, _ = heappop(self.heap)
+            match kind:
+                case Collision.WALL:
+                    self.update(i)
+                    self.Vs[i][j] = - self.Vs[i][j]
+                    self.counts[i] += 1
+                    self.predict(i)
+                case Collision.PAIR:
+                    self.update(i)
+                    self.update(j)
+                    E_before = np.dot(self.Vs[i],self.Vs[i]) + np.dot(self.Vs[j],self.Vs[j])
+                    x_j = self.Xs[j] if self.torus == None else self.Xs[i] - self.torus.diff_vec(self.Xs[i], self.Xs[j])
+                    self.Vs[i], self.Vs[j] = collide_pair(self.Xs[i], x_j, self.Vs[i], self.Vs[j])
+                    E_after = np.dot(self.Vs[i],self.Vs[i]) + np.dot(self.Vs[j],self.Vs[j])
+                    assert abs(E_before-E_after) < self.tolerance
+                    self.counts[i] += 1
+                    self.counts[j] += 1
+                    self.predict(i)
+                    self.predict(j, others = [k for k in self.get_neighbours(j) if k != i])
+                case Collision.CELL:
+                    self.cross(i, j)
+            self.compact()
+            if kind != Collision.CELL:
+                return kind, i, j, self.t - t0
+
+    def cross(self, i, k):
+        '''
+        Move a sphere into the next cell, then predict its collisions with spheres
+        in cells that have just become adjacent, and its next cell crossing. If the grid
+        is not being used to find neighbours, collisions with all spheres are predicted again.
+
+        Parameters:
+            i      Index of sphere
+            k      Coordinate whose boundary is being crossed
+        '''
+        self.update(i)
+        adjacent_before = set(self.grid.get_adjacent(self.grid.cell_of[i]))
+        self.grid.cross(i, k, self.Vs[i])
+        self.predict(i,
+                     others = [j for cell in self.grid.get_adjacent(self.grid.cell_of[i]) if cell not in adjacent_before
+                                 for j in self.grid.cells.get(cell, ()) if j != i] if self.cells else None,
+                     wall = False)
+
+    def compact(self):
+        '''
+        Remove stale events once the heap has grown well beyond its size after
+        the last compaction, so that it does not keep growing during long runs.
+        '''
+        if len(self.heap) > self.heap_limit:
+            self.heap = [event for event in self.heap if self.is_valid(event)]
+            heapify(self.heap)
+            self.heap_limit = 4 * max(len(self.heap), len(self))
 
 
 def create_rng(seed0):
@@ -280,36 +689,172 @@ def get_density(n=5,d=2,sigma = 0.1,  L = np.array([1,1])):
     b = get_volume_box(d=d,L=L)
     return n * s / b
 
-def create_config(n = 5, d = 2,  L = np.array([1,1]), sigma = 0.1, V = 1, rng = np.random.default_rng(), M = 25, verbose=True):
+def get_overlaps(Xs, sigma = 0.1):
+    '''
+    Find all pairs of spheres that overlap
+
+    Parameters:
+        Xs      Centres of spheres
+        sigma   Radius of spheres
+
+    Returns:
+        k, l, distance: the two spheres in each overlapping pair, and the distance between their centres
+    '''
+    pairs = cKDTree(Xs).query_pairs(2*sigma, output_type = 'ndarray')
+    k,l = pairs[:,0],pairs[:,1]
+    distance = np.linalg.norm(Xs[k] - Xs[l], axis = 1)
+    overlapping = distance < 2*sigma
+    return k[overlapping], l[overlapping], distance[overlapping]
+
+def create_config(n = 5, d = 2,  L = np.array([1,1]), sigma = 0.1, V = 1, rng = np.random.default_rng(), M = 25, verbose=True,
+                  strategy = 'tabula-rasa', lattice = None):
     '''
     Create a configuration of disks or spheres, no two of which overlap
 
+    Parameters:
+        n         Number of spheres
+        L         Lengths of all sides
+        V         Limiting velocity: we aim for velocities to be in range (-V,V)
+        sigma     Radius of sphere
+        d         Dimension of space
+        rng       Random number generator
+        M         Number of attempts allowed to create configuration (for rsa, number of attempts per sphere;
+                  for compress, number of relaxation steps allowed each time spheres are enlarged)
+        strategy  tabula-rasa: place all spheres at random, and start again if any overlap
+                  lattice:     place spheres on sites of a lattice, spaced as widely as possible
+                  rsa:         random sequential addition: place spheres one at a time, rejecting any that overlap
+                  compress:    start from small spheres and enlarge them, pushing overlapping spheres apart,
+                               until they reach the target radius
+        lattice   Type of lattice for lattice strategy: default is Lattice.HEX for d=2, and Lattice.FCC for d=3
+    '''
+    L = np.array(L, dtype = float)
+    if verbose:
+        print (f'Trying to create configuration: n={n}, d={d}, L={L}, sigma={sigma},'
+            f' density ={get_density(n=n,d=d,sigma=sigma,L=L):2g}, strategy={strategy}')
+    match strategy:
+        case 'tabula-rasa':
+            Xs = create_config_tabula_rasa(n = n, d = d, L = L, sigma = sigma, rng = rng, M = M)
+        case 'lattice':
+            Xs = create_config_lattice(n = n, d = d, L = L, sigma = sigma, rng = rng,
+                                       lattice = lattice if lattice != None else Lattice.HEX if d == 2 else Lattice.FCC)
+        case 'rsa':
+            Xs = create_config_rsa(n = n, d = d, L = L, sigma = sigma, rng = rng, M = M)
+        case 'compress':
+            Xs = create_config_compress(n = n, d = d, L = L, sigma = sigma, rng = rng, M = M)
+        case _:
+            raise ValueError(f'Unknown strategy {strategy}')
+    Vs = -V + 2 * V * rng.random((n,d))
+    return Xs, Vs
+
+def create_config_tabula_rasa(n = 5, d = 2,  L = np.array([1,1]), sigma = 0.1, rng = np.random.default_rng(), M = 25):
+    '''
+    Place all spheres at random, and start again if any overlap
+
     Parameters:
         n       Number of spheres
+        d       Dimension of space
         L       Lengths of all sides
-        V       Limiting velocity: we aim for velocities to be in range (-V,V)
         sigma   Radius of sphere
-        d       Dimension of space
         rng     Random number generator
         M       Number of attempts allowed to create configuration
     '''
-    def any_spheres_too_close(X):
-        for i in range(n):
-            for j in range(i):
-                if np.linalg.norm(Xs[i,:] - Xs[j,:]) < 2 * sigma: return True
-        return False
-
-    if verbose:
-        print (f'Trying to create configuration: n={n}, d={d}, L={L}, sigma={sigma},'
-            f' density ={get_density(n=5,d=d,sigma=sigma,L=L):2g}')
     for _ in range(M):
         Xs = sigma + rng.random((n,d)) * (L - 2*sigma)
-        if not any_spheres_too_close(Xs):
-            Vs = -V + 2 * V * rng.random((n,d))
-            return Xs, Vs
+        k,_,_ = get_overlaps(Xs, sigma = sigma)
+        if len(k) == 0:
+            return Xs
 
     raise RuntimeError(f'Failed to create configuration in {M} attempts: n={n}, d={d}, l={L}, sigma={sigma}')
 
+def create_config_lattice(n = 5, d = 2,  L = np.array([1,1]), sigma = 0.1, rng = np.random.default_rng(), lattice = 'hex'):
+    '''
+    Place spheres on a randomly chosen subset of the sites of a lattice, whose spacing
+    is the largest that still provides enough sites within the box.
+
+    Parameters:
+        n         Number of spheres
+        d         Dimension of space
+        L         Lengths of all sides
+        sigma     Radius of sphere
+        rng       Random number generator
+        lattice   Lattice.SC, Lattice.HEX, Lattice.BCC, or Lattice.FCC
+    '''
+    _,_,nearest = Lattice.get_cell(lattice, d)
+    a_min = 2 * sigma * (1 + 1e-9) / nearest    # Allow for rounding, so neighbours never overlap
+    if len(Lattice.get_sites(a_min, lattice = lattice, d = d, L = L, sigma = sigma)) < n:
+        raise RuntimeError(f'Lattice {lattice} cannot hold {n} spheres: d={d}, l={L}, sigma={sigma}')
+    a_max = max(L) / nearest
+    for _ in range(50):
+        a = 0.5 * (a_min + a_max)
+        if len(Lattice.get_sites(a, lattice = lattice, d = d, L = L, sigma = sigma)) >= n:
+            a_min = a
+        else:
+            a_max = a
+    sites = Lattice.get_sites(a_min, lattice = lattice, d = d, L = L, sigma = sigma)
+    return sites[np.sort(rng.choice(len(sites), size = n, replace = False))]
+
+def create_config_rsa(n = 5, d = 2,  L = np.array([1,1]), sigma = 0.1, rng = np.random.default_rng(), M = 25):
+    '''
+    Random sequential addition: add spheres one at a time, rejecting any that would overlap
+    a sphere that has already been placed. A cell grid is used so only nearby spheres are checked.
+
+    Parameters:
+        n       Number of spheres
+        d       Dimension of space
+        L       Lengths of all sides
+        sigma   Radius of sphere
+        rng     Random number generator
+        M       Number of attempts allowed for each sphere, on average
+    '''
+    grid = CellGrid(L, width = 2*sigma)
+    Xs = np.empty((n,d))
+    i = 0
+    for _ in range(M * n):
+        x = sigma + rng.random((d)) * (L - 2*sigma)
+        cell = grid.get_cell(x)
+        if all(np.dot(x - Xs[j], x - Xs[j]) >= 4*sigma**2
+               for c in grid.get_adjacent(cell) for j in grid.cells.get(c, ())):
+            Xs[i] = x
+            grid.add(i, cell)
+            i += 1
+            if i == n:
+                return Xs
+
+    raise RuntimeError(f'Placed only {i} spheres in {M*n} attempts: n={n}, d={d}, l={L}, sigma={sigma}')
+
+def create_config_compress(n = 5, d = 2,  L = np.array([1,1]), sigma = 0.1, rng = np.random.default_rng(), M = 25,
+                           stages = 20, tolerance = 1e-6):
+    '''
+    Start with spheres at random, then enlarge them in stages until they reach the specified radius
+    (which is equivalent to compressing the box). At each stage, overlapping pairs are pushed apart,
+    and spheres are kept away from the walls, until there are no more overlaps.
+
+    Parameters:
+        n          Number of spheres
+        d          Dimension of space
+        L          Lengths of all sides
+        sigma      Radius of sphere
+        rng        Random number generator
+        M          Number of relaxation steps allowed for each stage
+        stages     Number of stages used to enlarge spheres
+        tolerance  Spheres are pushed slightly further apart than needed, to allow for rounding
+    '''
+    Xs = sigma + rng.random((n,d)) * (L - 2*sigma)
+    for radius in np.linspace(sigma/stages, sigma, stages):
+        for _ in range(M):
+            k,l,distance = get_overlaps(Xs, sigma = radius)
+            if len(k) == 0: break
+            e = (Xs[k] - Xs[l]) / np.maximum(distance, tolerance*sigma)[:,np.newaxis]
+            push = 0.5 * (2*radius*(1 + tolerance) - distance)[:,np.newaxis] * e
+            Delta = np.zeros_like(Xs)
+            np.add.at(Delta, k, push)
+            np.add.at(Delta, l, -push)
+            Xs = np.clip(Xs + Delta, sigma, L - sigma)
+        else:
+            if len(get_overlaps(Xs, sigma = radius)[0]) > 0:
+                raise RuntimeError(f'Failed to compress to radius {radius} in {M} steps: n={n}, d={d}, l={L}, sigma={sigma}')
+    return Xs
+
 def get_sequence(saved_files,increment=1):
     '''
     Used to make file name unique
@@ -341,7 +886,9 @@ def save_configuration(file_patterns = 'md.npz',
                        d = 2,
                        L = np.array([1,1]),
                        sigma = 0.05,
-                       folder = 'configs'):
+                       folder = 'configs',
+                       calendar = None,
+                       periodic = False):
     '''
     Save configuration of disks
 
@@ -357,27 +904,40 @@ def save_configuration(file_patterns = 'md.npz',
         sigma           Radius of sphere
         d               Dimension of space
         folder          Folder to store files
+        calendar        If an EventCalendar is supplied, spheres are synchronized first,
+                        so that the saved configuration is a snapshot at a single time
+        periodic        Indicates whether periodic boundary conditions are in use
     '''
+    if calendar != None:
+        calendar.synchronize()
+        Xs = calendar.Xs
+        Vs = calendar.Vs
     file,saved_files = get_path_to_config(file_patterns = file_patterns,folder = folder)
-    np.savez(file, epoch = epoch, Xs = Xs, Vs = Vs, n_collisions = n_collisions, d = d, L =  L, sigma = sigma)
+    save_npz_atomic(file, epoch = epoch, Xs = Xs, Vs = Vs, n_collisions = n_collisions, d = d, L =  L, sigma = sigma, periodic = periodic)
 
     while len(saved_files) >= retention:
-        remove(f'{folder}{saved_files.pop()}')
+        remove(join(folder,saved_files.pop()))
 
-def reload(file, folder = 'configs'):
+def reload(file, folder = 'configs', periodic = False, mmap = False):
     '''
-    Reload configuration stored by save_configuration
+    Reload configuration stored by save_configuration or by checkpoint.Checkpointer
 
     Parameter
         file       Name of file to load
         folder     Folder where files are stored
+        periodic   Used for files saved before periodic boundary conditions were supported
+        mmap       Map arrays into memory instead of reading them
+
+    Returns:
+        Xs, Vs, epoch, n_collisions, d, L, sigma, periodic
     '''
     if len(splitext(file)[1]) ==0:
         file = f'{file}.npz'
     full_file_name = f'{folder}/{file}' if folder != None else file
-    restored = np.load(full_file_name, allow_pickle=True)
+    restored = load_npz_mmap(full_file_name) if mmap else np.load(full_file_name, allow_pickle=True)
     return (restored['Xs'], restored['Vs'], restored['epoch'].astype(int),
-            restored['n_collisions'],restored['d'].astype(int),restored['L'],restored['sigma'].astype(float))
+            restored['n_collisions'],restored['d'].astype(int),restored['L'],restored['sigma'].astype(float),
+            bool(restored['periodic']) if 'periodic' in restored else periodic)
 
 class TestsForFiles(TestCase):
     '''
@@ -390,6 +950,29 @@ class TestsForFiles(TestCase):
         '''
         self.assertEqual(4,get_sequence(['.\\exercise_2_3_000001.npz', '.\\exercise_2_3_000003.npz']))
 
+    def test_save_reload_periodic(self):
+        with TemporaryDirectory() as folder:
+            Xs = np.array([[0.25,0.25],[0.75,0.75]])
+            Vs = np.array([[1.0,0.0],[0.0,1.0]])
+            save_configuration(file_patterns = 'md.npz', Xs = Xs, Vs = Vs, n_collisions = np.zeros(2), sigma = 0.1,
+                               folder = folder, periodic = True)
+            file,_ = get_path_to_config(file_patterns = 'md.npz', folder = folder, increment = 0)
+            Xs1,Vs1,_,_,d,_,sigma,periodic = reload(file, folder = None)
+            np.testing.assert_array_equal(Xs,Xs1)
+            np.testing.assert_array_equal(Vs,Vs1)
+            self.assertEqual(2,d)
+            self.assertEqual(0.1,sigma)
+            self.assertTrue(periodic)
+            Xs2,_,_,_,_,_,_,_ = reload(file, folder = None, mmap = True)
+            np.testing.assert_array_equal(Xs,Xs2)
+
+    def test_retention(self):
+        with TemporaryDirectory() as folder:
+            for i in range(5):
+                save_configuration(file_patterns = 'md.npz', retention = 2, Xs = np.full((2,2), i), Vs = np.zeros((2,2)),
+                                   n_collisions = np.zeros(2), folder = folder)
+            self.assertEqual(['md000004.npz', 'md000005.npz'], sorted(glob('md*.npz', root_dir = folder)))
+
 class TestsForSpheres(TestCase):
     def test_easy_case(self):
         Xs,Vs = create_config(n = 5, d = 2,  L = np.array([1,1]), sigma = 0.1, V = 1,  M = 25, verbose=False)
@@ -402,6 +985,229 @@ class TestsForSpheres(TestCase):
         with self.assertRaises(RuntimeError) as cm:
             create_config(n = 100, d = 2,  L = np.array([1,1]), sigma = 0.1, V = 1,  M = 25, verbose=False)
 
+class TestCreateConfig(TestCase):
+    '''
+    Verify that each strategy creates valid configurations at densities where tabula rasa fails
+    '''
+    def setUp(self):
+        self.rng = np.random.default_rng(17)
+
+    def assertValid(self, Xs, Vs, n, d, L, sigma):
+        self.assertEqual((n,d), Xs.shape)
+        self.assertEqual((n,d), Vs.shape)
+        self.assertTrue(np.all(Xs >= sigma))
+        self.assertTrue(np.all(Xs <= L - sigma))
+        k = np.triu_indices(n, k = 1)
+        self.assertGreaterEqual(np.linalg.norm(Xs[k[0]] - Xs[k[1]], axis = 1).min(), 2*sigma*(1 - 1e-12))
+
+    def test_lattice(self):
+        for lattice,d,n,sigma in [(Lattice.SC,2,81,0.05), (Lattice.HEX,2,99,0.05), (Lattice.SC,3,64,0.1), (Lattice.FCC,3,108,0.1)]:
+            L = np.ones((d))
+            Xs,Vs = create_config(n = n, d = d, L = L, sigma = sigma, rng = self.rng, verbose = False,
+                                  strategy = 'lattice', lattice = lattice)
+            self.assertValid(Xs, Vs, n, d, L, sigma)
+
+    def test_lattice_too_dense(self):
+        with self.assertRaises(RuntimeError):
+            create_config(n = 82, d = 2, L = np.ones((2)), sigma = 0.05, rng = self.rng, verbose = False,
+                          strategy = 'lattice', lattice = Lattice.SC)
+        with self.assertRaises(ValueError):
+            create_config(n = 10, d = 2, verbose = False, strategy = 'lattice', lattice = Lattice.FCC)
+
+    def test_hex_denser_than_square(self):
+        Xs,_ = create_config(n = 99, d = 2, L = np.ones((2)), sigma = 0.05, rng = self.rng, verbose = False,
+                             strategy = 'lattice', lattice = Lattice.HEX)
+        with self.assertRaises(RuntimeError):
+            create_config(n = 99, d = 2, L = np.ones((2)), sigma = 0.05, rng = self.rng, verbose = False,
+                          strategy = 'tabula-rasa', M = 1000)
+
+    def test_rsa(self):
+        for d,n,sigma in [(2,200,0.025), (3,200,0.05)]:
+            L = np.ones((d))
+            Xs,Vs = create_config(n = n, d = d, L = L, sigma = sigma, rng = self.rng, verbose = False, strategy = 'rsa', M = 100)
+            self.assertValid(Xs, Vs, n, d, L, sigma)
+
+    def test_compress(self):
+        for d,n,sigma in [(2,200,0.03), (3,200,0.065)]:
+            L = np.ones((d))
+            Xs,Vs = create_config(n = n, d = d, L = L, sigma = sigma, rng = self.rng, verbose = False,
+                                  strategy = 'compress', M = 1000)
+            self.assertValid(Xs, Vs, n, d, L, sigma)
+
+class TestVectorized(TestCase):
+    '''
+    Verify that vectorized kernels agree with scalar versions
+    '''
+    def test_same_as_loops(self):
+        rng = np.random.default_rng(3)
+        for d in [2,3]:
+            L = np.ones(d)
+            Xs,Vs = create_config(n = 12, d = d, L = L, sigma = 0.05, rng = rng, M = 1000, verbose = False)
+            t_pair,k,l = get_next_pair(Xs, Vs, sigma = 0.05)
+            t_pair1,k1,l1 = get_next_pair_vectorized(Xs, Vs, sigma = 0.05)
+            self.assertAlmostEqual(t_pair,t_pair1)
+            self.assertEqual((k,l),(k1,l1))
+            self.assertEqual(get_next_wall(Xs, Vs, sigma = 0.05, d = d, L = L),
+                             get_next_wall_vectorized(Xs, Vs, sigma = 0.05, d = d, L = L))
+
+    def test_event_disks(self):
+        rng = np.random.default_rng(5)
+        L = np.array([1,1])
+        Xs,Vs = create_config(n = 8, d = 2, L = L, sigma = 0.05, rng = rng, M = 1000, verbose = False)
+        Xs1 = Xs.copy()
+        Vs1 = Vs.copy()
+        for _ in range(20):
+            kind,i,j,t = event_disks(Xs, Vs, sigma = 0.05, L = L)
+            kind1,i1,j1,t1 = event_disks(Xs1, Vs1, sigma = 0.05, L = L, vectorized = False)
+            self.assertEqual((kind,i,j),(kind1,i1,j1))
+            self.assertAlmostEqual(t,t1,places=6)
+
+class TestEventCalendar(TestCase):
+    '''
+    Verify that the event calendar generates the same sequence of collisions as a full rescan
+    '''
+    def test_same_as_rescan(self):
+        rng = np.random.default_rng(42)
+        L = np.array([1,1])
+        sigma = 0.05
+        Xs,Vs = create_config(n = 10, d = 2, L = L, sigma = sigma, rng = rng, M = 1000, verbose = False)
+        Xs0 = Xs.copy()
+        Vs0 = Vs.copy()
+        calendar = EventCalendar(Xs, Vs, sigma = sigma, d = 2, L = L)
+        for _ in range(50):
+            t_wall,wall,j = get_next_wall(Xs0, Vs0, sigma = sigma, d = 2, L = L)
+            t_pair,k,l = get_next_pair(Xs0, Vs0, sigma = sigma)
+            kind,i,m,t = event_disks(Xs, Vs, sigma = sigma, d = 2, L = L, calendar = calendar)
+            calendar.synchronize()
+            if t_wall < t_pair:
+                self.assertEqual((Collision.WALL,j,wall),(kind,i,m))
+                self.assertAlmostEqual(t_wall,t,places=6)
+                Xs0 += t_wall * Vs0
+                Vs0[j][wall] = - Vs0[j][wall]
+            else:
+                self.assertEqual((Collision.PAIR,k,l),(kind,i,m))
+                self.assertAlmostEqual(t_pair,t,places=6)
+                Xs0 += t_pair * Vs0
+                Vs0[k], Vs0[l] = collide_pair(Xs0[k], Xs0[l], Vs0[k], Vs0[l])
+            np.testing.assert_allclose(Xs0,Xs,atol=1e-6)
+            np.testing.assert_allclose(Vs0,Vs,atol=1e-6)
+
+    def test_cells_same_as_all_pairs(self):
+        '''
+        Restricting pair predictions to adjacent cells must not change the sequence of collisions
+        '''
+        for d in [2,3]:
+            rng = np.random.default_rng(17)
+            L = np.ones(d)
+            sigma = 0.03
+            Xs,Vs = create_config(n = 20, d = d, L = L, sigma = sigma, rng = rng, M = 1000, verbose = False)
+            Xs1 = Xs.copy()
+            Vs1 = Vs.copy()
+            calendar = EventCalendar(Xs, Vs, sigma = sigma, d = d, L = L)
+            calendar_cells = EventCalendar(Xs1, Vs1, sigma = sigma, d = d, L = L, cells = True)
+            for _ in range(50):
+                kind,i,j,t = calendar.next_event()
+                kind1,i1,j1,t1 = calendar_cells.next_event()
+                self.assertEqual((kind,i,j),(kind1,i1,j1))
+                self.assertAlmostEqual(t,t1,places=6)
+            calendar_cells.synchronize()
+            for i in range(len(calendar_cells)):
+                self.assertEqual(calendar_cells.grid.get_cell(Xs1[i]), calendar_cells.grid.cell_of[i])
+
+class TestPeriodic(TestCase):
+    '''
+    Tests for periodic boundary conditions
+    '''
+    def get_min_distance(self, calendar):
+        calendar.synchronize()
+        k,l = np.triu_indices(len(calendar), k = 1)
+        return np.min(np.linalg.norm(calendar.torus.diff_vec(calendar.Xs[k], calendar.Xs[l]), axis = 1))
+
+    def test_no_overlaps(self):
+        for d in [2,3]:
+            rng = np.random.default_rng(23)
+            L = np.ones(d)
+            sigma = 0.04
+            Xs,Vs = create_config(n = 15, d = d, L = L, sigma = sigma, rng = rng, M = 1000, verbose = False)
+            P0 = Vs.sum(axis = 0)
+            E0 = (Vs**2).sum()
+            for cells in [False,True]:
+                calendar = EventCalendar(Xs.copy(), Vs.copy(), sigma = sigma, d = d, L = L, periodic = True, cells = cells)
+                for _ in range(300 if d == 2 else 50):
+                    kind,_,_,_ = calendar.next_event()
+                    self.assertEqual(Collision.PAIR, kind)
+                self.assertGreater(self.get_min_distance(calendar), 2*sigma - 1e-9)
+                self.assertTrue(np.all(calendar.Xs >= 0) and np.all(calendar.Xs < 1))
+                np.testing.assert_allclose(P0, calendar.Vs.sum(axis = 0), atol = 1e-9)
+                self.assertAlmostEqual(E0, (calendar.Vs**2).sum())
+
+    def test_cells_same_as_all_pairs(self):
+        rng = np.random.default_rng(29)
+        L = np.array([1,1])
+        sigma = 0.03
+        Xs,Vs = create_config(n = 20, d = 2, L = L, sigma = sigma, rng = rng, M = 1000, verbose = False)
+        calendar = EventCalendar(Xs.copy(), Vs.copy(), sigma = sigma, L = L, periodic = True)
+        calendar_cells = EventCalendar(Xs.copy(), Vs.copy(), sigma = sigma, L = L, periodic = True, cells = True)
+        for _ in range(50):
+            _,i,j,t = calendar.next_event()
+            _,i1,j1,t1 = calendar_cells.next_event()
+            self.assertEqual((i,j),(i1,j1))
+            self.assertAlmostEqual(t,t1,places=6)
+
+    def test_crossing_boundary(self):
+        '''
+        Two disks can collide across the boundary of the box
+        '''
+        Xs = np.array([[0.05,0.5],[0.95,0.5]])
+        Vs = np.array([[-1.0,0.0],[0.0,0.0]])
+        _,i,j,t = event_disks(Xs, Vs, sigma = 0.02, L = np.array([1,1]), periodic = True)
+        self.assertEqual((0,1),(i,j))
+        self.assertAlmostEqual(0.06,t)
+        np.testing.assert_allclose([[0.0,0.0],[-1.0,0.0]], Vs)
+
+    def test_rescan(self):
+        '''
+        Rescanning all pairs without a calendar gives the same collisions as the calendar
+        '''
+        rng = np.random.default_rng(23)
+        L = np.array([1,1])
+        sigma = 0.04
+        Xs,Vs = create_config(n = 20, d = 2, L = L, sigma = sigma, rng = rng, M = 1000, verbose = False)
+        calendar = EventCalendar(Xs.copy(), Vs.copy(), sigma = sigma, L = L, periodic = True)
+        for _ in range(50):
+            _,i,j,t = event_disks(Xs, Vs, sigma = sigma, L = L, periodic = True)
+            _,i1,j1,_ = calendar.next_event()
+            self.assertEqual((i,j),(i1,j1))
+        calendar.synchronize()
+        np.testing.assert_allclose(calendar.Vs, Vs)
+
+class TestLazy(TestCase):
+    '''
+    Verify that lazy updates give the same trajectory as moving every sphere at every event
+    '''
+    def test_synchronize(self):
+        rng = np.random.default_rng(11)
+        L = np.array([1,1])
+        Xs,Vs = create_config(n = 8, d = 2, L = L, sigma = 0.05, rng = rng, M = 1000, verbose = False)
+        Xs0 = Xs.copy()
+        Vs0 = Vs.copy()
+        calendar = EventCalendar(Xs, Vs, sigma = 0.05, L = L)
+        for t_sample in np.arange(0.1, 2, 0.1):
+            while calendar.peek() < t_sample:
+                _,i,_,_ = calendar.next_event()
+                self.assertEqual(calendar.t, calendar.T[i])
+            calendar.synchronize(t_sample)
+            np.testing.assert_array_equal(t_sample, calendar.T)
+            t = 0
+            while True:
+                t_wall,_,_ = get_next_wall(Xs0, Vs0, sigma = 0.05, L = L)
+                t_pair,_,_ = get_next_pair(Xs0, Vs0, sigma = 0.05)
+                if t + min(t_wall,t_pair) >= 0.1: break
+                _,_,_,dt = event_disks(Xs0, Vs0, sigma = 0.05, L = L)
+                t += dt
+            Xs0 += (0.1 - t) * Vs0
+            np.testing.assert_allclose(Xs0, Xs, atol = 1e-6)
+
 class TestVolume(TestCase):
     def test_sphere2d(self):
         self.assertEqual(np.pi,get_volume_sphere(sigma=1))
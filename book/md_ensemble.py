@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2025 Simon Crase
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+    Algorithm 2.1, event driven molecular dynamics, for an ensemble of independent
+    replicas of a small system of spheres in a box. The next event is calculated for
+    all replicas at once, then each replica is run forward to its own next event.
+'''
+
+from unittest import TestCase, main
+import numpy as np
+from md import Collision, create_config, event_disks, get_pair_times, get_wall_times
+
+class Ensemble:
+    '''
+    A collection of replicas, each comprising n spheres in a box
+
+    Attributes:
+        Xs            Centres of spheres, one row for each replica
+        Vs            Velocities of spheres, one row for each replica
+        sigma         Radius of spheres
+        d             Dimension of space
+        L             Lengths of sides
+        t             Time for each replica
+        n_collisions  Number of wall and pair collisions for each replica
+        k, l          Indices of all pairs of spheres
+    '''
+    @staticmethod
+    def create(R = 10, n = 4, d = 2, L = np.array([1,1]), sigma = 0.1, V = 1, rng = np.random.default_rng(), M = 25,
+               strategy = 'tabula-rasa', lattice = None):
+        '''
+        Create an ensemble whose replicas start from independent configurations
+
+        Parameters:
+            R         Number of replicas
+            n         Number of spheres in each replica
+            d         Dimension of space
+            L         Lengths of all sides
+            sigma     Radius of spheres
+            V         Limiting velocity: we aim for velocities to be in range (-V,V)
+            rng       Random number generator
+            M         Number of attempts allowed to create each configuration
+            strategy  Strategy used by create_config for each configuration
+            lattice   Lattice used by lattice strategy
+        '''
+        Xs = np.empty((R,n,d))
+        Vs = np.empty((R,n,d))
+        for r in range(R):
+            Xs[r],Vs[r] = create_config(n = n, d = d, L = L, sigma = sigma, V = V, rng = rng, M = M, verbose = False,
+                                        strategy = strategy, lattice = lattice)
+        return Ensemble(Xs, Vs, sigma = sigma, L = L)
+
+    def __init__(self, Xs, Vs, sigma = 0.1, L = np.array([1,1])):
+        '''
+        Parameters:
+            Xs      Centres of spheres, one row for each replica
+            Vs      Velocities of spheres, one row for each replica
+            sigma   Radius of spheres
+            L       Lengths of sides
+        '''
+        self.Xs = Xs
+        self.Vs = Vs
+        R,n,self.d = Xs.shape
+        self.sigma = sigma
+        self.L = np.array(L)
+        self.t = np.zeros((R))
+        self.n_collisions = np.zeros((R,2), dtype = np.int64)
+        self.k,self.l = np.triu_indices(n, k = 1)
+
+    def __len__(self):
+        '''
+        Number of replicas
+        '''
+        return len(self.t)
+
+    def get_next_events(self, replicas):
+        '''
+        Calculate the next collision for selected replicas
+
+        Parameters:
+            replicas   Indices of replicas
+
+        Returns:
+            dt, kind, i, j: the time to the next collision for each replica, whether it is Collision.WALL
+            or Collision.PAIR, the index of a sphere, and the index of the wall or of the other sphere
+        '''
+        R = len(replicas)
+        t_wall = get_wall_times(self.Xs[replicas], self.Vs[replicas], sigma = self.sigma, L = self.L).reshape(R,-1)
+        wall_index = np.argmin(t_wall, axis = 1)
+        dt_wall = t_wall[np.arange(R), wall_index]
+        t_pair,_,_ = get_pair_times(self.Xs[replicas], self.Vs[replicas], sigma = self.sigma, k = self.k, l = self.l)
+        pair_index = np.argmin(t_pair, axis = 1) if t_pair.shape[1] > 0 else np.zeros((R), dtype = int)
+        dt_pair = t_pair[np.arange(R), pair_index] if t_pair.shape[1] > 0 else np.full((R), float('inf'))
+        is_wall = dt_wall < dt_pair
+        kind = np.where(is_wall, Collision.WALL, Collision.PAIR)
+        i = np.where(is_wall, wall_index // self.d, self.k[pair_index] if len(self.k) > 0 else 0)
+        j = np.where(is_wall, wall_index % self.d, self.l[pair_index] if len(self.l) > 0 else 0)
+        return np.where(is_wall, dt_wall, dt_pair), kind, i, j
+
+    def collide(self, replicas, kind, i, j):
+        '''
+        Adjust velocities of replicas whose spheres have just collided
+
+        Parameters:
+            replicas  Indices of replicas
+            kind      Collision.WALL or Collision.PAIR for each replica
+            i         Index of a sphere for each replica
+            j         Index of wall or other sphere for each replica
+        '''
+        wall = kind == Collision.WALL
+        r = replicas[wall]
+        self.Vs[r, i[wall], j[wall]] *= -1
+        self.n_collisions[r, Collision.WALL] += 1
+
+        pair = ~wall
+        r = replicas[pair]
+        k = i[pair]
+        l = j[pair]
+        Delta_x = self.Xs[r,k] - self.Xs[r,l]
+        e_hat_perp = Delta_x / np.linalg.norm(Delta_x, axis = 1)[:,np.newaxis]
+        Delta_v_perp = np.einsum('ij,ij->i', self.Vs[r,k] - self.Vs[r,l], e_hat_perp)[:,np.newaxis]
+        self.Vs[r,k] -= Delta_v_perp * e_hat_perp
+        self.Vs[r,l] += Delta_v_perp * e_hat_perp
+        self.n_collisions[r, Collision.PAIR] += 1
+
+    def next_event(self):
+        '''
+        Run every replica forward to its own next collision
+
+        Returns:
+            kind, i, j, dt for each replica, as for md.event_disks
+        '''
+        replicas = np.arange(len(self))
+        dt, kind, i, j = self.get_next_events(replicas)
+        self.Xs += dt[:,np.newaxis,np.newaxis] * self.Vs
+        self.t += dt
+        self.collide(replicas, kind, i, j)
+        return kind, i, j, dt
+
+    def advance(self, t):
+        '''
+        Run all replicas forward to a specified time, processing collisions as they occur
+
+        Parameters:
+            t      Time to move to: typically the next sample time
+        '''
+        replicas = np.flatnonzero(self.t < t)
+        while len(replicas) > 0:
+            dt, kind, i, j = self.get_next_events(replicas)
+            colliding = self.t[replicas] + dt < t
+            finishing = replicas[~colliding]
+            self.Xs[finishing] += (t - self.t[finishing])[:,np.newaxis,np.newaxis] * self.Vs[finishing]
+            self.t[finishing] = t
+            replicas = replicas[colliding]
+            self.Xs[replicas] += dt[colliding][:,np.newaxis,np.newaxis] * self.Vs[replicas]
+            self.t[replicas] += dt[colliding]
+            self.collide(replicas, kind[colliding], i[colliding], j[colliding])
+
+class TestEnsemble(TestCase):
+    '''
+    Verify that replicas follow the same trajectories as they would if run one at a time
+    '''
+    def setUp(self):
+        self.L = np.array([1,1])
+        self.ensemble = Ensemble.create(R = 5, n = 4, L = self.L, sigma = 0.1, rng = np.random.default_rng(7), M = 1000)
+        self.Xs = self.ensemble.Xs.copy()
+        self.Vs = self.ensemble.Vs.copy()
+
+    def test_next_event(self):
+        for _ in range(20):
+            kind, i, j, dt = self.ensemble.next_event()
+            for r in range(len(self.ensemble)):
+                kind1, i1, j1, dt1 = event_disks(self.Xs[r], self.Vs[r], sigma = 0.1, L = self.L)
+                self.assertEqual((kind1, i1, j1), (kind[r], i[r], j[r]))
+                self.assertAlmostEqual(dt1, dt[r])
+        np.testing.assert_allclose(self.Xs, self.ensemble.Xs, atol = 1e-9)
+        np.testing.assert_allclose(self.Vs, self.ensemble.Vs, atol = 1e-9)
+
+    def test_advance(self):
+        self.ensemble.advance(0.5)
+        np.testing.assert_array_equal(0.5, self.ensemble.t)
+        for r in range(len(self.ensemble)):
+            t = 0
+            for _ in range(int(self.ensemble.n_collisions[r].sum())):
+                _,_,_,dt = event_disks(self.Xs[r], self.Vs[r], sigma = 0.1, L = self.L)
+                t += dt
+            self.Xs[r] += (0.5 - t) * self.Vs[r]
+        np.testing.assert_allclose(self.Xs, self.ensemble.Xs, atol = 1e-9)
+
+    def test_strategy(self):
+        '''
+        Replicas can be created at densities where tabula rasa fails
+        '''
+        ensemble = Ensemble.create(R = 3, n = 30, L = self.L, sigma = 0.08, rng = np.random.default_rng(11), M = 1000,
+                                   strategy = 'lattice')
+        self.assertEqual((3,30,2), ensemble.Xs.shape)
+        for X in ensemble.Xs:
+            k,l = np.triu_indices(30, k = 1)
+            self.assertGreaterEqual(np.linalg.norm(X[k] - X[l], axis = 1).min(), 2*0.08)
+
+if __name__=='__main__':
+    main()
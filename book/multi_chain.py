@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+
+#   Copyright (C) 2025 Simon Crase
+
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+    Run several independent hard disk Markov chains, as in Exercise 2.8, in a pool of processes.
+    Each chain has its own random number generator, spawned from a single root seed, so results
+    do not depend on the number of processes. Chains report their histograms of x coordinates
+    after each round, and these are merged into a single checkpoint, which can be used to restart
+    this program or exercise_2_8.py.
+'''
+
+from argparse import ArgumentParser, ArgumentTypeError
+from json import dumps, loads
+from multiprocessing import Pool
+from os.path import basename, join, splitext
+from tempfile import TemporaryDirectory
+from time import time
+from unittest import TestCase, main
+import numpy as np
+from checkpoint import save_npz_atomic
+from event_chain import EventChain
+from geometry import Geometry, GeometryFactory, Histogram
+from markov_disks import markov_disks, checkerboard_sweep
+
+def run_segment(task):
+    '''
+    Run one chain for a specified number of epochs: executed by worker processes
+
+    Parameters:
+        task    A tuple comprising the index of the chain, centres of disks, state of random
+                number generator, and a dictionary of parameters shared by all chains
+
+    Returns:
+        index, X, state, counts, n_accepted, lift_sum, n_chains: the index of the chain, the new centres of the disks,
+        the new state of the random number generator, histogram counts for this segment, the number of moves accepted,
+        and statistics used to estimate pressure (event chains only)
+    '''
+    index,X,state,parameters = task
+    rng = np.random.default_rng()
+    rng.bit_generator.state = state
+    geometry = GeometryFactory(periodic = parameters['periodic'], L = parameters['L'], sigma = parameters['sigma'],
+                               d = len(parameters['L']))
+    delta = parameters['delta']
+    histogram = Histogram(n = parameters['n_bins'], x0 = parameters['x0'], xn = parameters['xn'],
+                          h = np.zeros((parameters['n_bins']), dtype = np.int64))
+    chain = EventChain(geometry, ell = parameters['ell']) if parameters['algorithm'] == 'event-chain' else None
+    n_accepted = 0
+    for epoch in range(parameters['burn'] + parameters['epochs']):
+        if epoch == parameters['burn'] and chain != None:
+            chain.n_chains,chain.lift_sum = 0,0.0    # Pressure covers the same epochs as the histogram
+        if parameters['algorithm'] == 'checkerboard':
+            n = checkerboard_sweep(X, rng = rng, delta = delta, geometry = geometry)
+        elif chain == None:
+            k,X = markov_disks(X, rng = rng, delta = delta, geometry = geometry)
+            n = 1 if k > -1 else 0
+        else:
+            chain.run(X, rng = rng, coordinate = epoch % geometry.d)
+            n = 1
+        if epoch >= parameters['burn']:
+            n_accepted += n
+            histogram.add_many(X[:,0])
+    return (index, X, rng.bit_generator.state, histogram.h, n_accepted,
+            chain.lift_sum if chain != None else 0.0, chain.n_chains if chain != None else 0)
+
+class MultiChain:
+    '''
+    A collection of independent chains, and their merged statistics
+
+    Attributes:
+        Xs          Centres of disks for each chain
+        states      State of random number generator for each chain
+        parameters  Parameters shared by all chains
+        histogram   Merged histogram of x coordinates
+        n_accepted  Total number of moves accepted
+        n_epochs    Total number of epochs, summed over all chains
+        lift_sum    Total distance along event chains at lifts, used to estimate pressure
+        n_chains    Total number of event chains
+    '''
+    @staticmethod
+    def create(P = 4, X = np.zeros((4,2)), seed = None, histogram = None, **parameters):
+        '''
+        Create P chains with the same starting configuration, each with its own random number generator
+
+        Parameters:
+            P           Number of chains
+            X           Starting configuration
+            seed        Root seed for random number generators
+            histogram   Histogram of x coordinates, e.g. from a previous run (default: a new, empty histogram)
+            parameters  Parameters shared by all chains: periodic, L, sigma, delta, algorithm, ell
+        '''
+        states = [np.random.default_rng(child).bit_generator.state for child in np.random.SeedSequence(seed).spawn(P)]
+        return MultiChain(np.array([X] * P), states, histogram, **parameters)
+
+    @staticmethod
+    def load(file_name, P = None, seed = None, algorithm = 'markov', ell = 0.5):
+        '''
+        Restore chains from a checkpoint. If the checkpoint was written by exercise_2_8.py, each of P chains
+        starts from its configuration, with a random number generator spawned from seed.
+
+        Parameters:
+            file_name   Name of checkpoint
+            P           Number of chains (only used for checkpoints from exercise_2_8.py)
+            seed        Root seed for random number generators (only used for checkpoints from exercise_2_8.py)
+            algorithm   Algorithm used for each chain
+            ell         Length of each chain for event-chain Monte Carlo
+        '''
+        with np.load(file_name) as npzfile:
+            if 'X_h' in npzfile:
+                histogram = Histogram.load(npzfile, 'X')
+            else:
+                histogram = Histogram(n = len(npzfile['counts']), x0 = npzfile['bins'][0], xn = npzfile['bins'][-1],
+                                      h = npzfile['counts'].copy())
+            parameters = dict(periodic = bool(npzfile['periodic']) if 'periodic' in npzfile else False,
+                              L = npzfile['L'], sigma = float(npzfile['sigma']), delta = npzfile['delta'],
+                              algorithm = algorithm, ell = ell)
+            if 'Xs' in npzfile:
+                multi_chain = MultiChain(npzfile['Xs'], loads(str(npzfile['states'])), histogram, **parameters)
+                multi_chain.n_accepted = int(npzfile['n_accepted'])
+                multi_chain.n_epochs = int(npzfile['n_epochs'])
+                if 'lift_sum' in npzfile:
+                    multi_chain.lift_sum = float(npzfile['lift_sum'])
+                    multi_chain.n_chains = int(npzfile['n_chains'])
+                return multi_chain
+            return MultiChain.create(P = P, X = npzfile['X'], seed = seed, histogram = histogram, **parameters)
+
+    def __init__(self, Xs, states, histogram = None, **parameters):
+        '''
+        Parameters:
+            Xs          Centres of disks for each chain
+            states      State of random number generator for each chain
+            histogram   Histogram of x coordinates, e.g. from a previous run (default: a new, empty histogram)
+            parameters  Parameters shared by all chains: periodic, L, sigma, delta, algorithm, ell
+        '''
+        self.Xs = Xs
+        self.states = list(states)
+        self.histogram = Histogram() if histogram == None else histogram
+        self.parameters = parameters
+        self.n_accepted = 0
+        self.n_epochs = 0
+        self.lift_sum = 0.0
+        self.n_chains = 0
+
+    def __len__(self):
+        '''
+        Number of chains
+        '''
+        return len(self.states)
+
+    def run(self, epochs = 1000, burn = 0, pool = None):
+        '''
+        Run every chain for a specified number of epochs, then merge the results
+
+        Parameters:
+            epochs    Number of epochs to be added to histogram
+            burn      Number of epochs to be run first, without adding to histogram
+            pool      Pool of worker processes, or None to run chains in this process
+        '''
+        parameters = dict(self.parameters, epochs = epochs, burn = burn, n_bins = len(self.histogram),
+                          x0 = self.histogram.x0, xn = self.histogram.xn)
+        tasks = [(i, self.Xs[i], self.states[i], parameters) for i in range(len(self))]
+        for i,X,state,counts,n_accepted,lift_sum,n_chains in (pool.imap_unordered(run_segment, tasks) if pool != None
+                                                             else map(run_segment, tasks)):
+            self.Xs[i] = X
+            self.states[i] = state
+            self.histogram.merge(Histogram(n = len(counts), x0 = self.histogram.x0, xn = self.histogram.xn, h = counts))
+            self.n_accepted += n_accepted
+            self.n_epochs += epochs
+            self.lift_sum += lift_sum
+            self.n_chains += n_chains
+
+    def save(self, file_name):
+        '''
+        Write a checkpoint, which exercise_2_8.py can also use to restart (from the first chain)
+
+        Parameters:
+            file_name   Name of checkpoint
+        '''
+        save_npz_atomic(file_name, X = self.Xs[0], Xs = self.Xs, states = np.array(dumps(self.states)),
+                        L = self.parameters['L'], sigma = self.parameters['sigma'], delta = self.parameters['delta'],
+                        periodic = self.parameters['periodic'], n_accepted = self.n_accepted, n_epochs = self.n_epochs,
+                        lift_sum = self.lift_sum, n_chains = self.n_chains, **self.histogram.save('X'))
+
+    def get_pressure(self):
+        '''
+        Estimate beta*P from event chains (periodic boundary conditions only), or NaN if no estimate is available
+        '''
+        if self.n_chains == 0 or not self.parameters['periodic']:
+            return float('nan')
+        _,N,_ = self.Xs.shape
+        return (1 + self.lift_sum / (self.n_chains * self.parameters['ell'])) * N / np.prod(self.parameters['L'])
+
+def parse_arguments():
+    parser = ArgumentParser(description = __doc__)
+    parser.add_argument('--show', action = 'store_true', help   = 'Show plot')
+    parser.add_argument('--seed',type=int,default=None,help='Root seed for random number generators')
+    parser.add_argument('-o', '--out', default = basename(splitext(__file__)[0]),help='Name of output file')
+    parser.add_argument('--figs', default = './figs', help = 'Name of folder where plots are to be stored')
+    parser.add_argument('--N', type = int,  default = 10000, help = 'Number of iterations for each chain')
+    parser.add_argument('--chains', type = int, default = 4, help = 'Number of chains')
+    parser.add_argument('--processes', type = int, default = None, help = 'Number of processes (default: one for each core)')
+    parser.add_argument('--rounds', type = int, default = 10, help = 'Number of times chains report back (and checkpoint is written)')
+    parser.add_argument('--Disks', type = int, default = 4, help = 'Number of disks/spheres')
+    parser.add_argument('--sigma', type = float, default = 0.125, help = 'Radius of disk/sphere')
+    parser.add_argument('--d', type = int, choices = [2,3], default = 2, help = 'Number of dimensions for space')
+    parser.add_argument('--L', type = float, nargs = '+', default = [1], help = 'Length of each side of box (just one value for square/cube)')
+    parser.add_argument('--delta', type = float, nargs   = '+', default = [0.1], help    = 'Maximum distance for each step')
+    parser.add_argument('--bins', default='sqrt', type=get_bins, help = 'Binning strategy or number of bins')
+    parser.add_argument('--burn', type = int, default = 0, help = 'Used to skip over early steps without accumulating stats')
+    parser.add_argument('--restart', default = None, help  = 'Restart from checkpoint (from this program, or exercise_2_8.py)')
+    parser.add_argument('--algorithm', default = 'markov', choices = ['markov', 'event-chain', 'checkerboard'],
+                        help = 'Algorithm 2.9, event-chain Monte Carlo, or Algorithm 2.9 applied to all disks in checkerboard sweeps')
+    parser.add_argument('--ell', type = float, default = 0.5, help = 'Length of each chain for event-chain Monte Carlo')
+    parser.add_argument('--periodic', action = 'store_true', help = 'Use periodic boundary conditions')
+    parser.add_argument('--eta', type = float, default = None, help = 'Used to specify density (override sigma)')
+    return parser.parse_args()
+
+def get_bins(bins):
+    '''
+    Used to parse args.bins: either a number of bins, or the name of a binning strategy.
+    '''
+    try:
+        return int(bins)
+    except ValueError:
+        if bins in ['auto', 'fd', 'doane', 'scott', 'sturges', 'sqrt', 'stone', 'rice']:
+            return bins
+        raise ArgumentTypeError(f'Invalid binning strategy "{bins}"')
+
+def get_file_name(name,default_ext='png',seq=None):
+    '''
+    Used to create file names
+
+    Parameters:
+        name          Basis for file name
+        default_ext   Extension if non specified
+        seq           Used if there are multiple files
+    '''
+    base,ext = splitext(name)
+    if len(ext) == 0:
+        ext = default_ext
+    if seq != None:
+        base = f'{base}{seq}'
+    qualified_name = f'{base}.{ext}'
+    if ext == 'png':
+        return join(args.figs,qualified_name)
+    else:
+        return qualified_name
+
+class TestMultiChain(TestCase):
+    '''
+    Verify that results depend only on the root seed, not on the number of processes or rounds
+    '''
+    def create(self, P = 3):
+        geometry = GeometryFactory(periodic = True, L = np.array([1.0,1.0]), sigma = 0.1, d = 2)
+        return MultiChain.create(P = P, X = geometry.create_configuration(N = 8), seed = 47,
+                                 histogram = Histogram.create(bins = 20, x0 = 0, xn = 1.0, expand = False),
+                                 periodic = True, L = geometry.L, sigma = geometry.sigma, delta = np.array([0.1,0.1]),
+                                 algorithm = 'markov', ell = 0.5)
+
+    def test_reproducible(self):
+        multi_chain1 = self.create()
+        multi_chain1.run(epochs = 200)
+        multi_chain1.run(epochs = 200)
+        multi_chain2 = self.create()
+        with Pool(2) as pool:
+            multi_chain2.run(epochs = 400, pool = pool)
+        np.testing.assert_array_equal(multi_chain1.histogram.h, multi_chain2.histogram.h)
+        np.testing.assert_array_equal(multi_chain1.Xs, multi_chain2.Xs)
+        self.assertEqual(3*400*8, multi_chain1.histogram.h.sum())
+        self.assertEqual(3*400, multi_chain1.n_epochs)
+
+    def test_restart(self):
+        multi_chain1 = self.create()
+        multi_chain1.run(epochs = 100)
+        with TemporaryDirectory() as folder:
+            multi_chain1.save(join(folder, 'chains.npz'))
+            multi_chain2 = MultiChain.load(join(folder, 'chains.npz'))
+            with np.load(join(folder, 'chains.npz')) as npzfile:
+                np.testing.assert_array_equal(multi_chain1.Xs[0], npzfile['X'])
+        multi_chain1.run(epochs = 100)
+        multi_chain2.run(epochs = 100)
+        np.testing.assert_array_equal(multi_chain1.histogram.h, multi_chain2.histogram.h)
+        self.assertEqual(multi_chain1.n_accepted, multi_chain2.n_accepted)
+
+    def test_restart_event_chain(self):
+        '''
+        Statistics used to estimate pressure must survive a restart
+        '''
+        geometry = GeometryFactory(periodic = True, L = np.array([1.0,1.0]), sigma = 0.05, d = 2)
+        multi_chain1 = MultiChain.create(P = 2, X = geometry.create_configuration(N = 8), seed = 67,
+                                         periodic = True, L = geometry.L, sigma = geometry.sigma, delta = np.array([0.1,0.1]),
+                                         algorithm = 'event-chain', ell = 0.3)
+        multi_chain1.run(epochs = 100)
+        self.assertEqual(2*100, multi_chain1.n_chains)
+        multi_chain1.run(epochs = 50, burn = 20)
+        self.assertEqual(2*150, multi_chain1.n_chains)
+        with TemporaryDirectory() as folder:
+            multi_chain1.save(join(folder, 'chains.npz'))
+            multi_chain2 = MultiChain.load(join(folder, 'chains.npz'), algorithm = 'event-chain', ell = 0.3)
+        self.assertEqual(multi_chain1.n_chains, multi_chain2.n_chains)
+        self.assertEqual(multi_chain1.get_pressure(), multi_chain2.get_pressure())
+
+    def test_default_histogram(self):
+        '''
+        Chains created without a histogram must not share one
+        '''
+        X = np.array([[0.25,0.25], [0.75,0.75]])
+        parameters = dict(periodic = True, L = np.array([1.0,1.0]), sigma = 0.1, delta = np.array([0.1,0.1]),
+                          algorithm = 'markov', ell = 0.5)
+        multi_chain1 = MultiChain.create(P = 2, X = X.copy(), seed = 71, **parameters)
+        multi_chain2 = MultiChain.create(P = 2, X = X.copy(), seed = 71, **parameters)
+        self.assertIsNot(multi_chain1.histogram, multi_chain2.histogram)
+        multi_chain1.run(epochs = 10)
+        self.assertEqual(0, multi_chain2.histogram.h.sum())
+
+if __name__=='__main__':
+    args = parse_arguments()
+    from matplotlib import rc
+    from matplotlib.pyplot import figure, show
+    start  = time()
+    if args.restart == None:
+        delta = np.array(args.delta if len(args.delta)==args.d else args.delta * args.d)
+        L = Geometry.create_L(args.L,args.d)
+        geometry = GeometryFactory(periodic = args.periodic, L = L, sigma = args.sigma, d = args.d)
+        if args.eta != None:
+            geometry.set_sigma(eta = args.eta, N = args.Disks)
+        multi_chain = MultiChain.create(P = args.chains, X = geometry.create_configuration(N = args.Disks), seed = args.seed,
+                                        histogram = Histogram.create(bins = args.bins, x0 = 0, xn = L[0],
+                                                                     n_samples = args.chains * args.N * args.Disks,
+                                                                     expand = False),
+                                        periodic = args.periodic, L = L, sigma = geometry.sigma, delta = delta,
+                                        algorithm = args.algorithm, ell = args.ell)
+    else:
+        multi_chain = MultiChain.load(args.restart, P = args.chains, seed = args.seed, algorithm = args.algorithm, ell = args.ell)
+
+    save_file = get_file_name(args.out,default_ext='npz')
+    with Pool(args.processes) as pool:
+        for i in range(args.rounds):
+            epochs = args.N // args.rounds + (1 if i < args.N % args.rounds else 0)
+            multi_chain.run(epochs = epochs, burn = args.burn if i == 0 else 0, pool = pool)
+            multi_chain.save(save_file)
+            print (f'Round {i+1} of {args.rounds}: {multi_chain.n_epochs:,} epochs, {multi_chain.n_accepted:,} accepted')
+    if multi_chain.n_chains > 0 and multi_chain.parameters['periodic']:
+        print (f'Pressure: beta*P={multi_chain.get_pressure():.6g}')
+
+    rc('font',**{'family':'serif','serif':['Palatino']})
+    rc('text', usetex=True)
+    _,Disks,_ = multi_chain.Xs.shape
+    geometry = GeometryFactory(periodic = multi_chain.parameters['periodic'], L = multi_chain.parameters['L'],
+                               sigma = multi_chain.parameters['sigma'], d = len(multi_chain.parameters['L']))
+    counts,bins = multi_chain.histogram.h,multi_chain.histogram.get_edges()
+    fig = figure(figsize=(12,12))
+    ax1 = fig.add_subplot(1,1,1)
+    ax1.plot(0.5*(bins[0:-1]+bins[1:]),counts/counts.sum(),color='blue')
+    ax1.set_title(fr'{Disks} Disks {geometry.get_description()}: '
+                  fr'{len(multi_chain)} chains, {multi_chain.n_epochs:,} iterations, '
+                  fr'$\sigma=${geometry.sigma:.3g}, '
+                  fr'$\eta=${geometry.get_density(N = Disks):.3g}')
+    ax1.set_xlabel('X')
+    ax1.set_ylabel('Frequency')
+    fig.savefig(get_file_name(args.out))
+
+    elapsed = time() - start
+    minutes = int(elapsed/60)
+    seconds = elapsed - 60*minutes
+    print (f'Elapsed Time {minutes} m {seconds:.2f} s')
+
+    if args.show:
+        show()
@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+
+#   Copyright (C) 2025 Simon Crase
+
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+    Parallel tempering (replica exchange) for the Ising model. One chain runs at each temperature
+    on a ladder, using checkerboard sweeps, in a pool of processes; the spins for all chains are held in
+    shared memory, so workers update them in place. After every round of sweeps, neighbouring
+    temperatures attempt to exchange configurations, alternating between even and odd pairs.
+    Acceptance rates are recorded for each pair, together with the flow of replicas between the
+    ends of the ladder, which can be used to tune the temperatures.
+'''
+
+from argparse import ArgumentParser
+from json import dumps
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+from os.path import basename, join, splitext
+from time import time
+from unittest import TestCase, main
+import numpy as np
+from checkpoint import save_npz_atomic
+from enumerate_ising import get_exact_averages
+from markov_ising import CheckerboardIsing
+
+engines = {}         # Engines are cached by each process, as constructing neighbour tables is slow
+segments = {}        # Shared memory is attached once by each process
+
+def get_engine(shape,periodic,beta):
+    '''
+    Find an engine for a specified lattice and temperature, creating it if necessary
+    '''
+    key = (shape,periodic,beta)
+    if key not in engines:
+        engines[key] = CheckerboardIsing(shape=shape,periodic=periodic,Niterations=1,beta=beta)
+    return engines[key]
+
+def get_spins(name,shape):
+    '''
+    Map the spins for all chains from shared memory
+
+    Parameters:
+        name    Name of shared memory
+        shape   (number of temperatures, m, n)
+    '''
+    if name not in segments:
+        segments[name] = SharedMemory(name=name)
+    return np.ndarray(shape,dtype=np.int8,buffer=segments[name].buf)
+
+def run_segment(task):
+    '''
+    Perform a number of sweeps for one chain: executed by worker processes
+
+    Parameters:
+        task    A tuple comprising the index of the temperature, its energy, magnetization, and state of random
+                number generator, and a dictionary of parameters shared by all chains
+
+    Returns:
+        index, E, M, state, Ns, NMs, accepted: the index of the temperature, the new energy and magnetization,
+        the new state of the random number generator, histograms of energy and magnetization (None unless recorded),
+        and the number of flips accepted
+    '''
+    index,E,M,state,parameters = task
+    shape = (parameters['m'],parameters['n'])
+    sigma = get_spins(parameters['name'],(len(parameters['beta']),) + shape)[index]
+    engine = get_engine(shape,parameters['periodic'],parameters['beta'][index])
+    engine.rng = np.random.default_rng()
+    engine.rng.bit_generator.state = state
+    engine.accepted_moves = 0
+    N = engine.N
+    Ns = np.zeros((4*N+1),dtype=np.int64) if parameters['record'] else None
+    NMs = np.zeros((2*N+1),dtype=np.int64) if parameters['record'] else None
+    for i in range(parameters['sweeps']):
+        sigma,E,M = engine.sweep(sigma,E,M)
+        if parameters['record']:
+            Ns[E + 2*N] += 1
+            NMs[M + N] += 1
+    return index, E, M, engine.rng.bit_generator.state, Ns, NMs, engine.accepted_moves
+
+class ParallelTempering:
+    '''
+    A set of Ising chains, one for each temperature, that exchange configurations
+
+    Attributes:
+        T             Temperatures, in increasing order
+        beta          Inverse temperatures
+        m             Number of rows
+        n             Number of columns
+        N             Number of sites
+        periodic      Use periodic boundary conditions
+        shared        Shared memory holding spins
+        spins         Spins for each temperature: an array of shape (number of temperatures, m, n)
+        E             Energy at each temperature
+        M             Magnetization at each temperature
+        states        States of random number generators used by chains
+        rng           Random number generator used for exchanges
+        Ns            Histograms of energy for each temperature, indexed by E + 2N
+        NMs           Histograms of magnetization for each temperature, indexed by M + N
+        n_sweeps      Number of sweeps recorded in histograms
+        n_accepted    Number of flips accepted at each temperature
+        n_rounds      Number of rounds of exchanges attempted
+        attempted     Number of exchanges attempted between each pair of neighbouring temperatures
+        exchanged     Number of exchanges accepted between each pair of neighbouring temperatures
+        replicas      Replica currently at each temperature: replicas keep their identity as they are exchanged
+        directions    For each replica, +1 if it has visited the lowest temperature more recently than the highest,
+                      -1 if the highest more recently, and 0 if it has visited neither
+        round_trips   For each replica, the number of times it has travelled from the lowest temperature to
+                      the highest and back
+        n_up          Number of rounds for which a replica moving up the ladder was found at each temperature
+        n_down        Number of rounds for which a replica moving down the ladder was found at each temperature
+    '''
+    def __init__(self,T=[1.5,2.0,2.5,3.0],shape=(8,8),periodic=True,seed=None):
+        self.T = np.sort(np.array(T,dtype=float))
+        self.beta = 1/self.T
+        self.m,self.n = shape
+        self.N = self.m*self.n
+        self.periodic = periodic
+        n_T = len(self.T)
+        seeds = np.random.SeedSequence(seed).spawn(n_T + 1)
+        self.rng = np.random.default_rng(seeds[-1])
+        self.states = [np.random.default_rng(s).bit_generator.state for s in seeds[:-1]]
+        self.shared = SharedMemory(create=True,size=n_T*self.N)
+        self.spins = np.ndarray((n_T,self.m,self.n),dtype=np.int8,buffer=self.shared.buf)
+        self.spins[:] = self.rng.choice(np.array([-1,1],dtype=np.int8),size=self.spins.shape)
+        engine = get_engine(shape,periodic,self.beta[0])
+        self.E = np.zeros((n_T),dtype=int)
+        self.M = np.zeros((n_T),dtype=int)
+        for i in range(n_T):
+            self.E[i],self.M[i] = engine.get_energy_magnetism(self.spins[i])
+        self.Ns = np.zeros((n_T,4*self.N+1),dtype=np.int64)
+        self.NMs = np.zeros((n_T,2*self.N+1),dtype=np.int64)
+        self.n_sweeps = 0
+        self.n_accepted = np.zeros((n_T),dtype=np.int64)
+        self.n_rounds = 0
+        self.attempted = np.zeros((n_T-1),dtype=np.int64)
+        self.exchanged = np.zeros((n_T-1),dtype=np.int64)
+        self.replicas = np.arange(n_T)
+        self.directions = np.zeros((n_T),dtype=int)
+        self.round_trips = np.zeros((n_T),dtype=np.int64)
+        self.n_up = np.zeros((n_T),dtype=np.int64)
+        self.n_down = np.zeros((n_T),dtype=np.int64)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return len(self.T)
+
+    def close(self):
+        '''
+        Release shared memory
+        '''
+        if self.shared != None:
+            self.spins = np.array(self.spins)
+            if self.shared.name in segments:
+                segments.pop(self.shared.name).close()
+            self.shared.close()
+            self.shared.unlink()
+            self.shared = None
+
+    def run(self,rounds=100,sweeps=10,burn=0,pool=None):
+        '''
+        Perform a number of rounds, each comprising sweeps at every temperature followed by exchanges
+
+        Parameters:
+            rounds    Number of rounds
+            sweeps    Number of sweeps performed by each chain between exchanges
+            burn      Number of rounds at start that are not recorded in histograms
+            pool      Pool of worker processes, or None to run chains in this process
+        '''
+        for i in range(rounds):
+            parameters = {'name' : self.shared.name, 'm' : self.m, 'n' : self.n, 'periodic' : self.periodic,
+                          'beta' : list(self.beta), 'sweeps' : sweeps, 'record' : i >= burn}
+            tasks = [(index,int(self.E[index]),int(self.M[index]),self.states[index],parameters) for index in range(len(self))]
+            results = pool.imap_unordered(run_segment,tasks) if pool != None else map(run_segment,tasks)
+            for index,E,M,state,Ns,NMs,accepted in results:
+                self.E[index],self.M[index],self.states[index] = E,M,state
+                self.n_accepted[index] += accepted
+                if Ns is not None:
+                    self.Ns[index] += Ns
+                    self.NMs[index] += NMs
+            if i >= burn:
+                self.n_sweeps += sweeps
+            self.exchange()
+
+    def exchange(self):
+        '''
+        Attempt to exchange configurations between neighbouring temperatures: pairs starting at
+        even temperatures on even rounds, and odd ones on odd rounds. An exchange is accepted with
+        probability min(1, exp((beta[i] - beta[i+1]) (E[i] - E[i+1]))), which preserves the Boltzmann
+        distribution at both temperatures.
+        '''
+        for i in range(self.n_rounds % 2, len(self) - 1, 2):
+            self.attempted[i] += 1
+            log_ratio = (self.beta[i] - self.beta[i+1]) * (self.E[i] - self.E[i+1])
+            if log_ratio >= 0 or self.rng.random() < np.exp(log_ratio):
+                self.exchanged[i] += 1
+                self.spins[[i,i+1]] = self.spins[[i+1,i]]
+                self.E[[i,i+1]] = self.E[[i+1,i]]
+                self.M[[i,i+1]] = self.M[[i+1,i]]
+                self.replicas[[i,i+1]] = self.replicas[[i+1,i]]
+        self.n_rounds += 1
+        self.track_replicas()
+
+    def track_replicas(self):
+        '''
+        Update directions of replicas when they reach either end of the ladder, counting round trips,
+        and record the direction of the replica at each temperature
+        '''
+        lowest,highest = self.replicas[0],self.replicas[-1]
+        if self.directions[lowest] == -1:
+            self.round_trips[lowest] += 1
+        self.directions[lowest] = +1
+        self.directions[highest] = -1
+        directions = self.directions[self.replicas]
+        self.n_up += directions == +1
+        self.n_down += directions == -1
+
+    def get_acceptance(self):
+        '''
+        Fraction of exchanges accepted for each pair of neighbouring temperatures
+        '''
+        return self.exchanged / np.maximum(self.attempted,1)
+
+    def get_flow(self):
+        '''
+        Fraction of replicas at each temperature that are moving up the ladder. For an ideal ladder
+        this falls linearly from 1 at the lowest temperature to 0 at the highest.
+        '''
+        return self.n_up / np.maximum(self.n_up + self.n_down,1)
+
+    def get_round_trip_time(self):
+        '''
+        Mean number of rounds for one round trip, or infinity if no replica has completed one
+        '''
+        n = self.round_trips.sum()
+        return len(self) * self.n_rounds / n if n > 0 else float('inf')
+
+    def get_data(self,index):
+        '''
+        Energies that have been observed at one temperature, and their counts, in the same form as IsingData.get_data()
+        '''
+        non_zero = np.flatnonzero(self.Ns[index])
+        return non_zero - 2*self.N, self.Ns[index,non_zero]
+
+    def save(self,file_name):
+        '''
+        Save spins, histograms, and statistics for exchanges
+        '''
+        save_npz_atomic(file_name, T = self.T, spins = self.spins, E = self.E, M = self.M,
+                        states = np.array([dumps(state) for state in self.states]),
+                        periodic = self.periodic, Ns = self.Ns, NMs = self.NMs, n_sweeps = self.n_sweeps,
+                        n_accepted = self.n_accepted, attempted = self.attempted, exchanged = self.exchanged,
+                        replicas = self.replicas, round_trips = self.round_trips, flow = self.get_flow())
+
+def parse_arguments():
+    parser = ArgumentParser(description = __doc__)
+    parser.add_argument('--show', action = 'store_true', help   = 'Show plot')
+    parser.add_argument('--seed',type=int,default=None,help='Root seed for random number generators')
+    parser.add_argument('-o', '--out', default = basename(splitext(__file__)[0]),help='Name of output file')
+    parser.add_argument('--figs', default = './figs', help = 'Name of folder where plots are to be stored')
+    parser.add_argument('--periodic', default=False, action = 'store_true', help = 'Use periodic boundary conditions')
+    parser.add_argument('-m', type = int, default = 16, help = 'Number of rows')
+    parser.add_argument('-n', type = int, default = 16, help = 'Number of columns')
+    parser.add_argument('-T', '--T', default=[1.5,3.5], nargs='+', type=float,
+                        help = 'Temperatures; or lowest and highest, if --replicas is specified')
+    parser.add_argument('--replicas', type = int, default = None, help = 'Number of temperatures, spaced geometrically')
+    parser.add_argument('--rounds', type = int, default = 1000, help = 'Number of rounds of exchanges')
+    parser.add_argument('--sweeps', type = int, default = 10, help = 'Number of sweeps between exchanges')
+    parser.add_argument('--burn', type = int, default = 100, help = 'Number of rounds before statistics are recorded')
+    parser.add_argument('--processes', type = int, default = None, help = 'Number of processes (default: one for each core)')
+    return parser.parse_args()
+
+def get_file_name(name,default_ext='png',seq=None):
+    '''
+    Used to create file names
+
+    Parameters:
+        name          Basis for file name
+        default_ext   Extension if non specified
+        seq           Used if there are multiple files
+    '''
+    base,ext = splitext(name)
+    if len(ext) == 0:
+        ext = default_ext
+    if seq != None:
+        base = f'{base}{seq}'
+    qualified_name = f'{base}.{ext}'
+    if ext == 'png':
+        return join(args.figs,qualified_name)
+    else:
+        return qualified_name
+
+class TestParallelTempering(TestCase):
+    '''
+    Tests for ParallelTempering
+    '''
+    def test_reproducible(self):
+        '''
+        Results should depend only on the seed, not on the number of processes
+        '''
+        with ParallelTempering(T=[1.5,2.0,2.5],shape=(6,6),periodic=True,seed=53) as tempering1:
+            tempering1.run(rounds=20,sweeps=5)
+        with ParallelTempering(T=[1.5,2.0,2.5],shape=(6,6),periodic=True,seed=53) as tempering2:
+            with Pool(2) as pool:
+                tempering2.run(rounds=20,sweeps=5,pool=pool)
+        np.testing.assert_array_equal(tempering1.spins,tempering2.spins)
+        np.testing.assert_array_equal(tempering1.Ns,tempering2.Ns)
+        np.testing.assert_array_equal(tempering1.exchanged,tempering2.exchanged)
+        self.assertEqual(3*100,tempering1.Ns.sum())
+        self.assertEqual([10,10],list(tempering1.attempted))
+
+    def test_consistent(self):
+        '''
+        Energy and magnetization must follow configurations when they are exchanged
+        '''
+        with ParallelTempering(T=[1.8,2.0,2.2,2.4],shape=(5,4),periodic=False,seed=59) as tempering:
+            tempering.run(rounds=50,sweeps=2)
+            engine = CheckerboardIsing(shape=(5,4),periodic=False)
+            for i in range(len(tempering)):
+                self.assertEqual((tempering.E[i],tempering.M[i]),engine.get_energy_magnetism(tempering.spins[i]))
+            self.assertGreater(tempering.exchanged.sum(),0)
+            self.assertEqual(list(range(4)),sorted(tempering.replicas))
+
+    def test_boltzmann(self):
+        '''
+        Exchanges must preserve the Boltzmann distribution at each temperature
+        '''
+        shape = (4,4)
+        with ParallelTempering(T=[1.5,2.0,2.5,3.0],shape=shape,periodic=True,seed=61) as tempering:
+            tempering.run(rounds=1000,sweeps=2,burn=50)
+            for i,beta in enumerate(tempering.beta):
+                mean_E,_,_ = get_exact_averages(shape,periodic=True,beta=beta)
+                E,N = tempering.get_data(i)
+                self.assertAlmostEqual(mean_E,(E*N).sum()/N.sum(),delta=0.5)
+            self.assertTrue(all(tempering.get_acceptance() > 0))
+            self.assertGreater(tempering.round_trips.sum(),0)
+            flow = tempering.get_flow()
+            self.assertEqual(1,flow[0])
+            self.assertEqual(0,flow[-1])
+
+if __name__=='__main__':
+    args = parse_arguments()
+    from matplotlib import rc
+    from matplotlib.pyplot import figure, show
+    from thermo_db import thermo
+    start  = time()
+    T = np.geomspace(args.T[0],args.T[-1],args.replicas) if args.replicas != None else args.T
+    with ParallelTempering(T=T,shape=(args.m,args.n),periodic=args.periodic,seed=args.seed) as tempering:
+        with Pool(args.processes) as pool:
+            tempering.run(rounds=args.rounds,sweeps=args.sweeps,burn=args.burn,pool=pool)
+        tempering.save(get_file_name(args.out,default_ext='npz'))
+
+    for T0,T1,rate in zip(tempering.T[:-1],tempering.T[1:],tempering.get_acceptance()):
+        print (f'T={T0:.4g}-{T1:.4g}: exchanges accepted {rate:.3f}')
+    print (f'Round trips: {tempering.round_trips.sum()}, mean rounds for one round trip: {tempering.get_round_trip_time():.4g}')
+
+    e = np.zeros((len(tempering)))
+    cV = np.zeros((len(tempering)))
+    for i,beta in enumerate(tempering.beta):
+        E,N = tempering.get_data(i)
+        e[i],cV[i] = thermo(E,N,beta=beta,NObservations=tempering.N)
+
+    rc('font',**{'family':'serif','serif':['Palatino']})
+    rc('text', usetex=True)
+    fig = figure(figsize=(12,12))
+    fig.suptitle(fr'Parallel tempering: {args.m}$\times${args.n} sites, {len(tempering)} temperatures, '
+                 fr'{args.rounds} rounds of {args.sweeps} sweeps')
+    ax1 = fig.add_subplot(3,1,1)
+    ax1.plot(tempering.T,e,color='blue',marker='o',label='e')
+    ax1t = ax1.twinx()
+    ax1t.plot(tempering.T,cV,color='red',marker='o',label='$c_V$')
+    ax1.set_xlabel('T')
+    ax1.set_ylabel('e')
+    ax1t.set_ylabel('$c_V$')
+    ax2 = fig.add_subplot(3,1,2)
+    ax2.plot(0.5*(tempering.T[:-1] + tempering.T[1:]),tempering.get_acceptance(),color='blue',marker='o')
+    ax2.set_xlabel('T')
+    ax2.set_ylabel('Exchanges accepted')
+    ax3 = fig.add_subplot(3,1,3)
+    ax3.plot(tempering.T,tempering.get_flow(),color='blue',marker='o')
+    ax3.set_xlabel('T')
+    ax3.set_ylabel('Fraction moving up')
+    fig.savefig(get_file_name(args.out))
+
+    elapsed = time() - start
+    minutes = int(elapsed/60)
+    seconds = elapsed - 60*minutes
+    print (f'Elapsed Time {minutes} m {seconds:.2f} s')
+
+    if args.show:
+        show()
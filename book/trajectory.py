@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2025 Simon Crase
+
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with GNU Emacs.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+    Record samples from a long run to a file on disk, in fixed size chunks, so that
+    the length of a run is not limited by memory, and samples that have already been
+    written survive if the run is stopped. The file can be memory mapped by a reader
+    while the run is still going.
+
+    File layout:
+        bytes 0-7       Magic number
+        bytes 8-15      Number of samples that have been committed (little endian uint64)
+        bytes 16-255    JSON description of samples: dtype, shape, and names of fields
+        bytes 256-      Samples
+'''
+
+from json import dumps, loads
+from os.path import exists, getsize
+from tempfile import TemporaryDirectory
+from unittest import TestCase, main
+import numpy as np
+
+MAGIC = b'SMACTRAJ'
+HEADER_SIZE = 256
+
+class TrajectoryRecorder:
+    '''
+    Append samples to a trajectory file. Samples are buffered in memory, and written one chunk at a time.
+    The count of samples in the header is only updated once a chunk has been written, so a reader never
+    sees a partial chunk.
+
+    Attributes:
+        path      Name of file
+        shape     Shape of one sample
+        fields    Names of fields (first axis of a sample)
+        buffer    Samples that have not yet been written
+        n_buffer  Number of samples in buffer
+        count     Number of samples that have been committed to file
+    '''
+    def __init__(self, path, shape = (1,), fields = (), dtype = np.float64, chunk = 1024, append = False):
+        '''
+        Parameters:
+            path      Name of file
+            shape     Shape of one sample
+            fields    Names of fields (first axis of a sample)
+            dtype     Type of data
+            chunk     Number of samples to be buffered before writing
+            append    If the file already exists, add samples to it instead of replacing it
+        '''
+        self.path = path
+        self.shape = tuple(shape)
+        self.fields = list(fields)
+        self.dtype = np.dtype(dtype)
+        self.buffer = np.empty((chunk,) + self.shape, dtype = self.dtype)
+        self.n_buffer = 0
+        if append and exists(path):
+            self.count,dtype,shape,fields = read_header(path)
+            if dtype != self.dtype or shape != self.shape:
+                raise ValueError(f'{path} contains samples of type {dtype} and shape {shape}: '
+                                 f'cannot append {self.dtype} {self.shape}')
+            self.file = open(path, 'r+b')
+            self.file.truncate(HEADER_SIZE + self.count * self.get_sample_size())
+        else:
+            self.count = 0
+            self.file = open(path, 'w+b')
+            description = dumps({'dtype' : self.dtype.str, 'shape' : self.shape, 'fields' : self.fields}).encode()
+            if len(description) > HEADER_SIZE - 16:
+                raise ValueError(f'Description of samples is too long: {description}')
+            self.file.write(MAGIC + np.uint64(0).tobytes() + description.ljust(HEADER_SIZE - 16))
+            self.file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def __len__(self):
+        '''
+        Number of samples recorded, including those that have not yet been written
+        '''
+        return self.count + self.n_buffer
+
+    def get_sample_size(self):
+        '''
+        Number of bytes in one sample
+        '''
+        return self.dtype.itemsize * int(np.prod(self.shape))
+
+    def append(self, sample):
+        '''
+        Record one sample
+
+        Parameters:
+            sample    Array whose shape matches self.shape
+        '''
+        self.buffer[self.n_buffer] = sample
+        self.n_buffer += 1
+        if self.n_buffer == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        '''
+        Write buffered samples to file, then commit them by updating count in header
+        '''
+        if self.n_buffer == 0: return
+        self.file.seek(HEADER_SIZE + self.count * self.get_sample_size())
+        self.file.write(self.buffer[0:self.n_buffer].tobytes())
+        self.file.flush()
+        self.count += self.n_buffer
+        self.n_buffer = 0
+        self.file.seek(len(MAGIC))
+        self.file.write(np.uint64(self.count).tobytes())
+        self.file.flush()
+
+    def close(self):
+        '''
+        Write any remaining samples and close file
+        '''
+        if self.file.closed: return
+        self.flush()
+        self.file.close()
+
+def read_header(path):
+    '''
+    Read the header of a trajectory file
+
+    Returns:
+        count, dtype, shape, fields
+    '''
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    if header[0:len(MAGIC)] != MAGIC:
+        raise ValueError(f'{path} is not a trajectory file')
+    count = int(np.frombuffer(header[8:16], dtype = np.uint64)[0])
+    description = loads(header[16:].decode().strip())
+    return count, np.dtype(description['dtype']), tuple(description['shape']), description['fields']
+
+class Trajectory:
+    '''
+    Read a trajectory file by mapping it into memory, without copying. The file may still be being written.
+
+    Attributes:
+        path      Name of file
+        dtype     Type of data
+        shape     Shape of one sample
+        fields    Names of fields (first axis of a sample)
+        data      Memory mapped array of all committed samples
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.refresh()
+
+    def refresh(self):
+        '''
+        Map any samples that have been committed since the file was last mapped
+        '''
+        count,self.dtype,self.shape,self.fields = read_header(self.path)
+        self.data = (np.memmap(self.path, dtype = self.dtype, mode = 'r', offset = HEADER_SIZE, shape = (count,) + self.shape)
+                        if count > 0 else np.empty((0,) + self.shape, dtype = self.dtype))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, i):
+        return self.data[i]
+
+    def get_field(self, name):
+        '''
+        Find all samples of one named field
+        '''
+        return self.data[:, self.fields.index(name)]
+
+    def chunks(self, size = 1024, field = None, start = 0):
+        '''
+        Iterate through samples a chunk at a time
+
+        Parameters:
+            size     Number of samples in each chunk
+            field    Name of field (default: all fields)
+            start    Index of first sample
+        '''
+        data = self.data if field == None else self.get_field(field)
+        for i in range(start, len(data), size):
+            yield data[i:i+size]
+
+    def get_histogram(self, field, bins = 10, start = 0, size = 1024):
+        '''
+        Histogram one field, one chunk at a time, so the whole trajectory never needs to be in memory.
+
+        Parameters:
+            field    Name of field
+            bins     Bin edges, number of bins, or name of a binning strategy: a strategy is
+                     evaluated on the first chunk, over the range of the whole trajectory
+            start    Index of first sample to be used
+            size     Number of samples in each chunk
+
+        Returns:
+            counts, bin edges
+        '''
+        if np.ndim(bins) == 0:
+            lo = min(chunk.min() for chunk in self.chunks(size = size, field = field, start = start))
+            hi = max(chunk.max() for chunk in self.chunks(size = size, field = field, start = start))
+            bins = np.histogram_bin_edges(next(self.chunks(size = size, field = field, start = start)),
+                                          bins = bins, range = (lo,hi))
+        counts = np.zeros((len(bins)-1), dtype = np.int64)
+        for chunk in self.chunks(size = size, field = field, start = start):
+            counts += np.histogram(chunk, bins = bins)[0]
+        return counts, bins
+
+class TestTrajectory(TestCase):
+    '''
+    Tests for TrajectoryRecorder and Trajectory
+    '''
+    def test_round_trip(self):
+        with TemporaryDirectory() as folder:
+            path = f'{folder}/test.traj'
+            samples = np.arange(2*3*5, dtype = float).reshape(5,2,3)
+            with TrajectoryRecorder(path, shape = (2,3), fields = ('X','V'), chunk = 2) as recorder:
+                for sample in samples:
+                    recorder.append(sample)
+                self.assertEqual(4, len(Trajectory(path)))
+            trajectory = Trajectory(path)
+            self.assertEqual(5, len(trajectory))
+            np.testing.assert_array_equal(samples, trajectory.data)
+            np.testing.assert_array_equal(samples[:,1], trajectory.get_field('V'))
+            self.assertEqual([2,2,1], [len(chunk) for chunk in trajectory.chunks(size = 2, field = 'X')])
+            counts,bins = trajectory.get_histogram('X', bins = 4, size = 2)
+            counts0,bins0 = np.histogram(samples[:,0], bins = 4)
+            np.testing.assert_array_equal(counts0, counts)
+            np.testing.assert_array_equal(bins0, bins)
+
+    def test_append(self):
+        with TemporaryDirectory() as folder:
+            path = f'{folder}/test.traj'
+            with TrajectoryRecorder(path, shape = (3,), chunk = 4) as recorder:
+                recorder.append(np.zeros(3))
+            with TrajectoryRecorder(path, shape = (3,), chunk = 4, append = True) as recorder:
+                recorder.append(np.ones(3))
+            trajectory = Trajectory(path)
+            np.testing.assert_array_equal([[0,0,0],[1,1,1]], trajectory.data)
+            self.assertEqual(HEADER_SIZE + 2*3*8, getsize(path))
+            with self.assertRaises(ValueError):
+                TrajectoryRecorder(path, shape = (4,), append = True)
+
+if __name__=='__main__':
+    main()